@@ -1,5 +1,254 @@
+"""
+brain_analyser
+==============
+
+A module to analyse the registered atlas, e.g. to count cells per region
+"""
+import os
+
+import numpy as np
+
+from amap.analysis.point_transform import iter_point_chunks
+from amap.analysis.region_intensities import DEFAULT_MAX_CHUNK_BYTES, region_intensities
+from amap.brain import brain_io as bio
+from amap.config.atlas import get_labels_lut
+
+
+def nearest_voxel_indices(voxels):
+    """
+    Round voxel coordinates to the nearest voxel
+
+    :param np.ndarray voxels: (N, 3) voxel coordinates (can be fractional)
+    :return: The (N, 3) integer indices
+    :rtype: np.ndarray
+    """
+    return np.floor(np.asarray(voxels, dtype=np.float64) + 0.5).astype(np.int64)
+
+
+def is_inside(volume, indices):
+    """
+    Whether each voxel is inside the volume
+
+    :param np.ndarray volume: The volume
+    :param np.ndarray indices: (N, 3) integer voxel indices (see nearest_voxel_indices)
+    :return: The (N, ) mask
+    :rtype: np.ndarray
+    """
+    return np.all((indices >= 0) & (indices < np.array(volume.shape[:3])), axis=1)
+
+
+def lookup_voxels(volume, voxels, outside_value=0):
+    """
+    Get the values of volume at the nearest voxel of each of the points
+
+    :param np.ndarray volume: The volume (can be memory mapped)
+    :param np.ndarray voxels: (N, 3) voxel coordinates (can be fractional)
+    :param outside_value: The value of the points outside of the volume
+    :return: The (N, ) values
+    :rtype: np.ndarray
+    """
+    indices = nearest_voxel_indices(voxels)
+    inside = is_inside(volume, indices)
+    values = np.full(len(indices), outside_value, dtype=volume.dtype)
+    inside_indices = indices[inside]
+    values[inside] = volume[inside_indices[:, 0], inside_indices[:, 1], inside_indices[:, 2]]
+    return values
+
+
+def save_table(table, dest_path):
+    """
+    Save a structured array (e.g. returned by BrainAnalyser.classify_counts) as a csv file
+
+    :param np.ndarray table: The structured array
+    :param str dest_path: The destination csv file
+    """
+    fmt = ['%.6g' if np.issubdtype(table.dtype[name], np.floating) else '%d' for name in table.dtype.names]
+    np.savetxt(dest_path, table, delimiter=',', fmt=fmt, header=','.join(table.dtype.names), comments='')
 
 
 class BrainAnalyser(object):
-    def classify_counts(self):
-        pass
+    """
+    A class to count cells (or any points) per region of the atlas registered to the sample.
+    The lookups are vectorised over chunks of points against the memory mapped registered atlas
+    and the counts accumulated with np.bincount over compact label indices.
+    """
+    def __init__(self, registered_atlas_path, registered_hemispheres_path=None, labels_lut_path=None,
+                 sample_space=None):
+        """
+
+        :param str registered_atlas_path: The atlas in sample space (see BrainRegistration.segment)
+        :param str registered_hemispheres_path: The hemispheres atlas in sample space (optional)
+        :param str labels_lut_path: If the registered atlas is compact, the lookup table to the region IDs
+        :param amap.brain.sample_space.SampleSpace sample_space: If set, the points are expected in raw sample
+            coordinates and scaled to the registered atlas, otherwise they must be in registered atlas voxels
+        """
+        self.registered_atlas_path = registered_atlas_path
+        self.atlas = bio.load_nii(registered_atlas_path, as_array=True)  # memory mapped
+        if registered_hemispheres_path:
+            self.hemispheres = bio.load_nii(registered_hemispheres_path, as_array=True)
+        else:
+            self.hemispheres = None
+        self.labels_lut_path = labels_lut_path
+        self.sample_space = sample_space
+        self._labels_lut = None
+
+    @classmethod
+    def from_registration(cls, brain_registration, sample_space=None):
+        """
+        Create the analyser from the outputs of a registration, using the compact registered atlas if available
+
+        :param amap.registration.brain_registration.BrainRegistration brain_registration:
+        :param amap.brain.sample_space.SampleSpace sample_space:
+        :return: The analyser
+        :rtype: BrainAnalyser
+        """
+        hemispheres_path = brain_registration.registered_hemispheres_img_path
+        if not os.path.exists(hemispheres_path):
+            hemispheres_path = None
+        if brain_registration.is_atlas_compact and os.path.exists(brain_registration.registered_compact_atlas_img_path):
+            return cls(brain_registration.registered_compact_atlas_img_path, hemispheres_path,
+                       labels_lut_path=brain_registration.atlas_labels_lut_path, sample_space=sample_space)
+        else:
+            return cls(brain_registration.registered_atlas_img_path, hemispheres_path, sample_space=sample_space)
+
+    @property
+    def is_compact(self):
+        return self.labels_lut_path is not None
+
+    @property
+    def labels_lut(self):
+        """
+        The sorted region IDs of the atlas. For a compact atlas, these are indexed by the atlas values,
+        otherwise they are computed in one pass over the registered atlas.
+
+        :rtype: np.ndarray
+        """
+        if self._labels_lut is None:
+            if self.is_compact:
+                self._labels_lut = np.load(self.labels_lut_path)
+            else:
+                self._labels_lut = get_labels_lut(self.atlas)
+        return self._labels_lut
+
+    @property
+    def outside_label_index(self):
+        """
+        The label index of the points outside of the atlas. It is the index of the background (0) in
+        self.labels_lut if the atlas has one, otherwise a dedicated index after the labels (see region_ids)
+        so that these points are not counted towards a region.
+
+        :rtype: int
+        """
+        background_idx = int(np.searchsorted(self.labels_lut, 0))
+        if background_idx < len(self.labels_lut) and self.labels_lut[background_idx] == 0:
+            return background_idx
+        return len(self.labels_lut)
+
+    @property
+    def region_ids(self):
+        """
+        The region ID of each label index: self.labels_lut followed by the background (0)
+        for the points outside of the atlas (see outside_label_index)
+
+        :rtype: np.ndarray
+        """
+        return np.append(self.labels_lut, np.zeros(1, dtype=self.labels_lut.dtype))
+
+    def get_atlas_voxels(self, points):
+        if self.sample_space is not None:
+            return self.sample_space.raw_to_downsampled(points)
+        else:
+            return points
+
+    def lookup_label_indices(self, points):
+        """
+        Get the compact label index (position in self.region_ids) of each point.
+        Points outside of the atlas are assigned to self.outside_label_index (the background).
+
+        :param np.ndarray points: (N, 3) coordinates (see __init__)
+        :return: (N, ) indices
+        :rtype: np.ndarray
+        """
+        indices = nearest_voxel_indices(self.get_atlas_voxels(points))
+        inside = is_inside(self.atlas, indices)
+        label_indices = np.full(len(indices), self.outside_label_index, dtype=np.int64)
+        values = self.atlas[indices[inside, 0], indices[inside, 1], indices[inside, 2]]
+        if self.is_compact:
+            label_indices[inside] = values
+        else:
+            label_indices[inside] = np.searchsorted(self.labels_lut, values)
+        return label_indices
+
+    def lookup_regions(self, points):
+        """
+        Get the region ID of each point
+
+        :param np.ndarray points: (N, 3) coordinates (see __init__)
+        :return: (N, ) region IDs
+        :rtype: np.ndarray
+        """
+        return self.region_ids[self.lookup_label_indices(points)]
+
+    def lookup_hemispheres(self, points):
+        """
+        Get the hemisphere of each point (0 if there is no hemispheres atlas)
+
+        :param np.ndarray points: (N, 3) coordinates (see __init__)
+        :return: (N, ) hemispheres
+        :rtype: np.ndarray
+        """
+        if self.hemispheres is None:
+            return np.zeros(len(points), dtype=np.uint8)
+        return lookup_voxels(self.hemispheres, self.get_atlas_voxels(points))
+
+    def classify_counts(self, points, chunk_size=10**6):
+        """
+        Count the points per region (and hemisphere)
+
+        :param points: An (N, 3) array of points or the path to a points file (see iter_point_chunks)
+        :param int chunk_size: The number of points to look up at once
+        :return: A table (structured array) with the region_id, hemisphere and count of the regions with points
+        :rtype: np.ndarray
+        """
+        if isinstance(points, str):
+            chunks = iter_point_chunks(points, chunk_size)
+        else:
+            chunks = (points[start:start + chunk_size] for start in range(0, len(points), chunk_size))
+        region_ids = self.region_ids
+        n_labels = len(region_ids)
+        counts = np.zeros((1, n_labels), dtype=np.int64)
+        for chunk in chunks:
+            label_indices = self.lookup_label_indices(chunk)
+            hemispheres = self.lookup_hemispheres(chunk).astype(np.int64)
+            n_hemispheres = max(counts.shape[0], int(hemispheres.max()) + 1 if len(hemispheres) else 0)
+            if n_hemispheres > counts.shape[0]:
+                counts = np.vstack((counts, np.zeros((n_hemispheres - counts.shape[0], n_labels), dtype=np.int64)))
+            counts += np.bincount(hemispheres * n_labels + label_indices,
+                                  minlength=n_hemispheres * n_labels).reshape(n_hemispheres, n_labels)
+        hemisphere_idx, label_idx = np.nonzero(counts)
+        table = np.empty(len(label_idx), dtype=[('region_id', region_ids.dtype), ('hemisphere', np.int64),
+                                                ('count', np.int64)])
+        table['region_id'] = region_ids[label_idx]
+        table['hemisphere'] = hemisphere_idx
+        table['count'] = counts[hemisphere_idx, label_idx]
+        return table
+
+    def measure_intensities(self, raw_src_path, sort_input_file=False, chunk_size=None,
+                            max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, n_processes=None):
+        """
+        Measure the count, sum and mean of the raw resolution signal per region
+        (see amap.analysis.region_intensities). This requires the sample space.
+
+        :param str raw_src_path: The raw channel (folder of tiff planes, text file listing them, tiff stack or nifty)
+        :param bool sort_input_file: If the input is a text file, natural sort the paths
+        :param int chunk_size: The number of planes per task (defaults to as many as fit in max_chunk_bytes)
+        :param int max_chunk_bytes: The maximum size in bytes of the planes of a task if chunk_size is not given
+        :param int n_processes: The number of processes (see region_intensities)
+        :return: A table (structured array) with the region_id, count, sum and mean of the regions with signal
+        :rtype: np.ndarray
+        """
+        if self.sample_space is None:
+            raise ValueError('The sample space is required to map the raw planes to the registered atlas')
+        return region_intensities(raw_src_path, self.registered_atlas_path, self.sample_space, self.labels_lut,
+                                  is_compact=self.is_compact, sort_input_file=sort_input_file,
+                                  chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, n_processes=n_processes)
@@ -0,0 +1,174 @@
+"""
+label_lookup
+============
+
+A lightweight service to answer "which region is this raw voxel in?" queries.
+The registered atlas is memory mapped once and the raw coordinates scaled to it on the fly
+(see amap.analysis.brain_analyser.BrainAnalyser), so no raw resolution atlas is ever built.
+It can be used in process (LabelLookup) or through a local socket server speaking json lines
+(LabelLookupServer and LabelLookupClient).
+"""
+import json
+import socket
+import argparse
+import socketserver
+
+import numpy as np
+
+from amap.analysis.brain_analyser import BrainAnalyser
+from amap.brain.sample_space import SampleSpace, get_sample_space_path
+
+
+class LabelLookupError(Exception):
+    pass
+
+
+class LabelLookup(object):
+    """
+    Look up the region ID and hemisphere of raw sample coordinates
+    """
+    def __init__(self, brain_analyser):
+        """
+
+        :param BrainAnalyser brain_analyser: The analyser of the registered atlas (with its sample space
+            to query raw coordinates)
+        """
+        self.analyser = brain_analyser
+        self.analyser.labels_lut  # Computed once up front so that queries are only lookups
+
+    @classmethod
+    def from_output_folder(cls, output_folder, sample_name):
+        """
+        Create the lookup from the outputs of amap for a sample
+
+        :param str output_folder: The output folder of the registration
+        :param str sample_name: The name of the sample
+        :return: The lookup
+        :rtype: LabelLookup
+        """
+        from amap.registration.brain_registration import BrainRegistration
+        sample_space = SampleSpace.load(get_sample_space_path(output_folder, sample_name))
+        brain_registration = BrainRegistration(sample_name, sample_space.reference_img_path, output_folder)
+        return cls(BrainAnalyser.from_registration(brain_registration, sample_space=sample_space))
+
+    def query(self, points):
+        """
+        Get the region ID and hemisphere of each point
+
+        :param np.ndarray points: (N, 3) raw sample coordinates
+        :return: region_ids, hemispheres
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        return self.analyser.lookup_regions(points), self.analyser.lookup_hemispheres(points)
+
+    def query_dict(self, points):
+        """
+        Like query but returns a json serialisable dictionary
+
+        :param points: (N, 3) raw sample coordinates
+        :return: {'region_ids': [...], 'hemispheres': [...]}
+        :rtype: dict
+        """
+        region_ids, hemispheres = self.query(points)
+        return {'region_ids': region_ids.tolist(), 'hemispheres': hemispheres.tolist()}
+
+
+class _LabelLookupHandler(socketserver.StreamRequestHandler):
+    """
+    Answers one json object per line of the form {"points": [[x, y, z], ...]} until the client disconnects
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.lookup.query_dict(json.loads(line.decode('utf-8'))['points'])
+            except (ValueError, KeyError, TypeError) as err:
+                response = {'error': '{}: {}'.format(type(err).__name__, err)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class LabelLookupServer(socketserver.ThreadingTCPServer):
+    """
+    A local TCP server answering label queries (see _LabelLookupHandler for the protocol)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, lookup, host='127.0.0.1', port=0):
+        """
+
+        :param LabelLookup lookup:
+        :param str host: The interface to listen on (local only by default)
+        :param int port: The port (0 to pick a free one, see self.server_address)
+        """
+        self.lookup = lookup
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), _LabelLookupHandler)
+
+
+class LabelLookupClient(object):
+    """
+    A client of LabelLookupServer keeping its connection open between queries
+    """
+    def __init__(self, host='127.0.0.1', port=0, timeout=10):
+        self.connection = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.connection.makefile('rwb')
+
+    def query(self, points):
+        """
+        Get the region ID and hemisphere of each point from the server
+
+        :param points: (N, 3) raw sample coordinates
+        :return: region_ids, hemispheres
+        :rtype: (np.ndarray, np.ndarray)
+        :raises LabelLookupError: If the server could not answer the query
+        """
+        request = {'points': np.asarray(points, dtype=np.float64).tolist()}
+        self.stream.write((json.dumps(request) + '\n').encode('utf-8'))
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise LabelLookupError('The server closed the connection')
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise LabelLookupError(response['error'])
+        return np.array(response['region_ids']), np.array(response['hemispheres'])
+
+    def close(self):
+        self.stream.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Serve region lookups of raw sample coordinates for a sample '
+                                                 'registered with amap')
+    parser.add_argument('output_folder', type=str, help='The output folder of the registration')
+    parser.add_argument('sample_name', type=str, help='The name of the sample')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='The interface to listen on')
+    parser.add_argument('--port', type=int, default=0, help='The port to listen on (0 picks a free port)')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    server = LabelLookupServer(LabelLookup.from_output_folder(args.output_folder, args.sample_name),
+                               args.host, args.port)
+    print("Serving label lookups on {}:{}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+point_transform
+===============
+
+Vectorised transformation of large numbers of points (typically detected cells) from the raw sample
+space to the atlas space. Points are processed in chunks, optionally on several processes,
+and can be streamed from and to .npy or .csv files.
+"""
+import itertools
+
+import numpy as np
+
+from amap.brain import brain_io as bio
+from amap.utils.parallel import bounded_map
+
+
+class PointTransformError(Exception):
+    pass
+
+
+def _is_header(line):
+    try:
+        [float(value) for value in line.replace(',', ' ').split()]
+    except ValueError:
+        return True
+    return False
+
+
+def iter_point_chunks(src_path, chunk_size=10**6):
+    """
+    Iterate over the points stored in src_path by chunks.
+    Points can be stored as a (N, 3) .npy array (memory mapped) or as a .csv/.txt file
+    with one point per line (an optional header line is skipped).
+
+    :param str src_path: The path of the points file
+    :param int chunk_size: The number of points per chunk
+    :return: A generator of (n, 3) arrays
+    """
+    if src_path.endswith('.npy'):
+        points = np.load(src_path, mmap_mode='r')
+        for start in range(0, len(points), chunk_size):
+            yield np.asarray(points[start:start + chunk_size, :3], dtype=np.float64)
+    elif src_path.endswith(('.csv', '.txt')):
+        with open(src_path, 'r') as in_file:
+            first_line = in_file.readline()
+            lines = in_file if _is_header(first_line) else itertools.chain((first_line, ), in_file)
+            while True:
+                chunk_lines = list(itertools.islice(lines, chunk_size))
+                if not chunk_lines:
+                    break
+                yield np.loadtxt(chunk_lines, delimiter=',' if ',' in chunk_lines[0] else None,
+                                 ndmin=2)[:, :3]
+    else:
+        raise NotImplementedError('Could not guess points format for path {}'.format(src_path))
+
+
+def count_points(src_path):
+    """
+    Count the points in a file readable by iter_point_chunks without loading them
+
+    :param str src_path: The path of the points file
+    :return: The number of points
+    :rtype: int
+    """
+    if src_path.endswith('.npy'):
+        return len(np.load(src_path, mmap_mode='r'))
+    with open(src_path, 'r') as in_file:
+        first_line = in_file.readline()
+        n_points = sum(1 for line in in_file if line.strip())
+    if first_line.strip() and not _is_header(first_line):
+        n_points += 1
+    return n_points
+
+
+class SampleToAtlasTransform(object):
+    """
+    The transformation of points from the raw sample voxel coordinates to the atlas voxel coordinates.
+    It chains the downsampling to the atlas resolution (see BrainProcessor), the registration transform
+    (see amap.registration.deformation) and the orientation and flips that were applied to the atlas.
+    """
+    def __init__(self, sample_space, deformation, registered_atlas_affine, registered_atlas_shape):
+        """
+
+        :param amap.brain.sample_space.SampleSpace sample_space: The geometry of the sample
+        :param amap.registration.deformation.Deformation deformation: The registration transform
+        :param np.ndarray registered_atlas_affine: The voxel to world matrix of the atlas used for the registration
+        :param tuple registered_atlas_shape: The shape of the atlas used for the registration
+        """
+        self.sample_space = sample_space
+        self.deformation = deformation
+        self.world_to_atlas = np.linalg.inv(registered_atlas_affine)
+        self.registered_atlas_shape = tuple(registered_atlas_shape[:3])
+
+    @classmethod
+    def from_registration(cls, brain_registration, sample_space):
+        """
+        Build the transform from the outputs of a registration
+
+        :param amap.registration.brain_registration.BrainRegistration brain_registration:
+        :param amap.brain.sample_space.SampleSpace sample_space:
+        :return: The transform
+        :rtype: SampleToAtlasTransform
+        """
+        atlas_header = bio.load_nii(brain_registration.atlas_img_path, as_array=False).header
+        return cls(sample_space, brain_registration.get_deformation(), atlas_header.get_best_affine(),
+                   atlas_header.get_data_shape())
+
+    def transform(self, points):
+        """
+        Transform the points
+
+        :param np.ndarray points: (N, 3) raw sample voxel coordinates
+        :return: (N, 3) atlas voxel coordinates (original atlas orientation)
+        :rtype: np.ndarray
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise PointTransformError('Expected an (N, 3) array of points, got shape {}'.format(points.shape))
+        downsampled_points = self.sample_space.raw_to_downsampled(points)
+        atlas_world_points = self.deformation.transform_points(downsampled_points)
+        registered_atlas_points = np.dot(atlas_world_points, self.world_to_atlas[:3, :3].T) + self.world_to_atlas[:3, 3]
+        return self.sample_space.registered_atlas_to_atlas(registered_atlas_points, self.registered_atlas_shape)
+
+    def transform_chunks(self, chunks, n_processes=1):
+        """
+        Transform a stream of chunks of points, optionally on several processes
+
+        :param chunks: An iterable of (n, 3) arrays of raw sample voxel coordinates
+        :param int n_processes: The number of processes to use
+        :return: A generator of the transformed chunks (in order)
+        """
+        return bounded_map(self.transform, chunks, n_processes)
+
+    def transform_array(self, points, chunk_size=10**6, n_processes=1):
+        """
+        Transform an (N, 3) array of points by chunks
+
+        :param np.ndarray points: (N, 3) raw sample voxel coordinates
+        :param int chunk_size: The number of points per chunk
+        :param int n_processes: The number of processes to use
+        :return: (N, 3) atlas voxel coordinates
+        :rtype: np.ndarray
+        """
+        chunks = (points[start:start + chunk_size] for start in range(0, len(points), chunk_size))
+        transformed = list(self.transform_chunks(chunks, n_processes))
+        return np.concatenate(transformed) if transformed else np.empty((0, 3))
+
+    def transform_file(self, src_path, dest_path, chunk_size=10**6, n_processes=1):
+        """
+        Stream the points of src_path (see iter_point_chunks) through the transform into dest_path
+        (.npy or .csv) without loading all the points in memory
+
+        :param str src_path: The raw sample voxel coordinates
+        :param str dest_path: Where to save the atlas voxel coordinates
+        :param int chunk_size: The number of points per chunk
+        :param int n_processes: The number of processes to use
+        """
+        chunks = self.transform_chunks(iter_point_chunks(src_path, chunk_size), n_processes)
+        if dest_path.endswith('.npy'):
+            out = np.lib.format.open_memmap(dest_path, mode='w+', dtype=np.float64, shape=(count_points(src_path), 3))
+            start = 0
+            for chunk in chunks:
+                out[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            out.flush()
+        elif dest_path.endswith('.csv'):
+            with open(dest_path, 'w') as out_file:
+                out_file.write('x,y,z\n')
+                for chunk in chunks:
+                    np.savetxt(out_file, chunk, delimiter=',', fmt='%.3f')
+        else:
+            raise NotImplementedError('Could not guess points format for path {}'.format(dest_path))
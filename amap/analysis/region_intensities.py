@@ -0,0 +1,127 @@
+"""
+region_intensities
+==================
+
+A module to measure the signal (count, sum and mean) per atlas region on the raw resolution data.
+The raw planes are streamed from disk by chunks (see amap.brain.brain_io.load_planes) and each plane is reduced to the cells of the registered atlas
+(the downsampled sample grid) before the weighted bincount, so the full resolution label volume
+is never materialised.
+Each process holds one chunk of raw planes at a time, so the raw data in memory is bounded by
+n_processes * max_chunk_bytes (or one plane per process if a plane is larger than max_chunk_bytes).
+"""
+import multiprocessing as mp
+
+import numpy as np
+
+from amap.brain import brain_io as bio
+from amap.utils.parallel import bounded_map
+
+DEFAULT_MAX_PROCESSES = 4  # The task is mostly bound by reading the planes
+DEFAULT_MAX_CHUNK_BYTES = 2**28
+
+
+def get_nearest_cells(sample_space, axis, n_raw, n_cells):
+    """
+    Get the nearest registered atlas cell of each raw sample index along one axis
+    (see amap.brain.sample_space.SampleSpace.nearest_downsampled_indices)
+
+    :param amap.brain.sample_space.SampleSpace sample_space: The geometry of the sample
+    :param int axis: The axis (0 for x, 1 for y)
+    :param int n_raw: The number of raw voxels along the axis
+    :param int n_cells: The number of downsampled voxels along the axis
+    :return: cells, starts (the sorted unique cells reached by the raw voxels and the index of the first raw voxel
+        of each of them)
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    return np.unique(sample_space.nearest_downsampled_indices(axis, n_raw, n_cells), return_index=True)
+
+
+def _planes_statistics(args):
+    """
+    Accumulate the count and sum of the signal per label index for a chunk of raw planes.
+    The raw pixels are first summed per registered atlas cell with np.add.reduceat along x and y.
+    """
+    raw_src_path, start, stop, z_cells, sort_input_file, atlas_path, sample_space, labels_lut, is_compact = args
+    atlas = bio.load_nii(atlas_path, as_array=True)  # memory mapped
+    n_labels = len(labels_lut)
+    counts = np.zeros(n_labels, dtype=np.float64)
+    sums = np.zeros(n_labels, dtype=np.float64)
+    planes = bio.load_planes(raw_src_path, start, stop, sort_input_file=sort_input_file)
+    x_cells, x_starts = get_nearest_cells(sample_space, 0, planes.shape[0], atlas.shape[0])
+    y_cells, y_starts = get_nearest_cells(sample_space, 1, planes.shape[1], atlas.shape[1])
+    cells = np.ix_(x_cells, y_cells)
+    cell_counts = np.outer(np.diff(np.append(x_starts, planes.shape[0])),
+                           np.diff(np.append(y_starts, planes.shape[1]))).ravel()
+    for i, z_cell in enumerate(z_cells):
+        plane = planes[:, :, i]
+        cell_labels = np.asarray(atlas[:, :, z_cell])[cells]
+        if is_compact:
+            label_indices = cell_labels.ravel()
+        else:
+            label_indices = np.searchsorted(labels_lut, cell_labels.ravel())
+        cell_sums = np.add.reduceat(np.add.reduceat(plane, x_starts, axis=0, dtype=np.float64), y_starts, axis=1)
+        counts += np.bincount(label_indices, weights=cell_counts, minlength=n_labels)
+        sums += np.bincount(label_indices, weights=cell_sums.ravel(), minlength=n_labels)
+    return counts, sums
+
+
+def get_chunk_size(raw_src_path, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, sort_input_file=False):
+    """
+    Get the number of raw planes that fit in max_chunk_bytes (at least 1)
+
+    :param str raw_src_path: The raw sample (see amap.brain.brain_io.load_planes)
+    :param int max_chunk_bytes: The maximum size of a chunk of planes in bytes
+    :param bool sort_input_file: If the input is a text file, natural sort the paths
+    :return: The number of planes per chunk
+    :rtype: int
+    """
+    plane_n_bytes = bio.load_planes(raw_src_path, 0, 1, sort_input_file=sort_input_file).nbytes
+    return max(1, int(max_chunk_bytes // plane_n_bytes))
+
+
+def region_intensities(raw_src_path, registered_atlas_path, sample_space, labels_lut, is_compact=False,
+                       sort_input_file=False, chunk_size=None, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                       n_processes=None):
+    """
+    Compute the count, sum and mean of the raw signal of each region of the registered atlas.
+    Chunks of planes are processed in parallel. The raw data in memory is bounded by
+    n_processes * max_chunk_bytes.
+
+    :param str raw_src_path: The raw sample as a folder of tiff planes, a text file listing them, a tiff stack
+        or a nifty file (see amap.brain.brain_io.load_planes)
+    :param str registered_atlas_path: The atlas in sample space (see BrainRegistration.segment)
+    :param amap.brain.sample_space.SampleSpace sample_space: The geometry of the sample
+    :param np.ndarray labels_lut: The sorted region IDs of the atlas (indexed by the atlas values if compact)
+    :param bool is_compact: Whether the registered atlas is compact
+    :param bool sort_input_file: If the input is a text file, natural sort the paths
+    :param int chunk_size: The number of planes per task (defaults to as many as fit in max_chunk_bytes)
+    :param int max_chunk_bytes: The maximum size in bytes of the planes of a task if chunk_size is not given
+    :param int n_processes: The number of processes (defaults to the number of cores - 1,
+        at most DEFAULT_MAX_PROCESSES)
+    :return: A table (structured array) with the region_id, count, sum and mean of the regions with signal
+    :rtype: np.ndarray
+    """
+    if n_processes is None:
+        n_processes = max(1, min(DEFAULT_MAX_PROCESSES, mp.cpu_count() - 1))
+    if chunk_size is None:
+        chunk_size = get_chunk_size(raw_src_path, max_chunk_bytes, sort_input_file)
+    n_planes = bio.get_shape(raw_src_path, sort_input_file)[2]
+    atlas_n_planes = bio.load_nii(registered_atlas_path, as_array=False).shape[2]
+    z_cells = sample_space.nearest_downsampled_indices(2, n_planes, atlas_n_planes)
+    labels_lut = np.asarray(labels_lut)
+    chunks = ((raw_src_path, start, min(start + chunk_size, n_planes), z_cells[start:start + chunk_size],
+               sort_input_file, registered_atlas_path, sample_space, labels_lut, is_compact)
+              for start in range(0, n_planes, chunk_size))
+    counts = np.zeros(len(labels_lut), dtype=np.float64)
+    sums = np.zeros(len(labels_lut), dtype=np.float64)
+    for chunk_counts, chunk_sums in bounded_map(_planes_statistics, chunks, n_processes):
+        counts += chunk_counts
+        sums += chunk_sums
+    label_idx = np.nonzero(counts)[0]
+    table = np.empty(len(label_idx), dtype=[('region_id', labels_lut.dtype), ('count', np.int64),
+                                            ('sum', np.float64), ('mean', np.float64)])
+    table['region_id'] = labels_lut[label_idx]
+    table['count'] = np.round(counts[label_idx])
+    table['sum'] = sums[label_idx]
+    table['mean'] = sums[label_idx] / counts[label_idx]
+    return table
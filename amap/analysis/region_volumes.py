@@ -0,0 +1,181 @@
+"""
+region_volumes
+==============
+
+A module to compute the number of voxels and physical volume of each region of a (registered) atlas
+and to roll them up a region hierarchy.
+The atlas is streamed by slabs of planes so that a whole brain table costs one pass over the file.
+"""
+import numpy as np
+
+from amap.brain import brain_io as bio
+
+
+class RegionHierarchyError(Exception):
+    pass
+
+
+def _merge_counts(labels, counts, new_labels, new_counts):
+    merged_labels = np.union1d(labels, new_labels)
+    merged_counts = np.zeros(merged_labels.shape, dtype=np.int64)
+    merged_counts[np.searchsorted(merged_labels, labels)] += counts
+    merged_counts[np.searchsorted(merged_labels, new_labels)] += new_counts
+    return merged_labels, merged_counts
+
+
+def count_region_voxels(atlas_path, slab_size=32):
+    """
+    Count the voxels of each label of the atlas, reading it by slabs of planes.
+    Small integer labels (e.g. compact atlases) are counted with np.bincount directly,
+    sparse labels are first compacted per slab.
+
+    :param str atlas_path: The path to the atlas image or the atlas itself as an array (possibly memory mapped)
+    :param int slab_size: The number of planes to read at once
+    :return: labels, counts (the sorted labels present in the atlas and their number of voxels)
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    if isinstance(atlas_path, np.ndarray):
+        atlas_data = atlas_path
+        dtype = atlas_data.dtype
+    else:
+        atlas_img = bio.load_nii(atlas_path, as_array=False)
+        atlas_data = atlas_img.dataobj
+        dtype = atlas_img.get_data_dtype()
+    n_planes = atlas_data.shape[2]
+    small_labels = np.issubdtype(dtype, np.unsignedinteger) and np.iinfo(dtype).max < 2**16
+    labels = np.empty(0, dtype=dtype)
+    counts = np.empty(0, dtype=np.int64)
+    bincounts = np.zeros(0, dtype=np.int64)
+    for start in range(0, n_planes, slab_size):
+        slab = np.asarray(atlas_data[:, :, start:start + slab_size])
+        if small_labels:
+            slab_counts = np.bincount(slab.ravel())
+            if slab_counts.size > bincounts.size:
+                bincounts = np.pad(bincounts, (0, slab_counts.size - bincounts.size), mode='constant')
+            bincounts[:slab_counts.size] += slab_counts
+        else:
+            slab_labels, inverse = np.unique(slab, return_inverse=True)
+            labels, counts = _merge_counts(labels, counts, slab_labels, np.bincount(inverse.ravel()))
+    if small_labels:
+        labels = np.nonzero(bincounts)[0].astype(dtype)
+        counts = bincounts[labels]
+    return labels, counts
+
+
+def get_voxel_volume(atlas_path):
+    """
+    The volume of a voxel of the image from the zooms of its header
+
+    :param str atlas_path: The path to the image
+    :return: The voxel volume (mm3 for NIfTI images in mm)
+    :rtype: float
+    """
+    return float(np.prod(bio.load_nii(atlas_path, as_array=False).header.get_zooms()[:3]))
+
+
+def load_hierarchy(hierarchy_path, id_column='id', parent_column='parent_structure_id'):
+    """
+    Load a region hierarchy from a csv file with one row per region (e.g. the Allen structures.csv)
+
+    :param str hierarchy_path: The path of the csv file
+    :param str id_column: The name of the column of the region IDs
+    :param str parent_column: The name of the column of the parent region IDs (empty for the root)
+    :return: region_ids, parent_ids (with -1 for the root)
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    hierarchy = np.genfromtxt(hierarchy_path, delimiter=',', names=True, dtype=None, encoding='utf-8',
+                              usecols=(id_column, parent_column), filling_values=-1)
+    return hierarchy[id_column].astype(np.int64), hierarchy[parent_column].astype(np.int64)
+
+
+def build_parent_index(region_ids, parent_ids):
+    """
+    Precompute the index of the parent of each region and the depth of each region in the hierarchy
+
+    :param np.ndarray region_ids: The IDs of the regions
+    :param np.ndarray parent_ids: The ID of the parent of each region (-1 or any unknown ID for roots)
+    :return: parent_idx, depth (parent_idx is -1 for the roots)
+    :rtype: (np.ndarray, np.ndarray)
+    :raises RegionHierarchyError: If the hierarchy has a cycle
+    """
+    region_ids = np.asarray(region_ids, dtype=np.int64)
+    parent_ids = np.asarray(parent_ids, dtype=np.int64)
+    order = np.argsort(region_ids)
+    positions = np.clip(np.searchsorted(region_ids, parent_ids, sorter=order), 0, len(region_ids) - 1)
+    parent_idx = order[positions]
+    parent_idx[region_ids[parent_idx] != parent_ids] = -1
+    depth = np.zeros(len(region_ids), dtype=np.int64)
+    ancestor = parent_idx.copy()
+    for _ in range(len(region_ids)):
+        has_ancestor = ancestor >= 0
+        if not has_ancestor.any():
+            break
+        depth[has_ancestor] += 1
+        ancestor[has_ancestor] = parent_idx[ancestor[has_ancestor]]
+    else:
+        raise RegionHierarchyError('The region hierarchy has a cycle')
+    return parent_idx, depth
+
+
+def rollup(values, parent_idx, depth):
+    """
+    Sum the values of each region with the values of all its descendants
+
+    :param np.ndarray values: The values of each region
+    :param np.ndarray parent_idx: See build_parent_index
+    :param np.ndarray depth: See build_parent_index
+    :return: The totals of each region
+    :rtype: np.ndarray
+    """
+    totals = np.array(values, copy=True)
+    max_depth = int(depth.max()) if depth.size else 0
+    for level in range(max_depth, 0, -1):
+        nodes = np.nonzero(depth == level)[0]
+        np.add.at(totals, parent_idx[nodes], totals[nodes])
+    return totals
+
+
+def region_volumes(atlas_path, hierarchy=None, labels_lut=None, slab_size=32, voxel_volume=None):
+    """
+    Compute the table of the number of voxels and volume of each region of the atlas.
+    If a hierarchy is given, all its regions are listed and the totals include the descendants.
+
+    :param str atlas_path: The path to the (registered) atlas or the atlas itself as an array
+    :param tuple hierarchy: region_ids, parent_ids (see load_hierarchy)
+    :param np.ndarray labels_lut: If the atlas is compact, the lookup table to the region IDs
+    :param int slab_size: The number of planes to read at once
+    :param float voxel_volume: The volume of a voxel (see get_voxel_volume by default).
+        Required if the atlas is given as an array.
+    :return: A table (structured array) with the region_id, voxel_count, volume, total_voxel_count and total_volume
+    :rtype: np.ndarray
+    """
+    labels, counts = count_region_voxels(atlas_path, slab_size)
+    if labels_lut is not None:
+        labels = np.asarray(labels_lut)[labels]
+    labels = labels.astype(np.int64)
+    if voxel_volume is None:
+        if isinstance(atlas_path, np.ndarray):
+            raise ValueError('The voxel volume is required to compute the region volumes of an array')
+        voxel_volume = get_voxel_volume(atlas_path)
+    if hierarchy is not None:
+        hierarchy_ids, parent_ids = hierarchy
+        hierarchy_ids = np.asarray(hierarchy_ids, dtype=np.int64)
+        outside_hierarchy = np.setdiff1d(labels, hierarchy_ids)  # e.g. background
+        region_ids = np.concatenate((hierarchy_ids, outside_hierarchy))
+        parent_idx, depth = build_parent_index(region_ids, np.concatenate((parent_ids,
+                                                                           np.full(len(outside_hierarchy), -1))))
+        voxel_counts = np.zeros(len(region_ids), dtype=np.int64)
+        order = np.argsort(region_ids)
+        voxel_counts[order[np.searchsorted(region_ids, labels, sorter=order)]] = counts
+        total_voxel_counts = rollup(voxel_counts, parent_idx, depth)
+    else:
+        region_ids, voxel_counts, total_voxel_counts = labels, counts, counts
+    table = np.empty(len(region_ids), dtype=[('region_id', np.int64), ('voxel_count', np.int64),
+                                             ('volume', np.float64), ('total_voxel_count', np.int64),
+                                             ('total_volume', np.float64)])
+    table['region_id'] = region_ids
+    table['voxel_count'] = voxel_counts
+    table['volume'] = voxel_counts * voxel_volume
+    table['total_voxel_count'] = total_voxel_counts
+    table['total_volume'] = total_voxel_counts * voxel_volume
+    return table
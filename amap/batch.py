@@ -0,0 +1,280 @@
+"""
+batch
+=====
+
+A module to register many samples listed in a manifest in one invocation.
+Each sample goes through the stages of amap.main (preprocessing, affine registration,
+freeform registration and segmentation) and a scheduler runs the stages of the different samples
+concurrently within a CPU core and memory budget. The stages of the samples further down the pipeline
+are started first, so that the cheap, I/O bound preprocessing of the next samples overlaps with the
+NiftyReg stages of the previous ones, and the number of concurrent reg_f3d jobs is capped.
+"""
+import os
+import csv
+import sys
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import psutil
+
+from amap import main as amap_main
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'y')
+
+
+class BatchError(Exception):
+    pass
+
+
+class Stage(object):
+    """
+    A step of the processing of each sample and the resources it needs
+    """
+    def __init__(self, name, func, n_cores=1, memory_gb=1.0, max_concurrent=None, use_process=False):
+        """
+
+        :param str name: The name of the stage
+        :param func: The function to run, it receives the arguments of the sample
+        :param int n_cores: The number of cores used by the stage
+        :param float memory_gb: The peak memory used by the stage in GB
+        :param int max_concurrent: The maximum number of jobs of this stage running at the same time (None for no cap)
+        :param bool use_process: Whether to run the stage in a separate process (for python bound stages)
+            rather than a thread (for stages spending their time in subprocesses)
+        """
+        self.name = name
+        self.func = func
+        self.n_cores = n_cores
+        self.memory_gb = memory_gb
+        self.max_concurrent = max_concurrent
+        self.use_process = use_process
+
+
+class BatchScheduler(object):
+    """
+    Run the stages of each sample in order, interleaving the samples within the resources budget.
+    When a stage of a sample fails, the following stages of that sample are skipped but the other
+    samples carry on.
+    """
+    def __init__(self, stages, max_cores=None, max_memory_gb=None, poll_interval=0.1):
+        """
+
+        :param list stages: The Stage objects in the order they must run for each sample
+        :param int max_cores: The core budget (defaults to the number of cores of the machine)
+        :param float max_memory_gb: The memory budget in GB (defaults to the available memory)
+        :param float poll_interval: The maximum time between two scheduling decisions in seconds
+        """
+        self.stages = stages
+        self.max_cores = max_cores if max_cores is not None else psutil.cpu_count()
+        if max_memory_gb is None:
+            max_memory_gb = psutil.virtual_memory().available / 1024**3
+        self.max_memory_gb = max_memory_gb
+        self.poll_interval = poll_interval
+
+    def _fits(self, stage, used_cores, used_memory_gb, n_running_per_stage, n_running):
+        if stage.max_concurrent is not None and n_running_per_stage[stage.name] >= stage.max_concurrent:
+            return False
+        if n_running == 0:  # Always allow a job to run alone, even if it exceeds the budget
+            return True
+        return (used_cores + stage.n_cores <= self.max_cores and
+                used_memory_gb + stage.memory_gb <= self.max_memory_gb)
+
+    def run(self, samples):
+        """
+        Process all the samples
+
+        :param list samples: The arguments of each sample (passed to the stage functions)
+        :return: The error of each failed sample (None for the samples that completed)
+        :rtype: list
+        """
+        next_stage_idx = [0] * len(samples)
+        errors = [None] * len(samples)
+        running = {}
+        n_running_per_stage = {stage.name: 0 for stage in self.stages}
+        used_cores, used_memory_gb = 0, 0.0
+        thread_pool = ThreadPoolExecutor(max_workers=max(1, self.max_cores))
+        process_pool = None
+        try:
+            while True:
+                busy_samples = set(sample_idx for sample_idx, _ in running.values())
+                # Later stages first so that samples leave the pipeline as early as possible
+                candidates = sorted((i for i in range(len(samples)) if i not in busy_samples and
+                                     errors[i] is None and next_stage_idx[i] < len(self.stages)),
+                                    key=lambda i: (-next_stage_idx[i], i))
+                for sample_idx in candidates:
+                    stage = self.stages[next_stage_idx[sample_idx]]
+                    if not self._fits(stage, used_cores, used_memory_gb, n_running_per_stage, len(running)):
+                        continue
+                    if stage.use_process:
+                        if process_pool is None:
+                            process_pool = ProcessPoolExecutor(max_workers=max(1, self.max_cores))
+                        future = process_pool.submit(stage.func, samples[sample_idx])
+                    else:
+                        future = thread_pool.submit(stage.func, samples[sample_idx])
+                    running[future] = (sample_idx, stage)
+                    n_running_per_stage[stage.name] += 1
+                    used_cores += stage.n_cores
+                    used_memory_gb += stage.memory_gb
+                if not running:
+                    break
+                done, _ = wait(list(running.keys()), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sample_idx, stage = running.pop(future)
+                    n_running_per_stage[stage.name] -= 1
+                    used_cores -= stage.n_cores
+                    used_memory_gb -= stage.memory_gb
+                    error = future.exception()
+                    if error is not None:
+                        errors[sample_idx] = BatchError('Stage {} failed: {}'.format(stage.name, error))
+                    else:
+                        next_stage_idx[sample_idx] += 1
+        finally:
+            thread_pool.shutdown()
+            if process_pool is not None:
+                process_pool.shutdown()
+        return errors
+
+
+def _str_to_bool(value):
+    return value.strip().lower() in TRUE_STRINGS
+
+
+def read_manifest(manifest_path, common_args=()):
+    """
+    Read the manifest of the samples to process. It is a csv file with a header and one sample per row.
+    The columns target_brain_path, sample_name and output_folder are required, any other column
+    is the destination name of an option of amap (e.g. x_pixel_mm, orientation or flip_x)
+    and overrides the common arguments for that sample. Empty cells keep the common value.
+
+    :param str manifest_path: The path to the csv file
+    :param common_args: The options of amap common to all samples (e.g. ['-p', '-r'])
+    :return: The parsed arguments of each sample
+    :rtype: list
+    """
+    parser = amap_main.get_parser()
+    actions = {action.dest: action for action in parser._actions}
+    samples = []
+    with open(manifest_path, 'r', newline='') as manifest_file:
+        for row in csv.DictReader(manifest_file):
+            row = {key.strip(): value.strip() for key, value in row.items() if key is not None}
+            try:
+                sample_args = parser.parse_args([row.pop('target_brain_path'), row.pop('sample_name'),
+                                                 row.pop('output_folder')] + list(common_args))
+            except KeyError as err:
+                raise BatchError('Missing column {} in manifest {}'.format(err, manifest_path))
+            for dest, value in row.items():
+                if value == '':
+                    continue
+                if dest not in actions:
+                    raise BatchError('Unknown column {} in manifest {}'.format(dest, manifest_path))
+                action = actions[dest]
+                if action.const is True and action.nargs == 0:  # store_true
+                    value = _str_to_bool(value)
+                elif action.nargs not in (None, '?'):
+                    value = [action.type(v) if action.type is not None else v for v in value.split()]
+                elif action.type is not None:
+                    value = action.type(value)
+                setattr(sample_args, dest, value)
+            samples.append(sample_args)
+    return samples
+
+
+def get_stages(registration_cores=4, preprocessing_memory_gb=8.0, registration_memory_gb=8.0,
+               max_concurrent_freeform=1):
+    """
+    The stages of amap.main with their resources
+
+    :param int registration_cores: The number of threads of each NiftyReg job
+    :param float preprocessing_memory_gb: The peak memory of the preprocessing of a sample
+    :param float registration_memory_gb: The peak memory of a NiftyReg job
+    :param int max_concurrent_freeform: The maximum number of concurrent reg_f3d jobs
+    :return: The stages
+    :rtype: list
+    """
+    return [
+        Stage('preprocess', run_preprocessing_stage, n_cores=1, memory_gb=preprocessing_memory_gb,
+              use_process=True),
+        Stage('affine', run_affine_stage, n_cores=registration_cores, memory_gb=registration_memory_gb),
+        Stage('freeform', run_freeform_stage, n_cores=registration_cores, memory_gb=registration_memory_gb,
+              max_concurrent=max_concurrent_freeform),
+        Stage('segment', run_segmentation_stage, n_cores=registration_cores, memory_gb=registration_memory_gb)
+    ]
+
+
+def run_pipeline_step(_args, step_name):
+    """
+    Run one step of the pipeline of the sample (see amap.main.get_pipeline) if it was selected by its arguments,
+    honouring --resume and --force-from
+
+    :param argparse.Namespace _args: The arguments of the sample
+    :param str step_name:
+    """
+    amap_main.get_pipeline(_args).run(resume=_args.resume, force_from=_args.force_from, only=(step_name,))
+
+
+def run_preprocessing_stage(_args):
+    if not os.path.exists(_args.output_folder):
+        os.makedirs(_args.output_folder)
+    run_pipeline_step(_args, 'preprocess')
+
+
+def run_affine_stage(_args):
+    run_pipeline_step(_args, 'affine')
+
+
+def run_freeform_stage(_args):
+    run_pipeline_step(_args, 'freeform')
+
+
+def run_segmentation_stage(_args):
+    run_pipeline_step(_args, 'segment')
+
+
+def get_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='Register the atlas to all the samples of a manifest. The options after '
+                                        '"--" are passed to amap for every sample (e.g. -- -p -r --left-right).')
+    parser.add_argument('manifest_path', metavar='manifest-path', type=str,
+                        help='The csv file listing the samples (columns target_brain_path, sample_name, '
+                             'output_folder and optionally any amap option destination, e.g. x_pixel_mm)')
+    parser.add_argument('--max-cores', dest='max_cores', type=int, default=psutil.cpu_count(),
+                        help='The maximum number of cores used at the same time')
+    parser.add_argument('--max-memory-gb', dest='max_memory_gb', type=float,
+                        default=psutil.virtual_memory().total / 1024**3 * 0.9,
+                        help='The maximum memory used at the same time in GB')
+    parser.add_argument('--registration-cores', dest='registration_cores', type=int, default=4,
+                        help='The number of threads of each NiftyReg job (sets OMP_NUM_THREADS)')
+    parser.add_argument('--preprocessing-memory-gb', dest='preprocessing_memory_gb', type=float, default=8.0,
+                        help='The estimated peak memory of the preprocessing of a sample in GB')
+    parser.add_argument('--registration-memory-gb', dest='registration_memory_gb', type=float, default=8.0,
+                        help='The estimated peak memory of a NiftyReg job in GB')
+    parser.add_argument('--max-concurrent-freeform', dest='max_concurrent_freeform', type=int, default=1,
+                        help='The maximum number of concurrent freeform registrations (reg_f3d)')
+    return parser
+
+
+def main():
+    argv = sys.argv[1:]
+    common_args = []
+    if '--' in argv:
+        common_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = get_parser().parse_args(argv)
+    os.environ['OMP_NUM_THREADS'] = str(args.registration_cores)  # Inherited by the NiftyReg processes
+
+    samples = read_manifest(args.manifest_path, common_args)
+    scheduler = BatchScheduler(get_stages(args.registration_cores, args.preprocessing_memory_gb,
+                                          args.registration_memory_gb, args.max_concurrent_freeform),
+                               max_cores=args.max_cores, max_memory_gb=args.max_memory_gb)
+    start = time.time()
+    errors = scheduler.run(samples)
+    print("Processed {} samples in {:.0f}s".format(len(samples), time.time() - start))
+    for sample_args, error in zip(samples, errors):
+        if error is not None:
+            print("Sample {} failed: {}".format(sample_args.sample_name, error), file=sys.stderr)
+    if any(error is not None for error in errors):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
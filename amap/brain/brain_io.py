@@ -18,6 +18,9 @@ import tifffile
 from tqdm import tqdm
 from natsort import natsorted
 
+from amap.utils import hooks
+from amap.utils.instrumentation import instrumented, stage
+
 import warnings
 with warnings.catch_warnings():
     warnings.simplefilter('ignore')
@@ -46,6 +49,7 @@ def check_mem(img_byte_size, n_imgs):
                                    'Needed {}, only {} available.'.format(total_size, free_mem))
 
 
+@instrumented('scale_z')
 def scale_z(volume, scaling_factor, verbose=False):
     """
     Scale the given brain allong the z dimension
@@ -65,6 +69,7 @@ def scale_z(volume, scaling_factor, verbose=False):
 
 
 # ######################## INPUT METHODS ####################
+@instrumented('load')
 def load_any(src_path, x_scaling_factor=1.0, y_scaling_factor=1.0, z_scaling_factor=1.0,
              load_parallel=False, sort_input_file=False, verbose=False):
     """
@@ -133,6 +138,79 @@ def load_nii(src_path, as_array=False):
         return nii_img
 
 
+def get_plane_paths(src_path, name_filter='.tif', sort=False):
+    """
+    Get the ordered list of the paths of the planes of a brain stored as a sequence of 2D images
+
+    :param str src_path: A folder of images or a text file containing an ordered list of paths (one per line)
+    :param str name_filter: For a folder, will have to be present in the file names for them\
+    to be considered part of the sample
+    :param bool sort: For a text file, if set to true will perform a natural sort of the file paths in the list
+    :return: The paths of the planes
+    :rtype: list
+    """
+    if os.path.isdir(src_path):
+        return [os.path.join(src_path, fname) for fname in sorted(os.listdir(src_path)) if name_filter in fname]
+    elif src_path.endswith('.txt'):
+        with open(src_path, 'r') as in_file:
+            paths = [p.strip() for p in in_file.readlines()]
+        paths = [p for p in paths if p]
+        if sort:
+            paths = natsorted(paths)
+        return paths
+    else:
+        raise NotImplementedError('Could not get the planes of path {}'.format(src_path))
+
+
+def load_planes(src_path, start, stop, sort_input_file=False):
+    """
+    Load the planes start to stop (along the last axis, as loaded by load_any) of a brain without scaling.
+    Only these planes are read for sequences of planes, nifty files and uncompressed tiff stacks.
+
+    :param str src_path: Can be the path of a nifty file, tiff file, tiff files folder or text file containing a list of paths
+    :param int start: The first plane
+    :param int stop: The end of the range of planes
+    :param bool sort_input_file: If set to true and the input is a filepaths file, it will be naturally sorted
+    :return: The planes
+    :rtype: np.ndarray
+    """
+    if os.path.isdir(src_path) or src_path.endswith('.txt'):
+        return load_from_paths_sequence(get_plane_paths(src_path, sort=sort_input_file)[start:stop])
+    elif src_path.endswith('.tif'):
+        try:
+            stack = tifffile.memmap(src_path, mode='r')
+        except ValueError:  # Compressed or not contiguous
+            stack = load_img_stack(src_path)
+        return np.asarray(stack[:, :, start:stop])
+    elif src_path.endswith(('.nii', '.nii.gz')):
+        return np.asarray(load_nii(src_path, as_array=False).dataobj[:, :, start:stop])
+    else:
+        raise NotImplementedError('Could not guess loading method for path {}'.format(src_path))
+
+
+def get_shape(src_path, sort_input_file=False):
+    """
+    Get the shape of a brain without loading its data (only the header of the first plane is read
+    for sequences of planes)
+
+    :param str src_path: Can be the path of a nifty file, tiff file, tiff files folder or text file containing a list of paths
+    :param bool sort_input_file: If set to true and the input is a filepaths file, it will be naturally sorted
+    :return: The shape of the brain as loaded by load_any without scaling
+    :rtype: tuple
+    """
+    if os.path.isdir(src_path) or src_path.endswith('.txt'):
+        paths = get_plane_paths(src_path, sort=sort_input_file)
+        with tifffile.TiffFile(paths[0]) as first_plane:
+            return tuple(first_plane.pages[0].shape) + (len(paths),)
+    elif src_path.endswith('.tif'):
+        with tifffile.TiffFile(src_path) as stack:
+            return tuple(stack.series[0].shape)
+    elif src_path.endswith(('.nii', '.nii.gz')):
+        return tuple(load_nii(src_path, as_array=False).shape)
+    else:
+        raise NotImplementedError('Could not guess loading method for path {}'.format(src_path))
+
+
 def load_from_folder(src_folder, x_scaling_factor, y_scaling_factor, name_filter='', load_parallel=False):
     """
     Load a brain from a folder. All tiff files will be read sorted and assumed to belong to the same sample.
@@ -148,7 +226,7 @@ def load_from_folder(src_folder, x_scaling_factor, y_scaling_factor, name_filter
     :return: The loaded and scaled brain
     :rtype: np.ndarray
     """
-    paths = [os.path.join(src_folder, fname) for fname in sorted(os.listdir(src_folder)) if name_filter in fname]
+    paths = get_plane_paths(src_folder, name_filter=name_filter)
     loading_function = threaded_load_from_sequence if load_parallel else load_from_paths_sequence
     return loading_function(paths, x_scaling_factor, y_scaling_factor)
 
@@ -165,11 +243,7 @@ def load_img_sequence(img_sequence_file_path, x_scaling_factor, y_scaling_factor
     :return: The loaded and scaled brain
     :rtype: np.ndarray
     """
-    with open(img_sequence_file_path, 'r') as in_file:
-        paths = in_file.readlines()
-        paths = [p.strip() for p in paths]
-    if sort:
-        paths = natsorted(paths)
+    paths = get_plane_paths(img_sequence_file_path, sort=sort)
     loading_function = threaded_load_from_sequence if load_parallel else load_from_paths_sequence
     return loading_function(paths, x_scaling_factor, y_scaling_factor)
 
@@ -216,20 +290,64 @@ def load_from_paths_sequence(paths_sequence, x_scaling_factor=1.0, y_scaling_fac
     :rtype: np.ndarray
     """
     for i, p in enumerate(tqdm(paths_sequence, desc='Loading images', unit='plane')):
-        img = tifffile.imread(p)
-        if i == 0:
-            check_mem(img.nbytes * x_scaling_factor * y_scaling_factor, len(paths_sequence))
-            volume = np.empty((int(round(img.shape[0] * x_scaling_factor)),
-                               int(round(img.shape[1] * y_scaling_factor)),  # TEST: add test case for shape rounding
-                               len(paths_sequence)),
-                              dtype=img.dtype)
-        if x_scaling_factor != 1 and y_scaling_factor != 1:
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                img = transform.rescale(img,
-                                        (x_scaling_factor, y_scaling_factor), mode='constant',
-                                        preserve_range=True)
-        volume[:, :, i] = img
+        with hooks.span('load_plane', index=i, path=p) as hook_payload:
+            img = tifffile.imread(p)
+            if hook_payload is not None:
+                hook_payload.update(shape=img.shape, dtype=str(img.dtype), n_bytes=img.nbytes)
+            if i == 0:
+                check_mem(img.nbytes * x_scaling_factor * y_scaling_factor, len(paths_sequence))
+                volume = np.empty((int(round(img.shape[0] * x_scaling_factor)),
+                                   int(round(img.shape[1] * y_scaling_factor)),  # TEST: add test case for shape rounding
+                                   len(paths_sequence)),
+                                  dtype=img.dtype)
+            volume[:, :, i] = scale_plane(img, x_scaling_factor, y_scaling_factor)
+    return volume
+
+
+def scale_plane(img, x_scaling_factor=1.0, y_scaling_factor=1.0):
+    """
+    Scale a plane of a brain as on loading (see load_from_paths_sequence)
+
+    :param np.ndarray img: The plane
+    :param float x_scaling_factor:
+    :param float y_scaling_factor:
+    :return: The scaled plane
+    :rtype: np.ndarray
+    """
+    if x_scaling_factor != 1 and y_scaling_factor != 1:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            img = transform.rescale(img,
+                                    (x_scaling_factor, y_scaling_factor), mode='constant',
+                                    preserve_range=True)
+    return img
+
+
+def scale_volume(volume, x_scaling_factor=1.0, y_scaling_factor=1.0, z_scaling_factor=1.0):
+    """
+    Scale a brain already in memory (e.g. a memory mapped array) as if it was loaded from a sequence of planes
+    with load_any, plane by plane along x and y then along z
+
+    :param np.ndarray volume: The brain at raw resolution
+    :param float x_scaling_factor:
+    :param float y_scaling_factor:
+    :param float z_scaling_factor:
+    :return: The scaled brain, always a new array so that the following (in place) steps never modify
+        the brain of the caller
+    :rtype: np.ndarray
+    """
+    src_volume = volume
+    if x_scaling_factor != 1 and y_scaling_factor != 1:
+        scaled_volume = np.empty((int(round(volume.shape[0] * x_scaling_factor)),
+                                  int(round(volume.shape[1] * y_scaling_factor)),
+                                  volume.shape[2]), dtype=volume.dtype)
+        for i in range(volume.shape[2]):
+            scaled_volume[:, :, i] = scale_plane(np.asarray(volume[:, :, i]), x_scaling_factor, y_scaling_factor)
+        volume = scaled_volume
+    if z_scaling_factor != 1:
+        volume = scale_z(volume, z_scaling_factor)
+    if volume is src_volume:
+        volume = np.array(volume)
     return volume
 
 
@@ -263,13 +381,50 @@ def to_nii(img, dest_path, scale=None, affine_transform=None):  # TODO: see if w
     :param np.ndarray affine_transform: A 4x4 matrix indicating the transform to save in the metadata of the image (required only if not nibabel input)
     :return:
     """
+    with hooks.span('to_nii', path=dest_path) as hook_payload, stage('to_nii', path=dest_path):
+        if hook_payload is not None and isinstance(img, np.ndarray):
+            hook_payload.update(shape=img.shape, dtype=str(img.dtype), n_bytes=img.nbytes)
+        if affine_transform is None:
+            affine_transform = np.eye(4)
+        if not isinstance(img, nib.Nifti1Image):
+            img = nib.Nifti1Image(img, affine_transform)
+        if scale is not None:
+            img.header.set_zooms(scale)
+        nib.save(img, dest_path)
+
+
+def create_nii_memmap(dest_path, shape, dtype, scale=None, affine_transform=None):
+    """
+    Create an uncompressed nifty image on disk and return its data as a writable memory map
+    so that large volumes can be written incrementally (e.g. by slabs of planes).
+    The header is the same as the one written by to_nii.
+
+    :param str dest_path: The path where to save the brain (.nii).
+    :param tuple shape: The shape of the volume
+    :param dtype: The data type of the volume
+    :param tuple scale: A tuple of floats to indicate the 'zooms' of the nifty image
+    :param np.ndarray affine_transform: A 4x4 matrix indicating the transform to save in the metadata of the image
+    :return: The data of the image (in fortran order like nifty)
+    :rtype: np.memmap
+    """
+    if not dest_path.endswith('.nii'):
+        raise ValueError('Path is expected to end in ".nii", got {} instead.'.format(dest_path))
     if affine_transform is None:
         affine_transform = np.eye(4)
-    if not isinstance(img, nib.Nifti1Image):
-        img = nib.Nifti1Image(img, affine_transform)
+    img = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype), affine_transform)
     if scale is not None:
         img.header.set_zooms(scale)
-    nib.save(img, dest_path)
+    img.update_header()  # As done by nib.save
+    header = img.header
+    header.set_data_shape(shape)
+    data_offset = 352  # The header and the empty extension flag of single file nifty images
+    header.set_data_offset(data_offset)
+    data_dtype = header.get_data_dtype()
+    with open(dest_path, 'wb') as out_file:
+        header.write_to(out_file)
+        out_file.write(b'\x00' * (data_offset - out_file.tell()))
+        out_file.truncate(data_offset + int(np.prod(shape)) * data_dtype.itemsize)
+    return np.memmap(dest_path, dtype=data_dtype, mode='r+', offset=data_offset, shape=tuple(shape), order='F')
 
 
 def tiff_to_nii(src_path, dest_path, affine_transform=None):
@@ -11,7 +11,10 @@ from skimage import morphology
 from tqdm import trange
 
 from amap.brain import brain_io as bio
+from amap.brain.sample_space import SampleSpace
 from amap.config.atlas import Atlas
+from amap.utils import hooks
+from amap.utils.instrumentation import instrumented
 
 
 class BrainProcessor(object):
@@ -22,10 +25,12 @@ class BrainProcessor(object):
     - filtering using despeckle and pseudo flatfield
     """
     def __init__(self, target_brain_path, output_folder, x_pix_mm, y_pix_mm, z_pix_mm,
-                 original_orientation='coronal', load_parallel=False, sort_input_file=False):
+                 original_orientation='coronal', load_parallel=False, sort_input_file=False,
+                 atlas_downsampling_factor=1):
         """
 
         :param str target_brain_path: The path to the brain to be processed (image file, paths file or folder)
+            or the brain itself as an array (possibly memory mapped) at raw resolution
         :param str output_folder: The folder where to store the results
         :param float x_pix_mm: The pixel spacing in the x dimension. It is used to scale the brain to the atlas.
         :param float y_pix_mm: The pixel spacing in the x dimension. It is used to scale the brain to the atlas.
@@ -33,19 +38,30 @@ class BrainProcessor(object):
         :param str original_orientation:
         :param bool load_parallel: Load planes in parallel using multiprocessing for faster data loading
         :param bool sort_input_file: If set to true and the input is a filepaths file, it will be naturally sorted
+        :param int atlas_downsampling_factor: The atlas pyramid level to use. The brain is scaled to the pixel
+            size of that level.
         """
         self.target_brain_path = target_brain_path
+        self.sort_input_file = sort_input_file
 
-        self.atlas = Atlas(dest_folder=output_folder)
+        self.atlas = Atlas(dest_folder=output_folder, downsampling_factor=atlas_downsampling_factor)
         atlas_pixel_sizes = self.atlas.pix_sizes
-        x_scaling = x_pix_mm / atlas_pixel_sizes['x']  # FIXME: round to um
-        y_scaling = y_pix_mm / atlas_pixel_sizes['y']
-        z_scaling = z_pix_mm / atlas_pixel_sizes['z']
+        self.x_scaling = x_pix_mm / atlas_pixel_sizes['x']  # FIXME: round to um
+        self.y_scaling = y_pix_mm / atlas_pixel_sizes['y']
+        self.z_scaling = z_pix_mm / atlas_pixel_sizes['z']
 
         self.original_orientation = original_orientation
-
-        self.target_brain = bio.load_any(self.target_brain_path, x_scaling, y_scaling, z_scaling,
-                                         load_parallel=load_parallel, sort_input_file=sort_input_file)
+        self.atlas_flips = (False, False, False)
+
+        if isinstance(self.target_brain_path, np.ndarray):
+            self.raw_shape = self.target_brain_path.shape
+            self.target_brain = bio.scale_volume(self.target_brain_path, self.x_scaling, self.y_scaling,
+                                                 self.z_scaling)
+        else:
+            self.raw_shape = bio.get_shape(self.target_brain_path, self.sort_input_file)
+            self.target_brain = bio.load_any(self.target_brain_path, self.x_scaling, self.y_scaling,
+                                             self.z_scaling, load_parallel=load_parallel,
+                                             sort_input_file=sort_input_file)
         # self.swap_orientation_from_original_to_atlas()
         self.atlas.load_all()
         self.output_folder = output_folder
@@ -61,9 +77,28 @@ class BrainProcessor(object):
                 # print("Flipping axis {}".format('xyz'[axis_idx]))
                 self.target_brain = np.flip(self.target_brain, axis_idx)
 
+    @instrumented('atlas_flip')
     def flip_atlas(self, axes):
         self.atlas.flip(axes)
+        self.atlas_flips = tuple(previous != bool(new) for previous, new in zip(self.atlas_flips, axes))
+
+    def get_sample_space(self, reference_img_path=''):
+        """
+        Get the geometry of the brain relative to the atlas (scaling, orientation and atlas flips)
 
+        :param str reference_img_path: The path where the preprocessed brain used for the registration is saved
+        :return: The sample space
+        :rtype: SampleSpace
+        """
+        # load_any does not scale the x and y axes of image stacks and nifty files
+        scalings = [scaling if downsampled_size != raw_size else 1.0 for scaling, downsampled_size, raw_size
+                    in zip((self.x_scaling, self.y_scaling, self.z_scaling), self.target_brain.shape, self.raw_shape)]
+        return SampleSpace(*scalings, orientation=self.original_orientation,
+                           atlas_flips=self.atlas_flips, downsampled_shape=self.target_brain.shape,
+                           raw_shape=self.raw_shape,
+                           reference_img_path=reference_img_path)
+
+    @instrumented('atlas_reorient')
     def swap_atlas_orientation_to_self(self):
         self.atlas.reorientate_to_sample(self.original_orientation)
 
@@ -105,6 +140,7 @@ class BrainProcessor(object):
         transposition = transpositions[self.original_orientation]
         self.target_brain = np.transpose(self.target_brain, transposition)
 
+    @instrumented('filter')
     def filter(self):
         """
         Applies a set of filters to the brain to avoid overfitting details in the image during
@@ -126,7 +162,8 @@ class BrainProcessor(object):
         """
         brain = brain.astype(np.float64, copy=False)
         for i in trange(brain.shape[-1], desc='filtering', unit='plane'):  # OPTIMISE: could multiprocess but not slow
-            brain[..., i] = filter_plane_for_registration(brain[..., i])  # OPTIMISE: see if in place better
+            with hooks.span('filter_plane', index=i, shape=brain.shape[:-1], n_bytes=brain[..., i].nbytes):
+                brain[..., i] = filter_plane_for_registration(brain[..., i])  # OPTIMISE: see if in place better
         brain = scale_to_16_bits(brain)
         brain = brain.astype(np.uint16, copy=False)
         return brain
@@ -0,0 +1,156 @@
+"""
+sample_space
+============
+
+A module to record how the sample brain was prepared for registration (scaling to the atlas
+resolution and orientation and flips applied to the atlas) so that coordinates can be mapped
+between the raw sample, the downsampled sample and the atlas after the run.
+"""
+import os
+import json
+
+import numpy as np
+
+# The transpositions applied to the atlas to match the sample orientation (see Atlas.reorientate_to_sample)
+ATLAS_TRANSPOSITIONS = {
+    'horizontal': (1, 0, 2),
+    'coronal': (2, 0, 1),
+    'sagittal': (2, 1, 0)
+}
+
+
+def get_sample_space_path(output_folder, sample_name):
+    """
+    Get the path of the sample space file of a sample in the output folder
+
+    :param str output_folder:
+    :param str sample_name:
+    :return: The path
+    :rtype: str
+    """
+    return os.path.join(output_folder, '{}_sample_space.json'.format(sample_name))
+
+
+class SampleSpace(object):
+    """
+    The geometry of a sample relative to the atlas.
+    The sample itself is not reoriented by BrainProcessor, the atlas is transposed and flipped to match it.
+    """
+    def __init__(self, x_scaling, y_scaling, z_scaling, orientation='coronal', atlas_flips=(False, False, False),
+                 downsampled_shape=None, raw_shape=None, reference_img_path=''):
+        """
+
+        :param float x_scaling: The scaling from the raw sample to the downsampled sample along x
+        :param float y_scaling: The scaling from the raw sample to the downsampled sample along y
+        :param float z_scaling: The scaling from the raw sample to the downsampled sample along z
+        :param str orientation: The orientation of the sample (see BrainProcessor)
+        :param tuple atlas_flips: Whether the (reoriented) atlas was flipped along each axis
+        :param tuple downsampled_shape: The shape of the downsampled sample
+        :param tuple raw_shape: The shape of the raw sample
+        :param str reference_img_path: The path of the downsampled (filtered) sample used for the registration
+        """
+        self.scaling = np.array((x_scaling, y_scaling, z_scaling), dtype=np.float64)
+        if orientation not in ATLAS_TRANSPOSITIONS:
+            raise ValueError('Unknown orientation {}, expected one of {}'
+                             .format(orientation, sorted(ATLAS_TRANSPOSITIONS.keys())))
+        self.orientation = orientation
+        self.atlas_flips = tuple(bool(flip) for flip in atlas_flips)
+        self.downsampled_shape = tuple(downsampled_shape) if downsampled_shape is not None else None
+        self.raw_shape = tuple(raw_shape) if raw_shape is not None else None
+        self.reference_img_path = reference_img_path
+
+    @property
+    def atlas_transposition(self):
+        return ATLAS_TRANSPOSITIONS[self.orientation]
+
+    def raw_to_downsampled(self, points):
+        """
+        Convert raw sample voxel coordinates to downsampled sample voxel coordinates.
+        Voxel centres are aligned like in skimage.transform.rescale.
+
+        :param np.ndarray points: (N, 3) raw voxel coordinates
+        :return: (N, 3) downsampled voxel coordinates
+        :rtype: np.ndarray
+        """
+        return (np.asarray(points, dtype=np.float64) + 0.5) * self.scaling - 0.5
+
+    def downsampled_to_raw(self, points):
+        """
+        Convert downsampled sample voxel coordinates to raw sample voxel coordinates
+
+        :param np.ndarray points: (N, 3) downsampled voxel coordinates
+        :return: (N, 3) raw voxel coordinates
+        :rtype: np.ndarray
+        """
+        return (np.asarray(points, dtype=np.float64) + 0.5) / self.scaling - 0.5
+
+    def nearest_downsampled_indices(self, axis, n_raw, n_downsampled):
+        """
+        Get the index of the nearest downsampled voxel of each raw voxel along one axis
+        (i.e. the nearest neighbour upsampling of the downsampled sample)
+
+        :param int axis: The axis (0 for x, 1 for y, 2 for z)
+        :param int n_raw: The number of raw voxels along the axis
+        :param int n_downsampled: The number of downsampled voxels along the axis
+        :return: (n_raw, ) indices
+        :rtype: np.ndarray
+        """
+        indices = np.floor((np.arange(n_raw) + 0.5) * self.scaling[axis]).astype(np.int64)
+        return np.clip(indices, 0, n_downsampled - 1)
+
+    def registered_atlas_to_atlas(self, points, registered_atlas_shape):
+        """
+        Convert voxel coordinates of the atlas as saved for the registration (transposed and flipped to the
+        sample orientation) to voxel coordinates of the atlas in its original orientation
+
+        :param np.ndarray points: (N, 3) voxel coordinates in the reoriented atlas
+        :param tuple registered_atlas_shape: The shape of the reoriented atlas
+        :return: (N, 3) voxel coordinates in the original atlas
+        :rtype: np.ndarray
+        """
+        points = np.array(points, dtype=np.float64)
+        for axis, flip in enumerate(self.atlas_flips):
+            if flip:
+                points[:, axis] = registered_atlas_shape[axis] - 1 - points[:, axis]
+        atlas_points = np.empty_like(points)
+        atlas_points[:, self.atlas_transposition] = points
+        return atlas_points
+
+    def to_dict(self):
+        return {
+            'scaling': self.scaling.tolist(),
+            'orientation': self.orientation,
+            'atlas_flips': list(self.atlas_flips),
+            'downsampled_shape': list(self.downsampled_shape) if self.downsampled_shape is not None else None,
+            'raw_shape': list(self.raw_shape) if self.raw_shape is not None else None,
+            'reference_img_path': self.reference_img_path
+        }
+
+    @classmethod
+    def from_dict(cls, sample_space_dict):
+        return cls(*sample_space_dict['scaling'], orientation=sample_space_dict['orientation'],
+                   atlas_flips=sample_space_dict['atlas_flips'],
+                   downsampled_shape=sample_space_dict['downsampled_shape'],
+                   raw_shape=sample_space_dict['raw_shape'],
+                   reference_img_path=sample_space_dict['reference_img_path'])
+
+    def save(self, dest_path):
+        """
+        Save the sample space as json
+
+        :param str dest_path:
+        """
+        with open(dest_path, 'w') as out_file:
+            json.dump(self.to_dict(), out_file, indent=4)
+
+    @classmethod
+    def load(cls, src_path):
+        """
+        Load a sample space saved with save
+
+        :param str src_path:
+        :return: The sample space
+        :rtype: SampleSpace
+        """
+        with open(src_path, 'r') as in_file:
+            return cls.from_dict(json.load(in_file))
@@ -0,0 +1,92 @@
+"""
+upsampling
+==========
+
+A module to export volumes in the downsampled sample space (e.g. the registered atlas) back to the
+raw acquisition resolution. The output is produced one plane at a time with nearest neighbour
+upsampling and written as a sequence of tiff planes, so the raw resolution volume never has to fit in memory.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+from amap.brain import brain_io as bio
+from amap.config.atlas import expand_labels
+
+
+def upsample_plane(volume, plane_idx, x_indices, y_indices, z_indices, labels_lut=None):
+    """
+    Get a raw resolution plane of a volume in downsampled sample space
+
+    :param np.ndarray volume: The downsampled volume (can be memory mapped)
+    :param int plane_idx: The index of the raw plane
+    :param np.ndarray x_indices: The nearest downsampled index of each raw index along x
+    :param np.ndarray y_indices: The nearest downsampled index of each raw index along y
+    :param np.ndarray z_indices: The nearest downsampled index of each raw index along z
+    :param np.ndarray labels_lut: If the volume is a compact atlas, the lookup table to the region IDs
+    :return: The raw resolution plane
+    :rtype: np.ndarray
+    """
+    plane = np.asarray(volume[:, :, z_indices[plane_idx]])
+    if labels_lut is not None:  # Expand before upsampling as the downsampled plane is much smaller
+        plane = expand_labels(plane, labels_lut)
+    return plane[np.ix_(x_indices, y_indices)]
+
+
+def _write_plane(volume, plane_idx, indices, labels_lut, dest_path):
+    tifffile.imsave(dest_path, upsample_plane(volume, plane_idx, *indices, labels_lut=labels_lut))
+
+
+def export_to_raw_resolution(src_path, dest_folder, sample_space, raw_shape=None, labels_lut=None,
+                             prefix='plane', pad_width=4, n_workers=4, max_planes_in_flight=None):
+    """
+    Export a volume in downsampled sample space (e.g. the registered atlas) to the raw sample resolution
+    as a sequence of tiff planes (see amap.brain.brain_io.to_tiffs for the naming).
+    This undoes the x, y and z scaling of the preprocessing. The registered atlas is already in the sample
+    orientation (the atlas is reoriented and flipped to the sample before the registration), so no
+    transposition is needed.
+    The planes are computed and written by a pool of threads with a bounded number of planes in flight.
+
+    :param str src_path: The path of the downsampled volume (nifty) or the volume itself as an array
+    :param str dest_folder: The folder to write the planes to
+    :param amap.brain.sample_space.SampleSpace sample_space: The geometry of the sample
+    :param tuple raw_shape: The shape of the raw sample (defaults to sample_space.raw_shape)
+    :param np.ndarray labels_lut: If the volume is a compact atlas, the lookup table to the region IDs
+    :param str prefix: The prefix of the name of the planes
+    :param int pad_width: The number of digits on which the index of the planes will be padded
+    :param int n_workers: The number of threads
+    :param int max_planes_in_flight: The maximum number of planes in memory (defaults to 2 * n_workers)
+    :return: The paths of the planes
+    :rtype: list
+    """
+    if raw_shape is None:
+        raw_shape = sample_space.raw_shape
+    if raw_shape is None:
+        raise ValueError('The raw shape is unknown, please specify it')
+    if raw_shape[2] > 10**pad_width:
+        raise ValueError("Not enough padding digits {} for value {}".format(pad_width, raw_shape[2]))
+    if max_planes_in_flight is None:
+        max_planes_in_flight = 2 * n_workers
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+
+    if isinstance(src_path, np.ndarray):
+        volume = src_path
+    else:
+        volume = bio.load_nii(src_path, as_array=True)  # memory mapped
+    indices = [sample_space.nearest_downsampled_indices(axis, raw_shape[axis], volume.shape[axis])
+               for axis in range(3)]
+    dest_paths = [os.path.join(dest_folder, '{}_{}.tif'.format(prefix, str(i).zfill(pad_width)))
+                  for i in range(raw_shape[2])]
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        futures = deque()
+        for plane_idx, dest_path in enumerate(dest_paths):
+            futures.append(executor.submit(_write_plane, volume, plane_idx, indices, labels_lut, dest_path))
+            if len(futures) >= max_planes_in_flight:
+                futures.popleft().result()
+        while futures:
+            futures.popleft().result()
+    return dest_paths
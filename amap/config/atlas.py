@@ -5,31 +5,214 @@ import nibabel as nb
 
 from amap.config.config import config_obj
 import amap.brain.brain_io as bio
+from amap.utils.instrumentation import instrumented
 
-atlas_conf = config_obj['atlas']
+
+def get_atlas_conf():
+    """
+    :return: The atlas section of the config (read on each call so that the config is only loaded when used)
+    :rtype: dict
+    """
+    return config_obj['atlas']
 
 
 class AtlasError(Exception):
     pass
 
 
+def _iter_slabs(n_planes, slab_size):
+    for start in range(0, n_planes, slab_size):
+        yield slice(start, min(start + slab_size, n_planes))
+
+
+def get_labels_lut(labels, slab_size=64):
+    """
+    Get the sorted array of the distinct labels in the volume, processing it in slabs along the last axis
+    (so that memory mapped volumes are not loaded at once)
+
+    :param np.ndarray labels: The label volume
+    :param int slab_size: The number of planes to process at once
+    :return: The sorted distinct labels
+    :rtype: np.ndarray
+    """
+    return np.unique(np.concatenate([np.unique(labels[..., slab]) for slab in _iter_slabs(labels.shape[-1],
+                                                                                          slab_size)]))
+
+
+def compact_labels(labels, slab_size=64):
+    """
+    Convert a volume of sparse label IDs (e.g. the 32 bits Allen structure IDs) into a dense
+    uint16 index volume and a lookup table (lut) such that lut[index_volume] == labels.
+    The volume is processed in slabs along the last axis to avoid the memory overhead of
+    a full np.unique(return_inverse=True) on the whole atlas.
+
+    :param np.ndarray labels: The label volume
+    :param int slab_size: The number of planes to process at once
+    :return: index_volume, lut
+    :rtype: (np.ndarray, np.ndarray)
+    :raises AtlasError: If there are too many distinct labels to fit in uint16
+    """
+    n_planes = labels.shape[-1]
+    lut = get_labels_lut(labels, slab_size)
+    if lut.size > np.iinfo(np.uint16).max + 1:
+        raise AtlasError('Cannot compact atlas, {} distinct labels do not fit in uint16'.format(lut.size))
+    index_volume = np.empty(labels.shape, dtype=np.uint16)
+    for slab in _iter_slabs(n_planes, slab_size):
+        index_volume[..., slab] = np.searchsorted(lut, labels[..., slab])
+    return index_volume, lut
+
+
+HEMISPHERES_SHIFT = 16  # Bits reserved for the compact annotation index in packed labels
+MAX_PACKED_HEMISPHERE = 2**8 - 1  # Keeps packed values below 2**24 so that they are exact as float32 in NiftyReg
+
+
+def pack_labels(annotations, hemispheres, slab_size=64):
+    """
+    Pack the annotations and hemispheres atlases into a single uint32 volume as
+    (hemisphere << HEMISPHERES_SHIFT) | compact annotation index, so that both can be propagated
+    with a single nearest neighbour resampling
+
+    :param np.ndarray annotations: The annotations atlas
+    :param np.ndarray hemispheres: The hemispheres atlas (same shape)
+    :param int slab_size: The number of planes to process at once
+    :return: packed_volume, lut (the lookup table of the annotations, see compact_labels)
+    :rtype: (np.ndarray, np.ndarray)
+    :raises AtlasError: If the volumes cannot be packed
+    """
+    if annotations.shape != hemispheres.shape:
+        raise AtlasError('Cannot pack labels, annotations shape {} and hemispheres shape {} differ'
+                         .format(annotations.shape, hemispheres.shape))
+    index_volume, lut = compact_labels(annotations, slab_size)
+    packed_volume = np.empty(annotations.shape, dtype=np.uint32)
+    for slab in _iter_slabs(annotations.shape[-1], slab_size):
+        hemispheres_slab = np.asarray(hemispheres[..., slab])
+        if hemispheres_slab.min() < 0 or hemispheres_slab.max() > MAX_PACKED_HEMISPHERE:
+            raise AtlasError('Cannot pack labels, hemisphere values must be in [0, {}]'.format(MAX_PACKED_HEMISPHERE))
+        packed_volume[..., slab] = (hemispheres_slab.astype(np.uint32) << HEMISPHERES_SHIFT) | index_volume[..., slab]
+    return packed_volume, lut
+
+
+def unpack_labels(packed_volume, lut, hemispheres_dtype=np.uint8):
+    """
+    Split a volume packed by pack_labels back into the annotations and hemispheres volumes
+
+    :param np.ndarray packed_volume: The packed volume
+    :param np.ndarray lut: The lookup table returned by pack_labels
+    :param hemispheres_dtype: The dtype of the returned hemispheres volume
+    :return: annotations, hemispheres
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    packed_volume = np.asarray(packed_volume).astype(np.uint32, copy=False)
+    index_volume = (packed_volume & (2**HEMISPHERES_SHIFT - 1)).astype(np.uint16)
+    hemispheres = (packed_volume >> HEMISPHERES_SHIFT).astype(hemispheres_dtype)
+    return expand_labels(index_volume, lut), hemispheres
+
+
+def _crop_to_factor(volume, factor):
+    return volume[tuple(slice(0, (size // factor) * factor) for size in volume.shape)]
+
+
+def block_average(volume, factor, slab_size=8):
+    """
+    Downsample the volume by averaging non overlapping blocks of factor**3 voxels.
+    The dimensions that are not a multiple of factor are cropped.
+    Used for the intensity (average brain) volumes of the atlas pyramid.
+
+    :param np.ndarray volume: The volume to downsample
+    :param int factor: The integer downsampling factor
+    :param int slab_size: The number of output planes to compute at once (bounds the memory usage)
+    :return: The downsampled volume (float32)
+    :rtype: np.ndarray
+    """
+    volume = _crop_to_factor(volume, factor)
+    out_shape = tuple(size // factor for size in volume.shape)
+    downsampled = np.empty(out_shape, dtype=np.float32)
+    for slab in _iter_slabs(out_shape[-1], slab_size):
+        src_slab = volume[..., slab.start * factor:slab.stop * factor].astype(np.float32)
+        blocks = src_slab.reshape(out_shape[0], factor, out_shape[1], factor, -1, factor)
+        downsampled[..., slab] = blocks.mean(axis=(1, 3, 5))
+    return downsampled
+
+
+def _block_mode(blocks):
+    """
+    The most frequent value of each row of blocks (the smallest value in case of a tie)
+    """
+    blocks = np.sort(blocks, axis=1)
+    counts = np.empty(blocks.shape, dtype=np.min_scalar_type(blocks.shape[1]))
+    for i in range(blocks.shape[1]):
+        counts[:, i] = (blocks == blocks[:, i:i + 1]).sum(axis=1)
+    return blocks[np.arange(blocks.shape[0]), counts.argmax(axis=1)]
+
+
+def downsample_labels(volume, factor, slab_size=8):
+    """
+    Downsample a label volume so that no new label values are created.
+    The labels are sampled at the centre of each block of factor**3 voxels, like the intensities of
+    block_average, so that both match the affine of the pyramid level. For odd factors the voxel at
+    the centre of the block is kept. For even factors, the centre falls between voxels and the most
+    frequent label of the block is kept instead.
+    The output shape matches block_average for the same factor.
+
+    :param np.ndarray volume: The label volume to downsample
+    :param int factor: The integer downsampling factor
+    :param int slab_size: The number of output planes to compute at once (bounds the memory usage)
+    :return: The downsampled volume (same dtype as the input)
+    :rtype: np.ndarray
+    """
+    volume = _crop_to_factor(volume, factor)
+    if factor % 2:
+        centre = factor // 2
+        return np.ascontiguousarray(volume[centre::factor, centre::factor, centre::factor])
+    out_shape = tuple(size // factor for size in volume.shape)
+    downsampled = np.empty(out_shape, dtype=volume.dtype)
+    for slab in _iter_slabs(out_shape[-1], slab_size):
+        src_slab = np.asarray(volume[..., slab.start * factor:slab.stop * factor])
+        blocks = src_slab.reshape(out_shape[0], factor, out_shape[1], factor, -1, factor)
+        blocks = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(-1, factor ** 3)
+        downsampled[..., slab] = _block_mode(blocks).reshape(out_shape[0], out_shape[1], -1)
+    return downsampled
+
+
+def expand_labels(index_volume, lut):
+    """
+    Convert a compact index volume (see compact_labels) back to the original label IDs
+
+    :param np.ndarray index_volume: The compact (uint16) index volume
+    :param np.ndarray lut: The lookup table from indices to original IDs
+    :return: The volume of original label IDs
+    :rtype: np.ndarray
+    """
+    return lut[index_volume]
+
+
 class Atlas(object):
     """
     A class to handle all the atlas data (including the
     """
-    def __init__(self, dest_folder='', src_folder=''):
+    def __init__(self, dest_folder='', src_folder='', downsampling_factor=1):
+        """
+
+        :param str dest_folder: The folder where to save the atlas (see save_all)
+        :param str src_folder: The folder to load the atlas from (defaults to the config base_folder)
+        :param int downsampling_factor: The level of the atlas pyramid to use as an integer downsampling factor
+            (e.g. 5 to get a 50 um atlas from the 10 um one). The pyramid levels are built on first use
+            and cached on disk (see get_pyramid_path).
+        """
         self.dest_folder = dest_folder
-        if src_folder:  # FIXME: hacky
-            atlas_conf['base_folder'] = src_folder
         self.src_folder = src_folder
+        if int(downsampling_factor) != downsampling_factor or downsampling_factor < 1:
+            raise AtlasError('Downsampling factor must be a positive integer, got {}'.format(downsampling_factor))
+        self.downsampling_factor = int(downsampling_factor)
 
         self._pix_sizes = None  # cached to avoid reloading atlas
 
         self._data = None
         self._brain_data = None
         self._hemispheres_data = None
+        self._labels_lut = None  # Only set if the atlas is in compact form (see compact_labels)
 
-        self.original_orientation = atlas_conf['orientation']
+        self.original_orientation = get_atlas_conf()['orientation']
         if self.original_orientation != 'horizontal':
             raise NotImplementedError('Unknown orientation {}. Only horizontal supported so far'
                                       .format(self.original_orientation))
@@ -48,7 +231,8 @@ class Atlas(object):
             if pixel_sizes != (0, 0, 0):
                 self._pix_sizes = {axis: size for axis, size in zip(('x', 'y', 'z'), pixel_sizes)}
             else:
-                self._pix_sizes = self.get_pixel_sizes_from_config()
+                self._pix_sizes = {axis: size * self.downsampling_factor
+                                   for axis, size in self.get_pixel_sizes_from_config().items()}
         return self._pix_sizes
 
     def get_path(self):
@@ -78,29 +262,154 @@ class Atlas(object):
     def get_mask_path(self):
         return self.get_atlas_element_path_or_default('mask_path')
 
+    def get_mask_cache_folder(self):
+        """
+        Get the folder where the atlas masks are cached (see brain_registration.get_cached_atlas_mask)
+
+        :rtype: str
+        """
+        return os.path.abspath(os.path.normpath(os.path.expanduser(get_atlas_conf()['mask_cache_folder'])))
+
+    def get_labels_lut_path(self):
+        return self.get_atlas_element_path_or_default('labels_lut_path')
+
+    @property
+    def is_compact(self):
+        return self._labels_lut is not None
+
+    @property
+    def labels_lut(self):
+        return self._labels_lut
+
     def get_data(self):
         """
         Load the atlas and return it
 
         :return: The atlas (nifty image)
         """
-        atlas_path = self.get_path()
         if self._data is None:
-            self._data = bio.load_nii(atlas_path)
+            self._data = self._load_element(self.get_path(), is_labels=True)
         return self._data
 
+    def get_brain_data(self):
+        """
+        Load the brain of the atlas (average template) and return it
+
+        :return: The atlas brain (nifty image)
+        """
+        if self._brain_data is None:
+            self._brain_data = self._load_element(self.get_brain_path(), is_labels=False)
+        return self._brain_data
+
+    def get_hemispheres_data(self):
+        """
+        Load the hemispheres of the atlas and return them
+
+        :return: The hemispheres (nifty image)
+        """
+        if self._hemispheres_data is None:
+            self._hemispheres_data = self._load_element(self.get_hemispheres_path(), is_labels=True)
+        return self._hemispheres_data
+
     def load_all(self):
         if self._data is None:
-            self._data = bio.load_nii(self.get_path())
+            self._data = self._load_element(self.get_path(), is_labels=True)
         if self._brain_data is None:
-            self._brain_data = bio.load_nii(self.get_brain_path())
+            self._brain_data = self._load_element(self.get_brain_path(), is_labels=False)
         if self._hemispheres_data is None:
-            self._hemispheres_data = bio.load_nii(self.get_hemispheres_path())
+            self._hemispheres_data = self._load_element(self.get_hemispheres_path(), is_labels=True)
+        if self._labels_lut is None and os.path.exists(self.get_labels_lut_path()):
+            self._labels_lut = np.load(self.get_labels_lut_path())
 
+    @instrumented('atlas_save')
     def save_all(self):
         bio.to_nii(self._data, self.get_dest_path('atlas'))
         bio.to_nii(self._brain_data, self.get_dest_path('brain'))
         bio.to_nii(self._hemispheres_data, self.get_dest_path('hemispheres'))
+        lut_dest_path = self.get_dest_path('labels_lut')
+        if self.is_compact:
+            np.save(lut_dest_path, self._labels_lut)
+        elif os.path.exists(lut_dest_path):  # Avoid a stale lut from a previous run being used with the full atlas
+            os.remove(lut_dest_path)
+
+    def compact_labels(self):
+        """
+        Replace the annotations atlas by a compact uint16 index volume (see compact_labels).
+        The lookup table is kept to expand the IDs on export (see get_region_ids)
+        """
+        if self.is_compact:
+            return
+        atlas = self.get_data()
+        index_volume, self._labels_lut = compact_labels(atlas.get_data())
+        self._data = nb.Nifti1Image(index_volume, atlas.affine, atlas.header)
+        self._data.set_data_dtype(np.uint16)
+
+    def get_region_ids(self, indices):
+        """
+        Get the original region IDs from values of the atlas (compact indices if the atlas is compact)
+
+        :param indices: A scalar or array of atlas values
+        :return: The corresponding region IDs
+        """
+        if self.is_compact:
+            return expand_labels(np.asarray(indices), self._labels_lut)
+        else:
+            return indices
+
+    def get_pyramid_path(self, element_path, downsampling_factor=None):
+        """
+        Get the path of the cached pyramid level of the atlas element at element_path
+
+        :param str element_path: The path of the full resolution atlas element
+        :param int downsampling_factor: The pyramid level (defaults to self.downsampling_factor)
+        :return: The path of the downsampled atlas element
+        :rtype: str
+        """
+        if downsampling_factor is None:
+            downsampling_factor = self.downsampling_factor
+        return os.path.join(os.path.dirname(element_path), 'pyramid', '{}x'.format(downsampling_factor),
+                            os.path.basename(element_path))
+
+    def _load_element(self, element_path, is_labels):
+        if self.downsampling_factor == 1:
+            return bio.load_nii(element_path)
+        pyramid_path = self.get_pyramid_path(element_path)
+        if not os.path.exists(pyramid_path) or os.path.getmtime(pyramid_path) < os.path.getmtime(element_path):
+            self._build_pyramid_level(element_path, pyramid_path, self.downsampling_factor, is_labels)
+        return bio.load_nii(pyramid_path)
+
+    def _build_pyramid_level(self, element_path, pyramid_path, downsampling_factor, is_labels):
+        full_res_img = bio.load_nii(element_path)
+        if is_labels:
+            downsampled = downsample_labels(full_res_img.get_data(), downsampling_factor)
+        else:
+            downsampled = block_average(full_res_img.get_data(), downsampling_factor)
+        pixel_sizes = full_res_img.header.get_zooms()[:3]
+        if pixel_sizes == (0, 0, 0):
+            config_pixel_sizes = self.get_pixel_sizes_from_config()
+            pixel_sizes = tuple(config_pixel_sizes[axis] for axis in ('x', 'y', 'z'))
+        scale = tuple(size * downsampling_factor for size in pixel_sizes)
+        # The new voxels are centred on their block of full resolution voxels
+        block_transform = np.diag([downsampling_factor] * 3 + [1]).astype(np.float64)
+        block_transform[:3, 3] = (downsampling_factor - 1) / 2.
+        affine_transform = full_res_img.affine.dot(block_transform)
+        if not os.path.exists(os.path.dirname(pyramid_path)):
+            os.makedirs(os.path.dirname(pyramid_path), exist_ok=True)
+        tmp_pyramid_path = '{}.{}.tmp.nii'.format(os.path.splitext(pyramid_path)[0], os.getpid())
+        bio.to_nii(downsampled, tmp_pyramid_path, scale=scale, affine_transform=affine_transform)
+        os.replace(tmp_pyramid_path, pyramid_path)  # Atomic so that concurrent jobs never see a partial level
+
+    def build_pyramid(self, downsampling_factors=(2, 5)):
+        """
+        Build (or refresh) the cached pyramid levels of all the atlas elements so that later runs with
+        one of these downsampling factors do not need to process the full resolution atlas.
+
+        :param tuple downsampling_factors: The integer downsampling factors of the levels to build
+        """
+        elements = ((self.get_path(), True), (self.get_brain_path(), False), (self.get_hemispheres_path(), True))
+        for factor in downsampling_factors:
+            for element_path, is_labels in elements:
+                self._build_pyramid_level(element_path, self.get_pyramid_path(element_path, factor), factor, is_labels)
 
     def _flip(self, nii_img, axis_idx):
         return nb.Nifti1Image(np.flip(nii_img.get_data(), axis_idx),  # FIXME: should be just changing the header
@@ -144,7 +453,7 @@ class Atlas(object):
     def get_dest_path(self, atlas_element_name):
         if not self.dest_folder:
             raise AtlasError('Could not get destination path. Missing destination folder information')
-        return os.path.join(self.dest_folder, atlas_conf['default_{}_name'.format(atlas_element_name)])
+        return os.path.join(self.dest_folder, get_atlas_conf()['default_{}_name'.format(atlas_element_name)])
 
     def make_atlas_scale_transformation_matrix(self):
         scale = self.pix_sizes
@@ -165,7 +474,7 @@ class Atlas(object):
         :return: the pixel size dictionary
         :rtype: dict
         """
-        return atlas_conf['pixel_size']
+        return get_atlas_conf()['pixel_size']
 
     def get_atlas_element_path(self, config_entry_name):
         """
@@ -175,7 +484,8 @@ class Atlas(object):
         :return: The path to that atlas element on the filesystem
         :rtype: str
         """
-        atlas_folder_name = os.path.expanduser(atlas_conf['base_folder'])
+        atlas_conf = get_atlas_conf()
+        atlas_folder_name = os.path.expanduser(self.src_folder if self.src_folder else atlas_conf['base_folder'])
         atlas_element_filename = atlas_conf[config_entry_name]
         return os.path.abspath(os.path.normpath(os.path.join(atlas_folder_name, atlas_element_filename)))
 
@@ -188,7 +498,7 @@ class Atlas(object):
         :return: The path to that atlas element on the filesystem
         :rtype: str
         """
-        full_path = atlas_conf[config_entry_name]
+        full_path = get_atlas_conf()[config_entry_name]
         if full_path:
             return os.path.abspath(os.path.normpath(full_path))
         else:
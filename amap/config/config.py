@@ -1,5 +1,5 @@
 import os, sys, platform
-from configobj import ConfigObj
+from collections.abc import MutableMapping
 
 
 class AmapConfigError(Exception):
@@ -23,22 +23,95 @@ config_dirs = [
 config_dirs = [os.path.normpath(d) for d in config_dirs]
 config_paths = [os.path.abspath(os.path.join(d, conf_file_name)) for d in config_dirs]
 
-config_path = None
-for p in config_paths:
-    if not os.path.exists(p):
-        continue
-    else:
-        config_path = p
-        break
 
-if not config_path:
+def find_config_path():
+    """
+    Get the first existing config file in config_paths
+
+    :return: The path of the config file
+    :rtype: str
+    :raises AmapConfigError: If there is no config file
+    """
+    for p in config_paths:
+        if os.path.exists(p):
+            return p
     raise AmapConfigError('Missing config file.\n'
                           ' Tried {}.\n'
                           ' Working directory: {}'.
                           format(config_paths,
                                  os.getcwd()))
-config_obj = ConfigObj(config_path, encoding="UTF8", indent_type='    ', unrepr=True)
-config_obj.reload()
+
+
+def load_config(config_path=None):
+    """
+    Parse the config file
+
+    :param str config_path: The config file (see find_config_path by default)
+    :return: The config
+    :rtype: ConfigObj
+    """
+    from configobj import ConfigObj
+    if config_path is None:
+        config_path = find_config_path()
+    config = ConfigObj(config_path, encoding="UTF8", indent_type='    ', unrepr=True)
+    config.reload()
+    return config
+
+
+class LazyConfig(MutableMapping):
+    """
+    The config of amap, found and parsed on first access rather than on import
+    so that the programs start fast (e.g. for --help) and can be imported without a config file.
+    It behaves like the ConfigObj it wraps.
+    """
+    def __init__(self, config_path=None):
+        """
+
+        :param str config_path: The config file (see find_config_path by default)
+        """
+        self._config_path = config_path
+        self._config = None
+
+    @property
+    def config(self):
+        """
+        :return: The parsed config
+        :rtype: ConfigObj
+        """
+        if self._config is None:
+            self._config = load_config(self._config_path)
+        return self._config
+
+    @property
+    def filename(self):
+        return self.config.filename
+
+    def reload(self):
+        self.config.reload()
+
+    def write(self, *args, **kwargs):
+        return self.config.write(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self.config[key]
+
+    def __setitem__(self, key, value):
+        self.config[key] = value
+
+    def __delitem__(self, key):
+        del self.config[key]
+
+    def __iter__(self):
+        return iter(self.config)
+
+    def __len__(self):
+        return len(self.config)
+
+    def __repr__(self):
+        return 'LazyConfig({})'.format(repr(self._config) if self._config is not None else self._config_path)
+
+
+config_obj = LazyConfig()
 
 __os_folder_names = {
     'Linux': 'linux_x64',
@@ -54,6 +127,18 @@ except KeyError:
 
 
 def get_binary(binaries_folder, program_name):
-    from pkg_resources import resource_filename, Requirement
-    path = "{}/{}/{}".format(binaries_folder, os_folder_name, program_name)
-    return resource_filename(Requirement.parse("amap"), path)
+    """
+    Get the path of a program shipped with amap for the current platform
+
+    :param str binaries_folder: The folder of the binaries starting with the package name (e.g. 'amap/bin/nifty_reg')
+    :param str program_name: e.g. 'reg_aladin'
+    :return: The path
+    :rtype: str
+    """
+    package, _, folder = binaries_folder.partition('/')
+    try:
+        from importlib.resources import files
+    except ImportError:  # Python < 3.9
+        from pkg_resources import resource_filename
+        return resource_filename(package, '/'.join((folder, os_folder_name, program_name)))
+    return str(files(package) / folder / os_folder_name / program_name)
@@ -0,0 +1,278 @@
+"""
+in_memory_pipeline
+==================
+
+A programmatic version of the amap pipeline (see amap.main) for notebooks and services.
+The stages exchange in memory (or memory mapped) arrays rather than files: the sample brain is
+preprocessed in memory, the atlas is reoriented in memory and the transformation computed by NiftyReg
+is propagated to the atlas in python (see amap.registration.deformation) instead of with reg_resample.
+Only the inputs of reg_aladin and reg_f3d (the preprocessed brain, the atlas brain and the optional mask)
+are written to disk, once, in the work folder. There are no prompts::
+
+    with InMemoryPipeline(0.001, 0.001, 0.005, orientation='coronal') as pipeline:
+        pipeline.preprocess(brain)  # A path or an array at raw resolution
+        pipeline.register()
+        registered_atlas = pipeline.propagate()
+        table = pipeline.compute_region_volumes()
+"""
+import os
+import shutil
+import tempfile
+
+from amap.brain import brain_io as bio
+from amap.utils.instrumentation import instrumented
+
+
+class InMemoryPipelineError(Exception):
+    pass
+
+
+class InMemoryPipeline(object):
+    """
+    Register the atlas to a sample brain, passing the volumes between the stages in memory.
+    The stages must be run in order: preprocess, register, propagate and then any of
+    generate_outlines, compute_region_volumes and export_atlas_to_raw_resolution.
+    """
+    def __init__(self, x_pix_mm, y_pix_mm, z_pix_mm, orientation='coronal', flips=(False, False, False),
+                 sample_name='sample', work_folder='', atlas_bounding_box=None, atlas_downsampling_factor=1,
+                 compact_labels=False, n_workers=4):
+        """
+
+        :param float x_pix_mm: The pixel spacing of the raw sample in the x dimension
+        :param float y_pix_mm: The pixel spacing of the raw sample in the y dimension
+        :param float z_pix_mm: The pixel spacing of the raw sample in the z dimension
+        :param str orientation: The orientation of the sample (see BrainProcessor)
+        :param tuple flips: Whether to flip the atlas along each of the x, y and z axes
+        :param str sample_name: The name of the sample used as prefix for the files of NiftyReg
+        :param str work_folder: The folder where the inputs, outputs and logs of NiftyReg are written.
+            A temporary folder, deleted on close, is used if not given.
+        :param tuple atlas_bounding_box: A (start, stop) pair per axis of the (reoriented) atlas to keep
+            for the registration
+        :param int atlas_downsampling_factor: The atlas pyramid level to use (see Atlas)
+        :param bool compact_labels: Propagate the atlas as a compact uint16 index volume (see Atlas.compact_labels)
+        :param int n_workers: The number of threads of the python stages
+        """
+        self.x_pix_mm = x_pix_mm
+        self.y_pix_mm = y_pix_mm
+        self.z_pix_mm = z_pix_mm
+        self.orientation = orientation
+        self.flips = tuple(flips)
+        self.sample_name = sample_name
+        self.atlas_bounding_box = atlas_bounding_box
+        self.atlas_downsampling_factor = atlas_downsampling_factor
+        self.compact_labels = compact_labels
+        self.n_workers = n_workers
+
+        self._is_temporary_work_folder = not work_folder
+        if self._is_temporary_work_folder:
+            work_folder = tempfile.mkdtemp(prefix='amap_')
+        elif not os.path.exists(work_folder):
+            os.makedirs(work_folder)
+        self.work_folder = work_folder
+
+        self.brain_processor = None
+        self.sample_space = None
+        self.brain_registration = None
+        self.deformation = None
+        self.registered_atlas = None  # Compact indices if the atlas is compact (see get_registered_atlas)
+        self.registered_hemispheres = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Delete the work folder if it is temporary
+        """
+        if self._is_temporary_work_folder and os.path.exists(self.work_folder):
+            shutil.rmtree(self.work_folder)
+
+    @property
+    def atlas(self):
+        """
+        The atlas reoriented and flipped to the sample
+
+        :rtype: amap.config.atlas.Atlas
+        """
+        self._check_stage(self.brain_processor, 'preprocess')
+        return self.brain_processor.atlas
+
+    @property
+    def brain(self):
+        """
+        The preprocessed sample brain
+
+        :rtype: np.ndarray
+        """
+        self._check_stage(self.brain_processor, 'preprocess')
+        return self.brain_processor.target_brain
+
+    @property
+    def reference_img_path(self):
+        """
+        The path of the preprocessed brain given to NiftyReg
+
+        :rtype: str
+        """
+        return os.path.join(self.work_folder, '{}_downsampled_filtered.nii'.format(self.sample_name))
+
+    @staticmethod
+    def _check_stage(result, stage_name):
+        if result is None:
+            raise InMemoryPipelineError('The {} stage must be run first'.format(stage_name))
+
+    def preprocess(self, brain, filter_brain=True, load_parallel=False, sort_input_file=False):
+        """
+        Scale the sample brain to the atlas and filter it. Prepare the atlas (reoriented and flipped
+        to the sample, optionally compacted) in memory.
+
+        :param brain: The path to the brain (image file, paths file or folder) or the brain itself as an
+            array (possibly memory mapped) at raw resolution
+        :param bool filter_brain: Filter the brain for the registration (see BrainProcessor.filter).
+            Disable if the brain is already filtered.
+        :param bool load_parallel: Load planes in parallel using multiprocessing for faster data loading
+        :param bool sort_input_file: If set to true and the input is a filepaths file, it will be naturally sorted
+        :return: The preprocessed brain
+        :rtype: np.ndarray
+        """
+        from amap.brain.brain_processor import BrainProcessor
+
+        brain_processor = BrainProcessor(brain, self.work_folder, self.x_pix_mm, self.y_pix_mm, self.z_pix_mm,
+                                         original_orientation=self.orientation, load_parallel=load_parallel,
+                                         sort_input_file=sort_input_file,
+                                         atlas_downsampling_factor=self.atlas_downsampling_factor)
+        brain_processor.swap_atlas_orientation_to_self()
+        brain_processor.flip_atlas(self.flips)
+        if self.compact_labels:
+            brain_processor.atlas.compact_labels()
+        if filter_brain:
+            brain_processor.filter()
+        self.brain_processor = brain_processor
+        self.sample_space = brain_processor.get_sample_space()
+        return brain_processor.target_brain
+
+    def register(self):
+        """
+        Register the atlas brain to the preprocessed brain (affine then freeform) with NiftyReg.
+        The preprocessed brain, the atlas brain and the optional mask are written to the work folder
+        for NiftyReg and the resulting transformation is loaded in memory.
+
+        :return: The transformation from the sample to the atlas space
+        :rtype: amap.registration.deformation.Deformation
+        """
+        from amap.registration.brain_registration import BrainRegistration, make_mask
+        from amap.registration.deformation import Deformation
+
+        self._check_stage(self.brain_processor, 'preprocess')
+        self.brain_processor.save(self.reference_img_path)
+        atlas_brain_path = self.atlas.get_dest_path('brain')
+        bio.to_nii(self.atlas.get_brain_data(), atlas_brain_path)
+
+        brain_registration = BrainRegistration(self.sample_name, self.reference_img_path, self.work_folder)
+        brain_registration.brain_of_atlas_img_path = atlas_brain_path
+        if self.atlas_bounding_box is not None:
+            brain_registration.atlas_mask_path = self.atlas.get_dest_path('mask')
+            make_mask(atlas_brain_path, brain_registration.atlas_mask_path, self.atlas_bounding_box)
+        brain_registration.register_affine()
+        brain_registration.register_freeform()
+        self.brain_registration = brain_registration
+        self.deformation = Deformation.from_files(self.reference_img_path,
+                                                  control_point_file_path=brain_registration.control_point_file_path)
+        return self.deformation
+
+    @instrumented('segment')
+    def propagate(self, hemispheres=False):
+        """
+        Propagate the transformation to the atlas (and optionally the hemispheres) in memory
+        (the equivalent of BrainRegistration.propagate_all).
+        The results are kept in self.registered_atlas and self.registered_hemispheres.
+
+        :param bool hemispheres: Whether to also propagate the hemispheres atlas
+        :return: The registered atlas with the region IDs
+        :rtype: np.ndarray
+        """
+        self._check_stage(self.deformation, 'register')
+        atlas_img = self.atlas.get_data()
+        self.registered_atlas = self.deformation.warp(atlas_img.get_data(), atlas_img.affine,
+                                                      interpolation_order=0, n_workers=self.n_workers)
+        if hemispheres:
+            hemispheres_img = self.atlas.get_hemispheres_data()
+            self.registered_hemispheres = self.deformation.warp(hemispheres_img.get_data(), hemispheres_img.affine,
+                                                                interpolation_order=0, n_workers=self.n_workers)
+        return self.get_registered_atlas()
+
+    def get_registered_atlas(self):
+        """
+        :return: The registered atlas with the region IDs (expanded if the atlas is compact)
+        :rtype: np.ndarray
+        """
+        self._check_stage(self.registered_atlas, 'propagate')
+        return self.atlas.get_region_ids(self.registered_atlas)
+
+    @instrumented('outlines')
+    def generate_outlines(self, mask_only=False, slab_size=32):
+        """
+        Compute the outlines of the regions of the registered atlas (see outline_volume)
+
+        :param bool mask_only: Only return the mask of the outlines (as uint8) rather than the region IDs
+        :param int slab_size: The number of planes per slab
+        :return: The outlines
+        :rtype: np.ndarray
+        """
+        from amap.registration.brain_registration import outline_volume
+
+        self._check_stage(self.registered_atlas, 'propagate')
+        return outline_volume(self.registered_atlas, labels_lut=self.atlas.labels_lut, mask_only=mask_only,
+                              slab_size=slab_size, n_workers=self.n_workers)
+
+    @instrumented('region_volumes')
+    def compute_region_volumes(self, hierarchy_path=''):
+        """
+        Compute the number of voxels and volume of each region of the registered atlas
+        (see amap.analysis.region_volumes)
+
+        :param str hierarchy_path: The optional csv file of the region hierarchy to roll the volumes up
+        :return: The table
+        :rtype: np.ndarray
+        """
+        from amap.analysis.region_volumes import load_hierarchy, region_volumes
+
+        self._check_stage(self.registered_atlas, 'propagate')
+        hierarchy = load_hierarchy(hierarchy_path) if hierarchy_path else None
+        pix_sizes = self.atlas.pix_sizes  # The scale of the preprocessed brain
+        return region_volumes(self.registered_atlas, hierarchy=hierarchy, labels_lut=self.atlas.labels_lut,
+                              voxel_volume=float(pix_sizes['x'] * pix_sizes['y'] * pix_sizes['z']))
+
+    @instrumented('raw_resolution_export')
+    def export_atlas_to_raw_resolution(self, dest_folder, raw_shape=None):
+        """
+        Export the registered atlas at the raw sample resolution as a sequence of tiff planes
+        (see amap.brain.upsampling.export_to_raw_resolution)
+
+        :param str dest_folder: The folder to write the planes to
+        :param tuple raw_shape: The shape of the raw sample (defaults to the shape of the sample brain)
+        :return: The paths of the planes
+        :rtype: list
+        """
+        from amap.brain.upsampling import export_to_raw_resolution
+
+        self._check_stage(self.registered_atlas, 'propagate')
+        return export_to_raw_resolution(self.registered_atlas, dest_folder, self.sample_space, raw_shape=raw_shape,
+                                        labels_lut=self.atlas.labels_lut, n_workers=self.n_workers)
+
+    def run(self, brain, hemispheres=False, filter_brain=True):
+        """
+        Run the preprocessing, registration and propagation stages
+
+        :param brain: The path to the brain or the brain itself as an array at raw resolution (see preprocess)
+        :param bool hemispheres: Whether to also propagate the hemispheres atlas
+        :param bool filter_brain: Filter the brain for the registration
+        :return: The registered atlas with the region IDs
+        :rtype: np.ndarray
+        """
+        self.preprocess(brain, filter_brain=filter_brain)
+        self.register()
+        return self.propagate(hemispheres=hemispheres)
@@ -3,9 +3,13 @@ import sys
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-import numpy as np
-from amap.brain.brain_processor import BrainProcessor  # Warning: required to allow direct or indirect import
-from amap.registration.brain_registration import BrainRegistration  # Warning: required to allow direct or indirect import
+from amap.registration.progress import load_progress, format_summary
+from amap.utils.checkpoint import Step, Pipeline, get_checkpoints_path
+
+# The heavy dependencies (numpy, scipy, skimage, nibabel, psutil...) and the config are imported in the functions
+# that need them so that the CLI starts fast (e.g. for --help) and the arguments are checked first
+
+STEP_NAMES = ('preprocess', 'affine', 'freeform', 'segment')
 
 
 def get_parser():
@@ -66,9 +70,33 @@ def get_parser():
     parser.add_argument('--left-right', dest='left_right', action='store_true',
                         help='Whether to do register the hemispheres (left/right) atlas too to get informations'
                              'about lateralisation.')
+    parser.add_argument('--pack-labels', dest='pack_labels', action='store_true',
+                        help='With --left-right, pack the hemispheres and the annotations into a single volume '
+                             'to propagate them in one pass instead of two. The results are identical.')
+    parser.add_argument('--compact-labels', dest='compact_labels', action='store_true',
+                        help='Store the annotations atlas as a uint16 index volume and a lookup table to the original '
+                             'region IDs. This halves memory and I/O for the label volumes. The IDs are expanded '
+                             'when exporting the registered atlas.')
+    parser.add_argument('--cache-deformation-field', dest='cache_deformation_field', action='store_true',
+                        help='Save the dense deformation field of the freeform registration as a memory mapped '
+                             'float32 array in the output folder to speed up later warps and point transforms. '
+                             'This needs 12 bytes per voxel of the sample brain.')
+    parser.add_argument('--n-propagation-workers', dest='n_propagation_workers', type=int, default=2,
+                        help='The maximum number of propagations of the transformation (atlas, hemispheres) '
+                             'to run concurrently.')
+    parser.add_argument('--region-volumes', dest='region_volumes', nargs='?', const='', default=None,
+                        metavar='HIERARCHY_CSV',
+                        help='Compute the number of voxels and volume of each region of the registered atlas. '
+                             'If the csv file of the region hierarchy (columns id and parent_structure_id) '
+                             'is given, the volumes are also rolled up the hierarchy.')
+    parser.add_argument('--export-raw-resolution-atlas', dest='export_raw_resolution_atlas', action='store_true',
+                        help='Export the registered atlas at the resolution of the raw sample as a sequence of tiff '
+                             'planes. This requires the sample space saved by the preprocessing.')
     parser.add_argument('--generate-outlines', dest='generate_outlines', action='store_true',
                         help='Generate the color boundaries of the mask in the sample reference space. This '
                              'is useful for testing the output.')
+    parser.add_argument('--outlines-mask-only', dest='outlines_mask_only', action='store_true',
+                        help='Only save the mask of the outlines (uint8) rather than the region IDs.')
 
     parser.add_argument('--erase-intermediate-files', dest='erase_intermediate_files', action='store_true',
                         help='Whether the program should erase the intermediate image volumes used by niftyreg after'
@@ -82,10 +110,53 @@ def get_parser():
                         help='The START and END of the range of planes to keep for the registration.'
                              'The planes before START and after END will be masked. It defaults to the whole range'
                              'meaning nothing will be masked.')
+    parser.add_argument('--atlas-mask-bounding-box', dest='atlas_mask_bounding_box', type=int, nargs=6,
+                        metavar=('X_START', 'X_END', 'Y_START', 'Y_END', 'Z_START', 'Z_END'),
+                        help='The 3D bounding box of the atlas to keep for the registration. '
+                             'Everything outside will be masked. Overrides --atlas-mask-planes.')
+    parser.add_argument('--atlas-downsampling-factor', dest='atlas_downsampling_factor', type=int, default=1,
+                        help='Run the whole pipeline against a downsampled level of the atlas pyramid. '
+                             'The value is the integer downsampling factor of the atlas (e.g. 5 to register '
+                             'against a 50um atlas with the default 10um one). This is much faster and useful for '
+                             'quality control or parameter screening. The pyramid levels are cached on disk. '
+                             'The atlas mask planes and bounding box are still expressed in full resolution planes.')
+
+    parser.add_argument('--report', action='store_true',
+                        help='Record the duration, CPU time, bytes read and written and peak memory (including '
+                             'the NiftyReg processes) of each stage and save them as a json report '
+                             'in the output folder.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the steps whose outputs are up to date with their inputs and parameters '
+                             '(as recorded in the checkpoints file of the sample in the output folder).')
+    parser.add_argument('--force-from', dest='force_from', type=str, choices=STEP_NAMES,
+                        help='Rerun this step and all the following ones even if they are up to date. '
+                             'The previous steps are resumed (implies --resume).')
 
     return parser
 
 
+def get_atlas_bounding_box(_args):
+    """
+    Get the bounding box of the atlas to keep for the registration from the mask options,
+    scaled to the atlas pyramid level in use
+
+    :param argparse.Namespace _args:
+    :return: The bounding box as a (start, stop) pair per axis or None if nothing is masked
+    :rtype: tuple
+    """
+    from amap.registration.brain_registration import slab_bounding_box
+    if _args.atlas_mask_bounding_box is not None:
+        bounds = _args.atlas_mask_bounding_box
+        bounding_box = tuple(zip(bounds[::2], bounds[1::2]))
+    elif tuple(_args.atlas_mask_planes) != (0, -1):
+        bounding_box = slab_bounding_box(*_args.atlas_mask_planes)
+    else:
+        return None
+    factor = _args.atlas_downsampling_factor  # Bounds are given at full resolution, negative ones are relative
+    return tuple(tuple(b // factor if b is not None and b > 0 else b for b in axis_bounds)
+                 for axis_bounds in bounding_box)
+
+
 def delete_intermediate_files(_args):
     """
     Deletes temporary file on the drive that are generated by nifty_reg steps but may not be
@@ -97,10 +168,13 @@ def delete_intermediate_files(_args):
     files_to_delete = ('downsampled_filtered.nii',
                        'affine_registered_atlas_brain.nii',
                        'freeform_registered_atlas_brain.nii')
-    for intermediate_file_basename in files_to_delete:
+    optional_files_to_delete = ('packed_atlas.nii',
+                                'registered_packed_atlas.nii')
+    for intermediate_file_basename in files_to_delete + optional_files_to_delete:
         intermediate_file_path = os.path.join(_args.output_folder,
                                               '{}_{}'.format(_args.sample_name, intermediate_file_basename))
-        os.remove(intermediate_file_path)
+        if intermediate_file_basename in files_to_delete or os.path.exists(intermediate_file_path):
+            os.remove(intermediate_file_path)
 
 
 def delete_logs(_args, log_names):
@@ -113,7 +187,8 @@ def delete_logs(_args, log_names):
     """
     for log_name in log_names:
         log_path = os.path.join(_args.output_folder, '{}_{}'.format(_args.sample_name, log_name))
-        os.remove(log_path)
+        if os.path.exists(log_path):  # Some steps are optional
+            os.remove(log_path)
 
 
 def delete_error_logs(_args):
@@ -123,7 +198,7 @@ def delete_error_logs(_args):
     :param _args:
     :return:
     """
-    delete_logs(_args, ('affine.err', 'freeform.err', 'segment.err'))
+    delete_logs(_args, ('affine.err', 'freeform.err', 'segment.err', 'segment_hemispheres.err'))
 
 
 def delete_regular_logs(_args):
@@ -133,7 +208,197 @@ def delete_regular_logs(_args):
     :param _args:
     :return:
     """
-    delete_logs(_args, ('affine.log', 'freeform.log', 'segment.log'))
+    delete_logs(_args, ('affine.log', 'freeform.log', 'segment.log', 'segment_hemispheres.log'))
+
+
+def get_filtered_brain_path(_args):
+    """
+    Get the path of the brain used as reference for the registration (the output of the preprocessing if any)
+
+    :param argparse.Namespace _args:
+    :return: The path
+    :rtype: str
+    """
+    if _args.preprocess:
+        return os.path.join(_args.output_folder, '{}_{}.nii'.format(_args.sample_name, _args.preprocessed_suffix))
+    else:
+        return _args.target_brain_path
+
+
+def get_brain_registration(_args):
+    """
+    Create the BrainRegistration of the sample from the CLI arguments
+
+    :param argparse.Namespace _args:
+    :return: The brain registration
+    :rtype: BrainRegistration
+    """
+    from amap.registration.brain_registration import BrainRegistration
+    return BrainRegistration(_args.sample_name, get_filtered_brain_path(_args), _args.output_folder,
+                             atlas_bounding_box=get_atlas_bounding_box(_args))
+
+
+def run_preprocessing(_args):
+    """
+    Downsample and filter the sample brain and prepare the atlas in the output folder
+
+    :param argparse.Namespace _args:
+    :return: The path to the preprocessed brain
+    :rtype: str
+    """
+    import numpy as np
+    from amap.brain.brain_processor import BrainProcessor
+    from amap.brain.sample_space import get_sample_space_path
+
+    sample_name = _args.sample_name
+    print("Preprocessing")
+    brain = BrainProcessor(_args.target_brain_path, _args.output_folder,
+                           _args.x_pixel_mm, _args.y_pixel_mm, _args.z_pixel_mm,
+                           original_orientation=_args.orientation,
+                           load_parallel=_args.load_parallel,
+                           sort_input_file=_args.sort_input_file,
+                           atlas_downsampling_factor=_args.atlas_downsampling_factor)
+    brain.swap_atlas_orientation_to_self()
+    brain.flip_atlas((_args.flip_x, _args.flip_y, _args.flip_z))  # TEST: check that axes match
+    if _args.compact_labels:
+        brain.atlas.compact_labels()
+    brain.atlas.save_all()
+    if _args.save_unfiltered:
+        downsampled_brain_path = os.path.join(_args.output_folder, '{}_{}.nii'
+                                              .format(sample_name, 'downsampled'))  # FIXME: extract
+        brain.target_brain = brain.target_brain.astype(np.uint16, copy=False)  # FIXME: avaoid hardcoding unless io
+        brain.save(downsampled_brain_path)
+    brain.filter()
+    filtered_brain_path = get_filtered_brain_path(_args)
+    brain.save(filtered_brain_path)
+    brain.get_sample_space(filtered_brain_path).save(get_sample_space_path(_args.output_folder, sample_name))
+    return filtered_brain_path
+
+
+def run_affine_registration(_args):
+    """
+    Run the affine registration of the atlas to the sample (reg_aladin)
+
+    :param argparse.Namespace _args:
+    """
+    print("\tStarting affine registration")
+    get_brain_registration(_args).register_affine()  # TODO: have it as option
+
+
+def run_freeform_registration(_args):
+    """
+    Run the freeform registration of the atlas to the sample (reg_f3d)
+
+    :param argparse.Namespace _args:
+    """
+    print("\tStarting freeform registration")
+    brain_reg = get_brain_registration(_args)
+    brain_reg.register_freeform()
+    for line in format_summary(load_progress(brain_reg.freeform_progress_path)).splitlines():
+        print("\t\t{}".format(line))
+    if _args.cache_deformation_field:
+        print("\tCaching deformation field")
+        brain_reg.cache_deformation_field()
+
+
+def run_segmentation(_args):
+    """
+    Propagate the registration to the atlas (and optionally hemispheres) and run the optional analyses
+
+    :param argparse.Namespace _args:
+    :return: The path to the registered atlas
+    :rtype: str
+    """
+    from amap.brain.sample_space import SampleSpace, get_sample_space_path
+
+    brain_reg = get_brain_registration(_args)
+    if _args.left_right:
+        print("\tStarting segmentation of atlas and hemispheres")
+    else:
+        print("\tStarting segmentation")
+    brain_reg.propagate_all(hemispheres=_args.left_right, n_workers=_args.n_propagation_workers,
+                            packed=_args.pack_labels)
+    if _args.region_volumes is not None:
+        print("\tComputing region volumes")
+        brain_reg.compute_region_volumes(_args.region_volumes)
+    if _args.export_raw_resolution_atlas:
+        print("\tExporting the registered atlas at raw resolution")
+        brain_reg.export_atlas_to_raw_resolution(
+            SampleSpace.load(get_sample_space_path(_args.output_folder, _args.sample_name)))
+    if _args.generate_outlines:
+        print("\tGenerating outlines")
+        brain_reg.generate_outlines(mask_only=_args.outlines_mask_only)
+    return brain_reg.registered_atlas_img_path
+
+
+def get_pipeline(_args):
+    """
+    Get the steps selected by the CLI arguments (preprocess, affine, freeform and segment) with
+    their inputs, outputs and parameters so that the up to date steps can be skipped
+
+    :param argparse.Namespace _args:
+    :return: The pipeline of the sample
+    :rtype: Pipeline
+    """
+    from amap.brain.sample_space import get_sample_space_path
+    from amap.config.atlas import Atlas, get_atlas_conf
+    from amap.registration.brain_registration import BrainRegistration
+
+    filtered_brain_path = get_filtered_brain_path(_args)
+    # No bounding box, the mask would need the atlas which may not be saved yet. Only used for the paths
+    paths = BrainRegistration(_args.sample_name, filtered_brain_path, _args.output_folder)
+    reg_params = paths.reg_params
+    bounding_box = get_atlas_bounding_box(_args)
+    steps = []
+    if _args.preprocess:
+        outputs = [filtered_brain_path, reg_params.atlas_path, reg_params.atlas_brain_path,
+                   reg_params.hemispheres_path, get_sample_space_path(_args.output_folder, _args.sample_name)]
+        if _args.compact_labels:
+            outputs.append(reg_params.atlas_labels_lut_path)
+        if _args.save_unfiltered:
+            outputs.append(os.path.join(_args.output_folder, '{}_downsampled.nii'.format(_args.sample_name)))
+        params = {name: getattr(_args, name) for name in ('x_pixel_mm', 'y_pixel_mm', 'z_pixel_mm', 'orientation',
+                                                          'flip_x', 'flip_y', 'flip_z', 'sort_input_file',
+                                                          'compact_labels', 'save_unfiltered',
+                                                          'atlas_downsampling_factor')}
+        params['atlas_conf'] = get_atlas_conf()  # The source files and pixel sizes of the atlas
+        atlas = Atlas()  # The source of the pyramid levels (rebuilt if older than their source)
+        inputs = [_args.target_brain_path, atlas.get_path(), atlas.get_brain_path(), atlas.get_hemispheres_path()]
+        steps.append(Step('preprocess', lambda: run_preprocessing(_args), inputs=inputs,
+                          outputs=outputs, params=params))
+    if _args.register:
+        previous_steps = ('preprocess',) if _args.preprocess else ()
+        steps.append(Step('affine', lambda: run_affine_registration(_args),
+                          inputs=[filtered_brain_path, reg_params.atlas_brain_path],
+                          outputs=[paths.affine_matrix_path, paths.affine_registered_atlas_brain_path],
+                          params={'program': reg_params.affine_reg_program_path,
+                                  'options': reg_params.format_affine_params(),
+                                  'bounding_box': bounding_box},
+                          depends_on=previous_steps))
+        steps.append(Step('freeform', lambda: run_freeform_registration(_args),
+                          inputs=[filtered_brain_path, reg_params.atlas_brain_path, paths.affine_matrix_path],
+                          outputs=[paths.control_point_file_path, paths.freeform_registered_atlas_brain_path,
+                                   paths.deformation_field_path if _args.cache_deformation_field else ''],
+                          params={'program': reg_params.freeform_reg_program_path,
+                                  'options': reg_params.format_freeform_params(),
+                                  'bounding_box': bounding_box,
+                                  'cache_deformation_field': _args.cache_deformation_field},
+                          depends_on=('affine',)))
+        steps.append(Step('segment', lambda: run_segmentation(_args),
+                          inputs=[filtered_brain_path, paths.control_point_file_path, reg_params.atlas_path,
+                                  reg_params.hemispheres_path if _args.left_right else '',
+                                  reg_params.atlas_labels_lut_path if _args.compact_labels else '',
+                                  _args.region_volumes or ''],
+                          outputs=[paths.registered_atlas_img_path,
+                                   paths.registered_hemispheres_img_path if _args.left_right else '',
+                                   paths.region_volumes_path if _args.region_volumes is not None else '',
+                                   paths.raw_resolution_atlas_folder if _args.export_raw_resolution_atlas else '',
+                                   paths.outlines_file_path if _args.generate_outlines else ''],
+                          params={'program': reg_params.segmentation_program_path,
+                                  'options': reg_params.format_segmentation_params(),
+                                  'outlines_mask_only': _args.outlines_mask_only},
+                          depends_on=('freeform',)))
+    return Pipeline(steps, get_checkpoints_path(_args.output_folder, _args.sample_name))
 
 
 def process(_args):
@@ -144,59 +409,29 @@ def process(_args):
     :return: The path to the registered atlas
     :rtype: str
     """
-    sample_name = _args.sample_name
     if not os.path.exists(_args.output_folder):
         result = input("Output folder does not exist, would you like to create it. [Y/n]")
         if result.lower() in ('Y', 'Yes', 'yes', 'y', ''):  # TEST:
             os.makedirs(_args.output_folder)
         else:
             sys.exit('Missing output folder, aborting')
-    if _args.preprocess:
-        print("Preprocessing")
-        brain = BrainProcessor(_args.target_brain_path, _args.output_folder,
-                               _args.x_pixel_mm, _args.y_pixel_mm, _args.z_pixel_mm,
-                               original_orientation=_args.orientation,
-                               load_parallel=_args.load_parallel,
-                               sort_input_file=_args.sort_input_file)
-        brain.swap_atlas_orientation_to_self()
-        brain.flip_atlas((_args.flip_x, _args.flip_y, _args.flip_z))  # TEST: check that axes match
-        brain.atlas.save_all()
-        if _args.save_unfiltered:
-            downsampled_brain_path = os.path.join(_args.output_folder, '{}_{}.nii'
-                                                  .format(sample_name, 'downsampled'))  # FIXME: extract
-            brain.target_brain = brain.target_brain.astype(np.uint16, copy=False)  # FIXME: avaoid hardcoding unless io
-            brain.save(downsampled_brain_path)
-        brain.filter()
-        filtered_brain_path = os.path.join(_args.output_folder,
-                                           '{}_{}.nii'.format(sample_name, _args.preprocessed_suffix))
-        brain.save(filtered_brain_path)
-    else:
-        filtered_brain_path = _args.target_brain_path
-    brain_reg = BrainRegistration(sample_name, filtered_brain_path, _args.output_folder,
-                                  atlas_start_slice=_args.atlas_mask_planes[0],
-                                  atlas_end_slice=_args.atlas_mask_planes[1])
-    if _args.register:
-        print("Registering")
-        print("\tStarting affine registration")
-        brain_reg.register_affine()  # TODO: have it as option
-        print("\tStarting freeform registration")
-        brain_reg.register_freeform()
-
-        print("\tStarting segmentation")
-        brain_reg.segment()
-        if _args.left_right:
-            print("\tSegmenting hemispheres")
-            brain_reg.register_hemispheres()
-        if _args.generate_outlines:
-            print("\tGenerating outlines")
-            brain_reg.generate_outlines()
+    get_pipeline(_args).run(resume=_args.resume, force_from=_args.force_from)
     print("Done")
-    return brain_reg.registered_atlas_img_path
+    return get_brain_registration(_args).registered_atlas_img_path
 
 
 def main():
     args = get_parser().parse_args()
-    results_path = process(args)
+    from amap.utils import instrumentation
+    recorder = instrumentation.enable() if args.report else None
+    try:
+        results_path = process(args)
+    finally:
+        if recorder is not None and os.path.isdir(args.output_folder):
+            instrumentation.disable()
+            report_path = instrumentation.get_report_path(args.output_folder, args.sample_name)
+            recorder.write_report(report_path)
+            print("Report saved to {}".format(report_path))
 
     print("Segmentation finished. Results can be found here: {}".format(results_path))
     if args.erase_intermediate_files:
@@ -209,7 +444,4 @@ def main():
 if __name__ == '__main__':
     cwd = os.path.abspath('.')
     sys.path.insert(0, cwd)
-
-    from amap.brain.brain_processor import BrainProcessor
-    from amap.registration.brain_registration import BrainRegistration
     main()
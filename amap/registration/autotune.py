@@ -0,0 +1,192 @@
+"""
+autotune
+========
+
+A module to find the number of threads giving the fastest NiftyReg registrations on the current machine.
+A short registration (coarsest pyramid level and few iterations) is timed for several thread counts
+and the best setting stored in the user config folder, where RegistrationParams picks it up
+when the thread count of a stage is not set in the config.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import psutil
+
+from amap.utils.run_command import safe_execute_command
+
+TUNED_THREADS_FILE_NAME = 'autotune.json'
+DEFAULT_TOLERANCE = 0.05  # Prefer fewer threads unless more are at least 5% faster
+
+
+def get_tuned_threads_path():
+    return os.path.join(os.path.expanduser('~'), '.amap', TUNED_THREADS_FILE_NAME)
+
+
+def load_tuned_threads(tuned_threads_path=None):
+    """
+    Load the thread counts stored by autotune
+
+    :param str tuned_threads_path: Defaults to ~/.amap/autotune.json
+    :return: The number of threads of each program type ('affine', 'freeform' and 'segmentation'),
+        empty if autotune has not been run
+    :rtype: dict
+    """
+    if tuned_threads_path is None:
+        tuned_threads_path = get_tuned_threads_path()
+    if not os.path.exists(tuned_threads_path):
+        return {}
+    with open(tuned_threads_path, 'r') as tuned_file:
+        return json.load(tuned_file).get('n_threads', {})
+
+
+def get_candidate_thread_counts(max_threads=None):
+    """
+    The powers of 2 up to the number of cores, and the number of cores
+
+    :param int max_threads: Defaults to the number of cores
+    :rtype: list
+    """
+    if max_threads is None:
+        max_threads = psutil.cpu_count()
+    counts = []
+    n = 1
+    while n < max_threads:
+        counts.append(n)
+        n *= 2
+    counts.append(max_threads)
+    return counts
+
+
+def pick_best(timings, tolerance=DEFAULT_TOLERANCE):
+    """
+    Pick the number of threads with the shortest time. A larger number of threads must be faster by
+    more than the tolerance to be preferred, so that cores are not wasted for marginal gains.
+
+    :param dict timings: The time in seconds for each number of threads
+    :param float tolerance: The relative improvement required
+    :return: The number of threads
+    :rtype: int
+    """
+    best = None
+    for n_threads in sorted(timings):
+        if best is None or timings[n_threads] < timings[best] * (1 - tolerance):
+            best = n_threads
+    return best
+
+
+def time_command(cmd, n_threads, log_file_path, error_file_path):
+    """
+    Time a command run with n_threads OpenMP threads
+
+    :return: The wall time in seconds
+    :rtype: float
+    """
+    env = os.environ.copy()
+    env['OMP_NUM_THREADS'] = str(n_threads)
+    start = time.time()
+    safe_execute_command(cmd, log_file_path, error_file_path, env=env)
+    return time.time() - start
+
+
+def get_short_registration_cmds(reference_img_path, floating_img_path, work_dir, n_steps=3, max_iterations=10):
+    """
+    Get the commands of a short affine and freeform registration (only the coarsest pyramid level is used)
+
+    :return: The commands of each program type
+    :rtype: dict
+    """
+    from amap.registration.registration_params import RegistrationParams
+    params = RegistrationParams()
+    level_params = '-ln {} -lp 1 -maxit {}'.format(n_steps, max_iterations)
+    return {
+        'affine': '{} {} -flo {} -ref {} -aff {} -res {}'.format(
+            params.affine_reg_program_path, level_params, floating_img_path, reference_img_path,
+            os.path.join(work_dir, 'affine_matrix.txt'), os.path.join(work_dir, 'affine_result.nii')),
+        'freeform': '{} {} -flo {} -ref {} -cpp {} -res {}'.format(
+            params.freeform_reg_program_path, level_params, floating_img_path, reference_img_path,
+            os.path.join(work_dir, 'control_point_file.nii'), os.path.join(work_dir, 'freeform_result.nii'))
+    }
+
+
+def autotune(reference_img_path, floating_img_path, thread_counts=None, n_steps=3, max_iterations=10,
+             tuned_threads_path=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Time a short affine and freeform registration with each number of threads and store the best ones.
+    The propagation (reg_resample) uses the value found for the freeform registration.
+
+    :param str reference_img_path: A typical sample (e.g. a preprocessed brain)
+    :param str floating_img_path: The average brain of the atlas
+    :param list thread_counts: The numbers of threads to try (see get_candidate_thread_counts)
+    :param int n_steps: The number of pyramid levels (only the coarsest one is registered)
+    :param int max_iterations: The maximum number of iterations
+    :param str tuned_threads_path: Where to store the result (defaults to ~/.amap/autotune.json)
+    :param float tolerance: See pick_best
+    :return: The best number of threads of each program type and the timings
+    :rtype: dict
+    """
+    if thread_counts is None:
+        thread_counts = get_candidate_thread_counts()
+    if tuned_threads_path is None:
+        tuned_threads_path = get_tuned_threads_path()
+    work_dir = tempfile.mkdtemp(prefix='amap_autotune_')
+    try:
+        cmds = get_short_registration_cmds(reference_img_path, floating_img_path, work_dir, n_steps, max_iterations)
+        log_file_path = os.path.join(work_dir, 'autotune.log')
+        error_file_path = os.path.join(work_dir, 'autotune.err')
+        timings = {}
+        for program_type in ('affine', 'freeform'):  # The freeform registration needs no affine matrix
+            timings[program_type] = {n: time_command(cmds[program_type], n, log_file_path, error_file_path)
+                                     for n in thread_counts}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    n_threads = {program_type: pick_best(program_timings, tolerance)
+                 for program_type, program_timings in timings.items()}
+    n_threads['segmentation'] = n_threads['freeform']
+    result = {
+        'n_threads': n_threads,
+        'timings': {program_type: {str(n): t for n, t in program_timings.items()}
+                    for program_type, program_timings in timings.items()},
+        'n_cores': psutil.cpu_count(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    tuned_threads_dir = os.path.dirname(tuned_threads_path)
+    if tuned_threads_dir and not os.path.exists(tuned_threads_dir):
+        os.makedirs(tuned_threads_dir)
+    with open(tuned_threads_path, 'w') as tuned_file:
+        json.dump(result, tuned_file, indent=4)
+    return result
+
+
+def get_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='Find the fastest number of threads for NiftyReg on this machine '
+                                        'and store it in {}'.format(get_tuned_threads_path()))
+    parser.add_argument('reference_img_path', metavar='reference-img-path', type=str,
+                        help='A typical preprocessed sample (nifty)')
+    parser.add_argument('floating_img_path', metavar='floating-img-path', type=str,
+                        help='The average brain of the atlas (nifty)')
+    parser.add_argument('--thread-counts', dest='thread_counts', type=int, nargs='+',
+                        help='The numbers of threads to try (defaults to the powers of 2 up to the number of cores)')
+    parser.add_argument('--n-steps', dest='n_steps', type=int, default=3,
+                        help='The number of pyramid levels. Only the coarsest one is registered')
+    parser.add_argument('--max-iterations', dest='max_iterations', type=int, default=10,
+                        help='The maximum number of iterations of the registrations')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    result = autotune(args.reference_img_path, args.floating_img_path, thread_counts=args.thread_counts,
+                      n_steps=args.n_steps, max_iterations=args.max_iterations)
+    for program_type, program_timings in result['timings'].items():
+        print("{}: {}".format(program_type, ', '.join('{} threads: {:.2f}s'.format(n, t)
+                                                       for n, t in program_timings.items())))
+    print("Best: {}".format(result['n_threads']))
+
+
+if __name__ == '__main__':
+    main()
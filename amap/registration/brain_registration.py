@@ -6,13 +6,22 @@ The module to actually start the registration
 """
 import os
 import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from skimage import segmentation as sk_segmentation
 
+from amap.analysis.brain_analyser import save_table
+from amap.analysis.region_volumes import region_volumes, load_hierarchy
 from amap.brain import brain_io as bio
+from amap.brain.upsampling import export_to_raw_resolution
+from amap.config.atlas import expand_labels, pack_labels, unpack_labels
 
+from amap.registration.deformation import Deformation, load_cached_deformation, materialise_deformation_field
 from amap.registration.registration_params import RegistrationParams
+from amap.utils.instrumentation import instrumented
+from amap.registration.progress import ProgressRecorder, get_progress_path
 from amap.utils.run_command import safe_execute_command, SafeExecuteCommandError
 
 
@@ -24,23 +33,161 @@ class SegmentationError(RegistrationError):
     pass
 
 
+def normalise_bounding_box(bounding_box, shape):
+    """
+    Convert a bounding box given as python slice bounds (which may be None or negative) to
+    absolute (start, stop) indices for an image of the given shape
+
+    :param tuple bounding_box: A (start, stop) pair per axis
+    :param tuple shape: The shape of the image
+    :return: The bounding box as absolute indices
+    :rtype: tuple
+    """
+    return tuple(slice(*bounds).indices(size)[:2] for bounds, size in zip(bounding_box, shape))
+
+
+def slab_bounding_box(atlas_start_slice, atlas_end_slice):
+    """
+    The bounding box of the slab of planes between atlas_start_slice and atlas_end_slice
+
+    :param int atlas_start_slice:
+    :param int atlas_end_slice:
+    :return: The bounding box
+    :rtype: tuple
+    """
+    return (None, None), (atlas_start_slice, atlas_end_slice), (None, None)  # FIXME: only valid for horizontal atlas
+
+
+def make_mask(atlas_img_path, mask_path, bounding_box):
+    """
+    Write a uint8 mask with the geometry of the atlas which is 1 inside bounding_box and 0 outside.
+    Only the header of the atlas is read.
+
+    :param str atlas_img_path: The path to the atlas image
+    :param str mask_path: The destination of the mask image
+    :param tuple bounding_box: A (start, stop) pair per axis (see normalise_bounding_box)
+    """
+    atlas_header = bio.load_nii(atlas_img_path, as_array=False).header
+    shape = atlas_header.get_data_shape()[:3]
+    atlas_mask = np.zeros(shape, dtype=np.uint8)
+    atlas_mask[tuple(slice(*bounds) for bounds in normalise_bounding_box(bounding_box, shape))] = 1
+    bio.to_nii(atlas_mask, mask_path, scale=atlas_header.get_zooms()[:3], affine_transform=atlas_header.get_best_affine())
+
+
 def make_atlas_mask(atlas_img_path, mask_path, atlas_start_slice, atlas_end_slice):
-    atlas = bio.load_nii(atlas_img_path, as_array=False)
-    atlas_mask = atlas.get_data().astype(np.uint16)
+    make_mask(atlas_img_path, mask_path, slab_bounding_box(atlas_start_slice, atlas_end_slice))
+
+
+def get_cached_atlas_mask(atlas_img_path, bounding_box, cache_folder):
+    """
+    Get the path to a mask of the atlas for bounding_box, creating it if it is not in the cache yet.
+    The masks are keyed by the geometry of the atlas (from its header) and the bounding box so that
+    they can be reused across runs and samples.
+
+    :param str atlas_img_path: The path to the atlas image
+    :param tuple bounding_box: A (start, stop) pair per axis (see normalise_bounding_box)
+    :param str cache_folder: The folder where the masks are stored
+    :return: The path to the mask
+    :rtype: str
+    """
+    atlas_header = bio.load_nii(atlas_img_path, as_array=False).header
+    shape = atlas_header.get_data_shape()[:3]
+    key = repr((shape, np.round(atlas_header.get_best_affine(), 6).tolist(),
+                normalise_bounding_box(bounding_box, shape)))
+    mask_path = os.path.join(cache_folder, 'atlas_mask_{}.nii'.format(hashlib.sha1(key.encode()).hexdigest()))
+    if not os.path.exists(mask_path):
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder, exist_ok=True)
+        tmp_mask_path = '{}.{}.tmp.nii'.format(os.path.splitext(mask_path)[0], os.getpid())
+        make_mask(atlas_img_path, tmp_mask_path, bounding_box)
+        os.replace(tmp_mask_path, mask_path)  # Atomic so that concurrent jobs never see a partial mask
+    return mask_path
+
+
+def outline_volume(atlas, labels_lut=None, mask_only=False, slab_size=32, n_workers=4, out=None):
+    """
+    Compute the outlines of the different regions of an (in memory or memory mapped) atlas.
+    The atlas is processed by slabs of planes with a one plane halo on a thread pool
+    so that the peak memory is a few slabs rather than several times the atlas.
+
+    :param np.ndarray atlas: The (registered) atlas
+    :param np.ndarray labels_lut: The lookup table to the region IDs if the atlas is compact
+    :param bool mask_only: Only return the mask of the outlines (as uint8) rather than the region IDs
+    :param int slab_size: The number of planes per slab
+    :param int n_workers: The number of threads
+    :param np.ndarray out: Where to write the outlines (e.g. a memory mapped file). Allocated if not given.
+    :return: The outlines
+    :rtype: np.ndarray
+    """
+    if out is None:
+        if mask_only:
+            dtype = np.uint8
+        else:
+            dtype = labels_lut.dtype if labels_lut is not None else atlas.dtype
+        out = np.empty(atlas.shape, dtype=dtype)
+    n_planes = atlas.shape[2]
+
+    def outline_slab(start):
+        stop = min(start + slab_size, n_planes)
+        halo_start = max(start - 1, 0)
+        slab = np.asarray(atlas[:, :, halo_start:min(stop + 1, n_planes)])
+        boundaries_mask = sk_segmentation.find_boundaries(slab, mode='inner')
+        boundaries_mask = boundaries_mask[:, :, start - halo_start:stop - halo_start]
+        if mask_only:
+            out[:, :, start:stop] = boundaries_mask
+        else:
+            slab = slab[:, :, start - halo_start:stop - halo_start]
+            if labels_lut is not None:
+                slab = expand_labels(slab, labels_lut)
+            out[:, :, start:stop] = slab * boundaries_mask
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        list(executor.map(outline_slab, range(0, n_planes, slab_size)))
+    return out
+
 
-    mask_low_value = 0
-    mask_high_value = 2**16 - 1
-    atlas_mask[:, :atlas_start_slice, :] = mask_low_value  # FIXME: only valid for horizontal atlas
-    atlas_mask[:, atlas_start_slice:atlas_end_slice, :] = mask_high_value
-    atlas_mask[:, atlas_end_slice:, :] = mask_low_value
-    bio.to_nii(atlas, mask_path)
+def generate_outlines(atlas_img_path, outlines_file_path, labels_lut=None, mask_only=False, slab_size=32, n_workers=4):
+    """
+    Generates the outlines of the different regions of an atlas (see outline_volume).
+    The outlines are written incrementally to outlines_file_path.
+
+    :param str atlas_img_path: The (registered) atlas
+    :param str outlines_file_path: Where to save the outlines
+    :param np.ndarray labels_lut: The lookup table to the region IDs if the atlas is compact
+    :param bool mask_only: Only save the mask of the outlines (as uint8) rather than the region IDs
+    :param int slab_size: The number of planes per slab
+    :param int n_workers: The number of threads
+    """
+    morphed_atlas = bio.load_nii(atlas_img_path, as_array=False)
+    atlas_scale = morphed_atlas.header.get_zooms()
+    morphed_atlas = morphed_atlas.get_data()  # memory mapped
+    if mask_only:
+        dtype = np.uint8
+    else:
+        dtype = labels_lut.dtype if labels_lut is not None else morphed_atlas.dtype
+    boundaries = bio.create_nii_memmap(outlines_file_path, morphed_atlas.shape, dtype, scale=atlas_scale)
+    outline_volume(morphed_atlas, labels_lut=labels_lut, mask_only=mask_only, slab_size=slab_size,
+                   n_workers=n_workers, out=boundaries)
+    boundaries.flush()
+    del boundaries
 
 
 class BrainRegistration(object):
     """
     A class to register brains using the nifty_reg set of binaries
     """
-    def __init__(self, sample_name, target_brain_path, output_folder, atlas_start_slice=0, atlas_end_slice=-1):
+    def __init__(self, sample_name, target_brain_path, output_folder, atlas_start_slice=0, atlas_end_slice=-1,
+                 atlas_bounding_box=None):
+        """
+
+        :param str sample_name: The name of the sample used as prefix for the output files
+        :param str target_brain_path: The path to the (preprocessed) sample brain
+        :param str output_folder: The folder where to save the output files
+        :param int atlas_start_slice: The first plane of the atlas to keep for the registration
+        :param int atlas_end_slice: The end of the range of planes to keep for the registration
+        :param tuple atlas_bounding_box: A (start, stop) pair per axis of the atlas to keep for the registration.
+            Overrides atlas_start_slice and atlas_end_slice.
+        """
         self.sample_name = sample_name
         self.output_folder = output_folder
         self.reg_params = self.get_reg_params()
@@ -49,12 +196,13 @@ class BrainRegistration(object):
         self.brain_of_atlas_img_path = self.reg_params.atlas_brain_path
         self.atlas_img_path = self.reg_params.atlas_path
         self.hemispheres_img_path = self.reg_params.hemispheres_path
+        self.atlas_labels_lut_path = self.reg_params.atlas_labels_lut_path
 
-        if atlas_start_slice != 0 or atlas_end_slice != -1:
-            make_atlas_mask(self.atlas_img_path,
-                            self.reg_params.atlas_mask_path,
-                            atlas_start_slice, atlas_end_slice)
-            self.atlas_mask_path = self.reg_params.atlas_mask_path
+        if atlas_bounding_box is None and (atlas_start_slice != 0 or atlas_end_slice != -1):
+            atlas_bounding_box = slab_bounding_box(atlas_start_slice, atlas_end_slice)
+        if atlas_bounding_box is not None:
+            self.atlas_mask_path = get_cached_atlas_mask(self.atlas_img_path, atlas_bounding_box,
+                                                         self.reg_params.atlas_mask_cache_folder)
         else:
             self.atlas_mask_path = ''
 
@@ -62,16 +210,28 @@ class BrainRegistration(object):
         self.affine_registered_atlas_brain_path = self.make_path('{}_affine_registered_atlas_brain.nii')
         self.freeform_registered_atlas_brain_path = self.make_path('{}_freeform_registered_atlas_brain.nii')
         self.registered_atlas_img_path = self.make_path('{}_registered_atlas.nii')
+        self.registered_compact_atlas_img_path = self.make_path('{}_registered_atlas_compact.nii')
         self.registered_hemispheres_img_path = self.make_path('{}_registered_hemispheres.nii')
+        self.packed_atlas_img_path = self.make_path('{}_packed_atlas.nii')
+        self.registered_packed_atlas_img_path = self.make_path('{}_registered_packed_atlas.nii')
 
         self.affine_matrix_path = self.make_path('{}_affine_matrix.txt')
         self.control_point_file_path = self.make_path('{}_control_point_file.nii')
+        self.deformation_field_path = self.make_path('{}_deformation_field.npy')
 
         self.outlines_file_path = self.make_path('{}_outlines.nii')
+        self.region_volumes_path = self.make_path('{}_region_volumes.csv')
+        self.raw_resolution_atlas_folder = self.make_path('{}_registered_atlas_raw_resolution')
 
         self.affine_log_file_path, self.affine_error_path = self.compute_log_file_paths('affine')
         self.freeform_log_file_path, self.freeform_error_file_path = self.compute_log_file_paths('freeform')
+        self.affine_progress_path = get_progress_path(self.affine_log_file_path)
+        self.freeform_progress_path = get_progress_path(self.freeform_log_file_path)
         self.segmentation_log_file, self.segmentation_error_file = self.compute_log_file_paths('segment')
+        self.hemispheres_segmentation_log_file, self.hemispheres_segmentation_error_file = \
+            self.compute_log_file_paths('segment_hemispheres')
+
+        self.command_results = {}  # The CommandResult (time and memory used) of each NiftyReg call
 
         # self.sanitise_inputs()
 
@@ -133,6 +293,7 @@ class BrainRegistration(object):
             cmd += ' -fmask {}'.format(self.atlas_mask_path)
         return cmd
 
+    @instrumented('affine')
     def register_affine(self):
         """
         Performs affine registration of the average brain of the atlas to the sample brain
@@ -142,8 +303,10 @@ class BrainRegistration(object):
         :raises RegistrationError: If any error was detected during registration.
         """
         try:
-            safe_execute_command(self._prepare_affine_reg_cmd(),
-                                 self.affine_log_file_path, self.affine_error_path)
+            with ProgressRecorder(self.affine_progress_path, 'affine') as progress:
+                self.command_results['affine'] = safe_execute_command(
+                    self._prepare_affine_reg_cmd(), self.affine_log_file_path, self.affine_error_path,
+                    env=self.reg_params.get_environment('affine'), line_callback=progress)
         except SafeExecuteCommandError as err:
             raise RegistrationError('Affine registration failed; {}'.format(err))
 
@@ -160,6 +323,7 @@ class BrainRegistration(object):
             cmd += ' -fmask {}'.format(self.atlas_mask_path)
         return cmd
 
+    @instrumented('freeform')
     def register_freeform(self):
         """
         Performs freeform (elastic) registration of the average brain of the atlas to the sample brain
@@ -169,14 +333,17 @@ class BrainRegistration(object):
         :raises RegistrationError: If any error was detected during registration.
         """
         try:
-            safe_execute_command(self._prepare_freeform_reg_cmd(),
-                                 self.freeform_log_file_path, self.freeform_error_file_path)
+            with ProgressRecorder(self.freeform_progress_path, 'freeform') as progress:
+                self.command_results['freeform'] = safe_execute_command(
+                    self._prepare_freeform_reg_cmd(), self.freeform_log_file_path, self.freeform_error_file_path,
+                    env=self.reg_params.get_environment('freeform'), line_callback=progress)
         except SafeExecuteCommandError as err:
             raise RegistrationError('Freeform registration failed; {}'.format(err))
 
-    def _prepare_segmentation_cmd(self, floating_image_path, dest_img_path):
+    def _prepare_segmentation_cmd(self, floating_image_path, dest_img_path, interpolation_order=None):
         cmd = '{} {} -cpp {} -flo {} -ref {} -res {}'.format(
-            self.reg_params.segmentation_program_path, self.reg_params.format_segmentation_params().strip(),
+            self.reg_params.segmentation_program_path,
+            self.reg_params.format_segmentation_params(interpolation_order).strip(),
             self.control_point_file_path,
             floating_image_path,
             self.dataset_img_path,
@@ -184,35 +351,198 @@ class BrainRegistration(object):
         )
         return cmd
 
+    @property
+    def is_atlas_compact(self):
+        """
+        Whether the atlas is stored as a compact uint16 index volume and a lookup table
+        (see amap.config.atlas.compact_labels)
+
+        :rtype: bool
+        """
+        return os.path.exists(self.atlas_labels_lut_path)
+
+    @instrumented('segment')
     def segment(self):
         """
         Registers the atlas to the sample brain (propagates the transformation computed for the average brain
         of the atlas to the atlas itself).
+        If the atlas is compact, the compact form is propagated and the region IDs are only expanded
+        when exporting to self.registered_atlas_img_path.
 
 
         :return:
         :raises SegmentationError: If any error was detected during the propagation.
         """
-        try:
-            safe_execute_command(self._prepare_segmentation_cmd(self.atlas_img_path, self.registered_atlas_img_path),
-                                 self.segmentation_log_file, self.segmentation_error_file)
-        except SafeExecuteCommandError as err:
-            SegmentationError('Segmentation failed; {}'.format(err))
+        if self.is_atlas_compact:
+            registered_atlas_img_path = self.registered_compact_atlas_img_path
+        else:
+            registered_atlas_img_path = self.registered_atlas_img_path
+        self.propagate(self.atlas_img_path, registered_atlas_img_path,
+                       self.segmentation_log_file, self.segmentation_error_file)
+        if self.is_atlas_compact:
+            self.expand_registered_atlas()
+
+    def expand_registered_atlas(self):
+        """
+        Export the compact registered atlas to self.registered_atlas_img_path with the original region IDs
+        """
+        compact_atlas = bio.load_nii(self.registered_compact_atlas_img_path, as_array=False)
+        lut = np.load(self.atlas_labels_lut_path)
+        bio.to_nii(expand_labels(compact_atlas.get_data(), lut), self.registered_atlas_img_path,
+                   scale=compact_atlas.header.get_zooms(), affine_transform=compact_atlas.affine)
 
+    @instrumented('hemispheres')
     def register_hemispheres(self):
         """
         Registers the hemispheres atlas to the sample brain (propagates the transformation computed for the average brain
         of the atlas to the hemispheres atlas itself).
 
         :return:
-        :raises RegistrationError: If any error was detected during the propagation.
+        :raises SegmentationError: If any error was detected during the propagation.
+        """
+        self.propagate(self.hemispheres_img_path, self.registered_hemispheres_img_path,
+                       self.hemispheres_segmentation_log_file, self.hemispheres_segmentation_error_file)
+
+    @instrumented('segment_packed')
+    def segment_packed(self):
+        """
+        Registers the atlas and the hemispheres atlas to the sample brain with a single propagation.
+        The hemisphere and annotation of each voxel are packed into one integer volume (see
+        amap.config.atlas.pack_labels) which is propagated with nearest neighbour interpolation and
+        then split back into self.registered_atlas_img_path and self.registered_hemispheres_img_path.
+        This gives the same results as segment and register_hemispheres.
+
+        :return:
+        :raises SegmentationError: If any error was detected during the propagation.
+        """
+        atlas = bio.load_nii(self.atlas_img_path, as_array=False)
+        hemispheres = bio.load_nii(self.hemispheres_img_path, as_array=False)
+        packed_atlas, packed_lut = pack_labels(atlas.get_data(), hemispheres.get_data())
+        hemispheres_dtype = hemispheres.get_data_dtype()
+        bio.to_nii(packed_atlas, self.packed_atlas_img_path,  # Same geometry as the atlas for reg_resample
+                   scale=atlas.header.get_zooms(), affine_transform=atlas.affine)
+        del atlas, hemispheres, packed_atlas
+
+        self.propagate(self.packed_atlas_img_path, self.registered_packed_atlas_img_path,
+                       self.segmentation_log_file, self.segmentation_error_file)
+
+        registered_packed_atlas = bio.load_nii(self.registered_packed_atlas_img_path, as_array=False)
+        scale = registered_packed_atlas.header.get_zooms()
+        affine_transform = registered_packed_atlas.affine
+        if self.is_atlas_compact:  # The packed lut maps to compact indices, which must be expanded in turn
+            registered_atlas, registered_hemispheres = unpack_labels(registered_packed_atlas.get_data(),
+                                                                     packed_lut.astype(np.uint16),
+                                                                     hemispheres_dtype)
+            bio.to_nii(registered_atlas, self.registered_compact_atlas_img_path,
+                       scale=scale, affine_transform=affine_transform)
+            registered_atlas = expand_labels(registered_atlas, np.load(self.atlas_labels_lut_path))
+        else:
+            registered_atlas, registered_hemispheres = unpack_labels(registered_packed_atlas.get_data(),
+                                                                     packed_lut, hemispheres_dtype)
+        bio.to_nii(registered_atlas, self.registered_atlas_img_path, scale=scale, affine_transform=affine_transform)
+        bio.to_nii(registered_hemispheres, self.registered_hemispheres_img_path,
+                   scale=scale, affine_transform=affine_transform)
+
+    def propagate(self, floating_image_path, dest_img_path, log_file_path, error_file_path,
+                  interpolation_order=None):
+        """
+        Propagates the transformation computed for the average brain of the atlas to the
+        image at floating_image_path using nifty_reg reg_resample
+
+        :param str floating_image_path: The image to transform (in atlas space)
+        :param str dest_img_path: Where to save the transformed image (in sample space)
+        :param str log_file_path: The log file of this propagation
+        :param str error_file_path: The error file of this propagation
+        :param int interpolation_order: The interpolation order (0: nearest, 1: linear).
+            Defaults to the value from the registration params (nearest for label volumes)
+        :return:
+        :raises SegmentationError: If any error was detected during the propagation.
         """
         try:
-            safe_execute_command(self._prepare_segmentation_cmd(self.hemispheres_img_path,
-                                                                self.registered_hemispheres_img_path),
-                                 self.segmentation_log_file, self.segmentation_error_file)
+            result = safe_execute_command(self._prepare_segmentation_cmd(floating_image_path, dest_img_path,
+                                                                         interpolation_order),
+                                          log_file_path, error_file_path,
+                                          env=self.reg_params.get_environment('segmentation'))
+            self.command_results[os.path.splitext(os.path.basename(log_file_path))[0]] = result
         except SafeExecuteCommandError as err:
-            SegmentationError('Segmentation failed; {}'.format(err))
+            raise SegmentationError('Segmentation failed; {}'.format(err))
+
+    def propagate_all(self, hemispheres=False, extra_volumes=(), n_workers=2, packed=False):
+        """
+        Runs the independent propagations (atlas, optionally hemispheres and any extra volume)
+        concurrently as they all use the same control point file. Each propagation has its own log files.
+
+        :param bool hemispheres: Whether to also propagate the hemispheres atlas
+        :param extra_volumes: A sequence of (floating_image_path, dest_img_path, interpolation_order)
+            of other volumes to propagate (e.g. additional label volumes or channels)
+        :param int n_workers: The maximum number of reg_resample processes running at the same time
+        :param bool packed: Propagate the atlas and hemispheres in a single pass (see segment_packed)
+        :return:
+        :raises SegmentationError: If any of the propagations failed (after all have completed).
+        """
+        if hemispheres and packed:
+            tasks = [(self.segment_packed, ())]
+        else:
+            tasks = [(self.segment, ())]
+            if hemispheres:
+                tasks.append((self.register_hemispheres, ()))
+        for floating_image_path, dest_img_path, interpolation_order in extra_volumes:
+            basename = os.path.splitext(os.path.basename(dest_img_path))[0]
+            log_file_path, error_file_path = self.compute_log_file_paths('segment_{}'.format(basename))
+            tasks.append((self.propagate, (floating_image_path, dest_img_path, log_file_path, error_file_path,
+                                           interpolation_order)))
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:  # The work is done by subprocesses
+            futures = [executor.submit(func, *args) for func, args in tasks]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            raise SegmentationError('{} of {} propagations failed; {}'
+                                    .format(len(errors), len(tasks), '\n'.join(str(e) for e in errors)))
+
+    def get_deformation(self):
+        """
+        Get the transformation computed by the registration (from the cached dense deformation field if up to date,
+        otherwise from the control point file if the freeform registration was run or from the affine matrix)
+        to warp volumes in python (see deformation)
+
+        :return: The deformation
+        :rtype: Deformation
+        """
+        cached_deformation = load_cached_deformation(self.dataset_img_path, self.control_point_file_path,
+                                                     self.deformation_field_path)
+        if cached_deformation is not None:
+            return cached_deformation
+        elif os.path.exists(self.control_point_file_path):
+            return Deformation.from_files(self.dataset_img_path, control_point_file_path=self.control_point_file_path)
+        elif os.path.exists(self.affine_matrix_path):
+            return Deformation.from_files(self.dataset_img_path, affine_matrix_path=self.affine_matrix_path)
+        else:
+            raise RegistrationError('Cannot get the deformation, the registration has not been run')
+
+    @instrumented('cache_deformation_field')
+    def cache_deformation_field(self):
+        """
+        Materialise the dense deformation field of the freeform registration as a memory mapped
+        float32 array next to the other outputs (see deformation.materialise_deformation_field).
+        Later warps and point transforms then only need array lookups.
+
+        :return:
+        """
+        materialise_deformation_field(self.dataset_img_path, self.control_point_file_path,
+                                      self.deformation_field_path)
+
+    def warp_volume(self, volume, floating_affine, interpolation_order=0, n_workers=4):
+        """
+        Propagate the transformation to an in memory volume in atlas space without calling reg_resample
+
+        :param np.ndarray volume: The volume to warp (same geometry as the atlas)
+        :param np.ndarray floating_affine: The voxel to world matrix of the volume
+        :param int interpolation_order: 0 for nearest neighbour (labels), 1 for linear
+        :param int n_workers: The number of threads
+        :return: The volume in sample space
+        :rtype: np.ndarray
+        """
+        return self.get_deformation().warp(volume, floating_affine, interpolation_order=interpolation_order,
+                                           n_workers=n_workers)
 
     def get_reg_params(self):
         """
@@ -223,15 +553,61 @@ class BrainRegistration(object):
         """
         return RegistrationParams(self.output_folder)
 
-    def generate_outlines(self):
+    @instrumented('outlines')
+    def generate_outlines(self, mask_only=False, slab_size=32, n_workers=4):
         """
-        Generates the outlines of the different atlas region.
+        Generates the outlines of the different atlas region (see generate_outlines).
+        If the atlas is compact, the outlines are computed on the compact form and expanded on export.
 
+        :param bool mask_only: Only save the mask of the outlines (as uint8) rather than the region IDs
+        :param int slab_size: The number of planes per slab
+        :param int n_workers: The number of threads
         :return:
         """
-        morphed_atlas = bio.load_nii(self.registered_atlas_img_path, as_array=False)
-        atlas_scale = morphed_atlas.header.get_zooms()
-        morphed_atlas = morphed_atlas.get_data()
-        boundaries_mask = sk_segmentation.find_boundaries(morphed_atlas, mode='inner')
-        boundaries = morphed_atlas * boundaries_mask
-        bio.to_nii(boundaries, self.outlines_file_path, scale=atlas_scale)
+        if self.is_atlas_compact:
+            generate_outlines(self.registered_compact_atlas_img_path, self.outlines_file_path,
+                              labels_lut=np.load(self.atlas_labels_lut_path), mask_only=mask_only,
+                              slab_size=slab_size, n_workers=n_workers)
+        else:
+            generate_outlines(self.registered_atlas_img_path, self.outlines_file_path, mask_only=mask_only,
+                              slab_size=slab_size, n_workers=n_workers)
+
+    @instrumented('region_volumes')
+    def compute_region_volumes(self, hierarchy_path=''):
+        """
+        Computes the number of voxels and volume of each region of the registered atlas
+        (see amap.analysis.region_volumes) and saves the table to self.region_volumes_path.
+        If the atlas is compact, the counts are accumulated on the compact form.
+
+        :param str hierarchy_path: The optional csv file of the region hierarchy to roll the volumes up
+        :return: The table
+        :rtype: np.ndarray
+        """
+        hierarchy = load_hierarchy(hierarchy_path) if hierarchy_path else None
+        if self.is_atlas_compact:
+            table = region_volumes(self.registered_compact_atlas_img_path, hierarchy=hierarchy,
+                                   labels_lut=np.load(self.atlas_labels_lut_path))
+        else:
+            table = region_volumes(self.registered_atlas_img_path, hierarchy=hierarchy)
+        save_table(table, self.region_volumes_path)
+        return table
+
+    @instrumented('raw_resolution_export')
+    def export_atlas_to_raw_resolution(self, sample_space, raw_shape=None, n_workers=4):
+        """
+        Exports the registered atlas at the raw sample resolution as a sequence of tiff planes in
+        self.raw_resolution_atlas_folder (see amap.brain.upsampling.export_to_raw_resolution).
+
+        :param amap.brain.sample_space.SampleSpace sample_space: The geometry of the sample
+        :param tuple raw_shape: The shape of the raw sample (defaults to sample_space.raw_shape)
+        :param int n_workers: The number of threads
+        :return: The paths of the planes
+        :rtype: list
+        """
+        if self.is_atlas_compact:
+            return export_to_raw_resolution(self.registered_compact_atlas_img_path, self.raw_resolution_atlas_folder,
+                                            sample_space, raw_shape=raw_shape,
+                                            labels_lut=np.load(self.atlas_labels_lut_path), n_workers=n_workers)
+        else:
+            return export_to_raw_resolution(self.registered_atlas_img_path, self.raw_resolution_atlas_folder,
+                                            sample_space, raw_shape=raw_shape, n_workers=n_workers)
@@ -0,0 +1,366 @@
+"""
+deformation
+===========
+
+A python implementation of the transformation applied by nifty_reg reg_resample.
+It evaluates the cubic B-spline deformation stored in the control point file written by reg_f3d
+(or an affine matrix written by reg_aladin) to warp in memory volumes from the atlas (floating)
+space to the sample (reference) space without spawning a subprocess.
+
+.. note:: reg_f3d initialises the control point grid with the affine transformation (-aff) and the
+    control point file stores the positions of the control points in the floating space.
+    The affine is therefore already composed into the grid.
+"""
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from amap.brain import brain_io as bio
+from amap.utils.file_hash import hash_file
+
+
+class DeformationError(Exception):
+    pass
+
+
+def load_affine_matrix(affine_matrix_path):
+    """
+    Load the affine transformation matrix saved by reg_aladin.
+    The matrix maps the reference (sample) world coordinates to the floating (atlas) world coordinates.
+
+    :param str affine_matrix_path: The path to the text file
+    :return: The 4x4 matrix
+    :rtype: np.ndarray
+    """
+    matrix = np.loadtxt(affine_matrix_path)
+    if matrix.shape != (4, 4):
+        raise DeformationError('Expected a 4x4 matrix in {}, got shape {}'.format(affine_matrix_path, matrix.shape))
+    return matrix
+
+
+def cubic_bspline_weights(basis):
+    """
+    The weights of the 4 control points surrounding each position for a uniform cubic B-spline
+
+    :param np.ndarray basis: The fractional part of the position in grid coordinates
+    :return: The weights (shape basis.shape + (4,))
+    :rtype: np.ndarray
+    """
+    basis_sq = basis * basis
+    basis_cube = basis_sq * basis
+    one_minus = 1. - basis
+    return np.stack((one_minus * one_minus * one_minus / 6.,
+                     (3. * basis_cube - 6. * basis_sq + 4.) / 6.,
+                     (-3. * basis_cube + 3. * basis_sq + 3. * basis + 1.) / 6.,
+                     basis_cube / 6.), axis=-1)
+
+
+def _apply_affine(matrix, points):
+    return np.dot(points, matrix[:3, :3].T) + matrix[:3, 3]
+
+
+def _bspline_matrix(grid_coordinates, n_control_points):
+    """
+    The dense (n_positions, n_control_points) matrix of B-spline weights along one axis
+    """
+    first_idx = np.floor(grid_coordinates).astype(np.int64) - 1
+    weights = cubic_bspline_weights(grid_coordinates - np.floor(grid_coordinates))
+    weights_matrix = np.zeros((grid_coordinates.size, n_control_points))
+    rows = np.arange(grid_coordinates.size)
+    for i in range(4):
+        np.add.at(weights_matrix, (rows, np.clip(first_idx + i, 0, n_control_points - 1)), weights[:, i])
+    return weights_matrix
+
+
+class Deformation(object):
+    """
+    The transformation from the reference (sample) space to the floating (atlas) space
+    as computed by the nifty_reg registration steps.
+    """
+    def __init__(self, reference_shape, reference_affine, control_points=None, control_points_affine=None,
+                 affine_matrix=None):
+        """
+
+        :param tuple reference_shape: The shape of the reference image
+        :param np.ndarray reference_affine: The voxel to world matrix of the reference image
+        :param np.ndarray control_points: The (nx, ny, nz, 3) positions of the control points (world, floating space)
+        :param np.ndarray control_points_affine: The voxel to world matrix of the control point grid
+        :param np.ndarray affine_matrix: A reg_aladin matrix. Only used if there is no control point grid.
+        """
+        if control_points is None and affine_matrix is None:
+            raise DeformationError('A control point grid or an affine matrix is required')
+        self.reference_shape = tuple(reference_shape[:3])
+        self.reference_affine = np.asarray(reference_affine, dtype=np.float64)
+        self.control_points = control_points
+        self.affine_matrix = affine_matrix
+        if control_points is not None:
+            self.control_points = np.asarray(control_points, dtype=np.float64)
+            # reference voxel -> control point grid coordinates
+            self.reference_to_grid = np.linalg.inv(control_points_affine).dot(self.reference_affine)
+
+    @classmethod
+    def from_files(cls, reference_img_path, control_point_file_path=None, affine_matrix_path=None):
+        """
+        Create the deformation from the files written by nifty_reg (see BrainRegistration)
+
+        :param str reference_img_path: The path to the reference (sample) image
+        :param str control_point_file_path: The control point file written by reg_f3d (-cpp)
+        :param str affine_matrix_path: The matrix written by reg_aladin (-aff). Only used without control point file
+        :return: The deformation
+        :rtype: Deformation
+        """
+        reference_img = bio.load_nii(reference_img_path, as_array=False)
+        control_points = control_points_affine = affine_matrix = None
+        if control_point_file_path:
+            control_points_img = bio.load_nii(control_point_file_path, as_array=False)
+            control_points = np.asarray(control_points_img.dataobj, dtype=np.float64)
+            control_points = control_points.reshape(control_points.shape[:3] + (3,))  # Drop the time dimension
+            control_points_affine = control_points_img.affine
+        elif affine_matrix_path:
+            affine_matrix = load_affine_matrix(affine_matrix_path)
+        return cls(reference_img.shape, reference_img.affine, control_points, control_points_affine, affine_matrix)
+
+    @property
+    def is_axis_aligned(self):
+        """
+        Whether the control point grid axes are aligned with the reference image axes
+        (always the case for grids created by reg_f3d), which allows a separable evaluation.
+
+        :rtype: bool
+        """
+        rotation = self.reference_to_grid[:3, :3]
+        return np.allclose(rotation, np.diag(np.diag(rotation)), atol=1e-6)
+
+    def transform_points(self, points):
+        """
+        Transform points from reference voxel coordinates to floating world coordinates
+
+        :param np.ndarray points: (N, 3) reference voxel coordinates (can be fractional)
+        :return: (N, 3) floating world coordinates
+        :rtype: np.ndarray
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if self.control_points is None:
+            return _apply_affine(self.affine_matrix, _apply_affine(self.reference_affine, points))
+        grid_coordinates = _apply_affine(self.reference_to_grid, points)
+        first_idx = np.floor(grid_coordinates).astype(np.int64) - 1
+        weights = cubic_bspline_weights(grid_coordinates - np.floor(grid_coordinates))
+        grid_shape = self.control_points.shape[:3]
+        positions = np.zeros(points.shape)
+        for i in range(4):
+            x_idx = np.clip(first_idx[:, 0] + i, 0, grid_shape[0] - 1)
+            for j in range(4):
+                y_idx = np.clip(first_idx[:, 1] + j, 0, grid_shape[1] - 1)
+                xy_weights = weights[:, 0, i] * weights[:, 1, j]
+                for k in range(4):
+                    z_idx = np.clip(first_idx[:, 2] + k, 0, grid_shape[2] - 1)
+                    positions += (xy_weights * weights[:, 2, k])[:, None] * self.control_points[x_idx, y_idx, z_idx]
+        return positions
+
+    def deformation_field(self, z_slice=slice(None)):
+        """
+        Compute the dense deformation field (the floating world position of each reference voxel)
+        for the planes z_slice of the reference image
+
+        :param slice z_slice: The range of planes of the reference image
+        :return: The (nx, ny, n_planes, 3) field
+        :rtype: np.ndarray
+        """
+        nx, ny, nz = self.reference_shape
+        z_range = np.arange(nz)[z_slice]
+        if self.control_points is not None and self.is_axis_aligned:
+            axes_coordinates = [np.arange(nx), np.arange(ny), z_range]
+            weight_matrices = [_bspline_matrix(coords * self.reference_to_grid[axis, axis] +
+                                               self.reference_to_grid[axis, 3], self.control_points.shape[axis])
+                               for axis, coords in enumerate(axes_coordinates)]
+            field = np.tensordot(weight_matrices[2], self.control_points, axes=(1, 2))  # k, gx, gy, c
+            field = np.tensordot(weight_matrices[1], field, axes=(1, 2))  # j, k, gx, c
+            field = np.tensordot(weight_matrices[0], field, axes=(1, 2))  # i, j, k, c
+            return field
+        grid = np.stack(np.meshgrid(np.arange(nx), np.arange(ny), z_range, indexing='ij'), axis=-1)
+        return self.transform_points(grid.reshape(-1, 3)).reshape(grid.shape)
+
+    def warp(self, floating_volume, floating_affine, interpolation_order=0, padding_value=0,
+             slab_size=16, n_workers=4, out=None):
+        """
+        Resample floating_volume into the reference space (equivalent of reg_resample).
+        The reference volume is processed in slabs of planes on a thread pool to bound the memory usage.
+
+        :param np.ndarray floating_volume: The volume to warp (e.g. the atlas)
+        :param np.ndarray floating_affine: The voxel to world matrix of floating_volume
+        :param int interpolation_order: 0 for nearest neighbour (labels), 1 for linear
+        :param padding_value: The value of the voxels mapping outside of floating_volume
+        :param int slab_size: The number of reference planes per chunk
+        :param int n_workers: The number of threads
+        :param np.ndarray out: An optional array (e.g. a memory map) of the reference shape to write to
+        :return: The warped volume (same dtype as floating_volume for nearest neighbour, float32 otherwise)
+        :rtype: np.ndarray
+        """
+        if interpolation_order not in (0, 1):
+            raise DeformationError('Unsupported interpolation order {}'.format(interpolation_order))
+        if out is None:
+            dtype = floating_volume.dtype if interpolation_order == 0 else np.float32
+            out = np.empty(self.reference_shape, dtype=dtype)
+        world_to_floating = np.linalg.inv(floating_affine)
+
+        def warp_slab(start):
+            z_slice = slice(start, min(start + slab_size, self.reference_shape[2]))
+            field = self.deformation_field(z_slice)
+            floating_voxels = _apply_affine(world_to_floating, field.reshape(-1, 3))
+            out[..., z_slice] = _sample(floating_volume, floating_voxels, interpolation_order,
+                                        padding_value).reshape(field.shape[:3])
+
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+            list(executor.map(warp_slab, range(0, self.reference_shape[2], slab_size)))
+        return out
+
+
+class CachedDeformation(Deformation):
+    """
+    A deformation backed by a dense deformation field (typically memory mapped, see materialise_deformation_field)
+    so that warping and transforming points only need array lookups.
+    """
+    def __init__(self, field, reference_affine):
+        """
+
+        :param np.ndarray field: The (nx, ny, nz, 3) floating world position of each reference voxel
+        :param np.ndarray reference_affine: The voxel to world matrix of the reference image
+        """
+        self.field = field
+        self.reference_shape = tuple(field.shape[:3])
+        self.reference_affine = np.asarray(reference_affine, dtype=np.float64)
+        self.control_points = None
+        self.affine_matrix = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.field, np.memmap) and self.field.filename:  # Reopen the memory map rather than copy it
+            state['field'] = self.field.filename
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state['field'], str):
+            state['field'] = np.load(state['field'], mmap_mode='r')
+        self.__dict__.update(state)
+
+    def deformation_field(self, z_slice=slice(None)):
+        return np.asarray(self.field[:, :, z_slice, :], dtype=np.float64)
+
+    def transform_points(self, points):
+        """
+        Transform points from reference voxel coordinates to floating world coordinates
+        by trilinear interpolation of the dense field
+
+        :param np.ndarray points: (N, 3) reference voxel coordinates (can be fractional)
+        :return: (N, 3) floating world coordinates
+        :rtype: np.ndarray
+        """
+        points = np.asarray(points, dtype=np.float64)
+        return np.stack([map_coordinates(self.field[..., axis], points.T, order=1, mode='nearest')
+                         for axis in range(3)], axis=-1)
+
+
+def _field_cache_key(reference_img_path, control_point_file_path):
+    reference_header = bio.load_nii(reference_img_path, as_array=False).header
+    return {
+        'control_point_file_sha1': hash_file(control_point_file_path),
+        'reference_shape': [int(size) for size in reference_header.get_data_shape()[:3]],
+        'reference_affine': np.round(reference_header.get_best_affine(), 6).tolist()
+    }
+
+
+def _field_metadata_path(field_path):
+    return '{}.json'.format(field_path)
+
+
+def materialise_deformation_field(reference_img_path, control_point_file_path, field_path, slab_size=16):
+    """
+    Compute the dense deformation field once and save it as a memory mappable float32 .npy file.
+    A metadata file next to it records the content hash of the control point file so that the
+    cache is invalidated when the registration is rerun (see load_cached_deformation).
+
+    :param str reference_img_path: The path to the reference (sample) image
+    :param str control_point_file_path: The control point file written by reg_f3d
+    :param str field_path: The destination of the field (.npy)
+    :param int slab_size: The number of reference planes to compute at once (bounds the memory usage)
+    :return: The memory mapped field
+    :rtype: np.memmap
+    """
+    deformation = Deformation.from_files(reference_img_path, control_point_file_path=control_point_file_path)
+    metadata_path = _field_metadata_path(field_path)
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)  # The field is invalid until completely written
+    field = np.lib.format.open_memmap(field_path, mode='w+', dtype=np.float32,
+                                      shape=deformation.reference_shape + (3,))
+    for start in range(0, deformation.reference_shape[2], slab_size):
+        z_slice = slice(start, min(start + slab_size, deformation.reference_shape[2]))
+        field[:, :, z_slice, :] = deformation.deformation_field(z_slice)
+    field.flush()
+    with open(metadata_path, 'w') as metadata_file:
+        json.dump(_field_cache_key(reference_img_path, control_point_file_path), metadata_file)
+    return np.load(field_path, mmap_mode='r')
+
+
+def load_cached_deformation(reference_img_path, control_point_file_path, field_path):
+    """
+    Load the dense deformation field saved by materialise_deformation_field if it is up to date
+    with the control point file and the reference image.
+
+    :param str reference_img_path: The path to the reference (sample) image
+    :param str control_point_file_path: The control point file written by reg_f3d
+    :param str field_path: The path of the field (.npy)
+    :return: The cached deformation or None if missing or stale
+    :rtype: CachedDeformation
+    """
+    metadata_path = _field_metadata_path(field_path)
+    if not (os.path.exists(field_path) and os.path.exists(metadata_path) and
+            os.path.exists(control_point_file_path)):
+        return None
+    with open(metadata_path, 'r') as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata != _field_cache_key(reference_img_path, control_point_file_path):
+        return None
+    reference_affine = bio.load_nii(reference_img_path, as_array=False).affine
+    return CachedDeformation(np.load(field_path, mmap_mode='r'), reference_affine)
+
+
+def _sample(volume, voxels, interpolation_order, padding_value):
+    """
+    Sample volume at the (N, 3) voxel coordinates with nearest neighbour or linear interpolation
+    """
+    shape = np.array(volume.shape[:3])
+    if interpolation_order == 0:
+        indices = np.floor(voxels + 0.5).astype(np.int64)
+        inside = np.all((indices >= 0) & (indices < shape), axis=1)
+        values = np.full(len(voxels), padding_value, dtype=volume.dtype)
+        inside_indices = indices[inside]
+        values[inside] = volume[inside_indices[:, 0], inside_indices[:, 1], inside_indices[:, 2]]
+        return values
+    else:  # Like nifty_reg, the neighbours outside of the volume contribute with the padding value
+        return map_coordinates(volume, voxels.T, order=1, mode='grid-constant', cval=padding_value,
+                               output=np.float32)
+
+
+def warp_image(floating_img_path, reference_img_path, control_point_file_path=None, affine_matrix_path=None,
+               interpolation_order=0, padding_value=0, n_workers=4):
+    """
+    Convenience function to warp an image file with the nifty_reg outputs
+
+    :param str floating_img_path: The image to warp
+    :param str reference_img_path: The reference (sample) image
+    :param str control_point_file_path: The control point file written by reg_f3d
+    :param str affine_matrix_path: The affine matrix written by reg_aladin (used without control point file)
+    :param int interpolation_order: 0 for nearest neighbour (labels), 1 for linear
+    :param padding_value: The value of the voxels mapping outside of the floating image
+    :param int n_workers: The number of threads
+    :return: The warped volume
+    :rtype: np.ndarray
+    """
+    deformation = Deformation.from_files(reference_img_path, control_point_file_path, affine_matrix_path)
+    floating_img = bio.load_nii(floating_img_path, as_array=False)
+    return deformation.warp(np.asanyarray(floating_img.dataobj), floating_img.affine,
+                            interpolation_order=interpolation_order, padding_value=padding_value,
+                            n_workers=n_workers)
@@ -0,0 +1,164 @@
+"""
+progress
+========
+
+Structured progress of the NiftyReg registrations.
+The output of reg_aladin and reg_f3d is parsed as it is produced (see amap.utils.run_command)
+into events (start and end of each pyramid level, iterations with the value of the objective function)
+with the elapsed time, and written as JSON lines next to the log of the registration.
+The summary of these files shows where the time goes and helps tune the number of pyramid levels
+(n_steps and use_n_steps in amap.conf).
+"""
+import re
+import json
+import time
+
+LEVEL_PATTERN = re.compile(r'^\[(?:NiftyReg F3D|NiftyReg ALADIN|reg_aladin(?:_sym)?)\] Current level:? (\d+) / (\d+)')
+INITIAL_OBJECTIVE_PATTERN = re.compile(r'Initial objective function: ([-+0-9.eE]+|nan|inf)')
+ITERATION_PATTERN = re.compile(r'\[(\d+)\] Current objective function: ([-+0-9.eE]+|nan|inf)')
+LEVEL_DONE_PATTERN = re.compile(r'Current registration level done')
+
+
+def get_progress_path(log_file_path):
+    """
+    Get the path of the progress file of a registration from the path of its log file
+
+    :param str log_file_path: e.g. sample_freeform.log
+    :return: e.g. sample_freeform_progress.jsonl
+    :rtype: str
+    """
+    if log_file_path.endswith('.log'):
+        log_file_path = log_file_path[:-len('.log')]
+    return '{}_progress.jsonl'.format(log_file_path)
+
+
+class ProgressRecorder(object):
+    """
+    Parse the output of a NiftyReg registration line by line and write the progress events
+    to a JSON lines file. An instance is used as the line_callback of safe_execute_command.
+
+    The events have a type ('level_start', 'iteration', 'level_end' or 'end'), the time since the
+    start of the registration and:
+        - level_start: level and n_levels
+        - iteration: level, iteration and objective
+        - level_end: level, n_levels, n_iterations, objective (the last value) and duration
+        - end: duration
+    """
+    def __init__(self, progress_path, program='', clock=time.time):
+        """
+
+        :param str progress_path: The JSON lines file to write
+        :param str program: The name of the program (e.g. 'freeform') added to the events
+        :param clock: The function giving the current time in seconds
+        """
+        self.progress_path = progress_path
+        self.program = program
+        self.clock = clock
+        self.start_time = clock()
+        self.events = []
+        self._level = None
+        self._progress_file = None
+        self._closed = False
+
+    def __enter__(self):
+        self._progress_file = open(self.progress_path, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _emit(self, event_type, **fields):
+        event = {'event': event_type, 'program': self.program, 'time': round(self.clock() - self.start_time, 3)}
+        event.update(fields)
+        self.events.append(event)
+        if self._progress_file is not None:
+            self._progress_file.write(json.dumps(event) + '\n')
+            self._progress_file.flush()
+        return event
+
+    def _end_level(self):
+        level = self._level
+        self._level = None
+        return self._emit('level_end', level=level['level'], n_levels=level['n_levels'],
+                          n_iterations=level['n_iterations'], objective=level['objective'],
+                          duration=round(self.clock() - level['start'], 3))
+
+    def __call__(self, stream_name, line):
+        """
+        Parse a line of output
+
+        :param str stream_name: 'stdout' or 'stderr'
+        :param str line:
+        :return: The event of this line if any
+        :rtype: dict
+        """
+        match = LEVEL_PATTERN.match(line)
+        if match:
+            if self._level is not None:  # reg_aladin does not report the end of the levels
+                self._end_level()
+            level, n_levels = int(match.group(1)), int(match.group(2))
+            self._level = {'level': level, 'n_levels': n_levels, 'n_iterations': 0, 'objective': None,
+                           'start': self.clock()}
+            return self._emit('level_start', level=level, n_levels=n_levels)
+        if self._level is None:
+            return None
+        match = ITERATION_PATTERN.search(line)
+        if match:
+            iteration, objective = int(match.group(1)), float(match.group(2))
+            self._level['n_iterations'] = iteration
+            self._level['objective'] = objective
+            return self._emit('iteration', level=self._level['level'], iteration=iteration, objective=objective)
+        match = INITIAL_OBJECTIVE_PATTERN.search(line)
+        if match:
+            self._level['objective'] = float(match.group(1))
+            return self._emit('iteration', level=self._level['level'], iteration=0,
+                              objective=self._level['objective'])
+        if LEVEL_DONE_PATTERN.search(line):
+            return self._end_level()
+        return None
+
+    def close(self):
+        """
+        End the current level if any and write the end event
+        """
+        if self._closed:
+            return
+        if self._level is not None:
+            self._end_level()
+        self._emit('end', duration=round(self.clock() - self.start_time, 3))
+        self._closed = True
+        if self._progress_file is not None:
+            self._progress_file.close()
+
+
+def load_progress(progress_path):
+    """
+    Load the events of a progress file
+
+    :param str progress_path:
+    :rtype: list
+    """
+    with open(progress_path, 'r') as progress_file:
+        return [json.loads(line) for line in progress_file if line.strip()]
+
+
+def summarise_progress(events):
+    """
+    Get the duration, number of iterations and final objective of each pyramid level
+
+    :param list events: The events of a registration (see load_progress)
+    :return: The 'level_end' events in level order
+    :rtype: list
+    """
+    return sorted((event for event in events if event['event'] == 'level_end'), key=lambda event: event['level'])
+
+
+def format_summary(events):
+    """
+    A human readable summary of the pyramid levels of a registration
+
+    :param list events: The events of a registration (see load_progress)
+    :rtype: str
+    """
+    return '\n'.join('Level {level} / {n_levels}: {n_iterations} iterations in {duration:.1f}s, '
+                     'objective {objective}'.format(**level) for level in summarise_progress(events))
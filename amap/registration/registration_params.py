@@ -4,7 +4,12 @@ registration_params
 
 The module to handle all the registration options and program binaries
 """
+import os
+
 from amap.config.atlas import Atlas
+from amap.registration.autotune import load_tuned_threads
+
+PROGRAM_TYPES = ('affine', 'freeform', 'segmentation')
 
 
 class RegistrationParams(object):
@@ -21,6 +26,16 @@ class RegistrationParams(object):
         self.freeform_reg_program_path = self.__get_binary('freeform')
         self.segmentation_program_path = self.__get_binary('segmentation')
 
+        # threads (0 to let OpenMP use all the cores). The autotuned values do not override the number of threads
+        # already set for the run in the environment (e.g. by amap_batch --registration-cores)
+        tuned_threads = {} if os.environ.get('OMP_NUM_THREADS') else load_tuned_threads()
+        self.n_threads = {}
+        self.cpu_affinity = {}
+        for program_type in PROGRAM_TYPES:
+            n_threads = self.config[program_type].get('n_threads', 0)
+            self.n_threads[program_type] = n_threads if n_threads else tuned_threads.get(program_type, 0)
+            self.cpu_affinity[program_type] = self.config[program_type].get('cpu_affinity', '')
+
         # affine (reg_aladin)
         self.affine_reg_pyramid_steps = ('-ln', self.config['affine']['n_steps'])
         self.affine_reg_used_pyramid_steps = ('-lp', self.config['affine']['use_n_steps'])
@@ -53,6 +68,8 @@ class RegistrationParams(object):
         self.atlas_brain_path = atlas.get_brain_path()
         self.hemispheres_path = atlas.get_hemispheres_path()
         self.atlas_mask_path = atlas.get_mask_path()
+        self.atlas_mask_cache_folder = atlas.get_mask_cache_folder()
+        self.atlas_labels_lut_path = atlas.get_labels_lut_path()
 
         pixel_sizes = atlas.get_pixel_sizes_from_config()  # WARNING: mm
         self.atlas_x_pix_size = pixel_sizes['x']
@@ -91,14 +108,18 @@ class RegistrationParams(object):
         ]
         return freeform_params
 
-    def get_segmentation_params(self):
+    def get_segmentation_params(self, interpolation_order=None):
         """
         Get the parameters (options) required for the segmentation step (propagation of transformation)
 
+        :param int interpolation_order: Overrides the default (nearest neighbour) interpolation order
         :return: The affine registration options.
         :rtype: list
         """
-        return [self.segmentation_interpolation_order, ]
+        if interpolation_order is None:
+            return [self.segmentation_interpolation_order, ]
+        else:
+            return [(self.segmentation_interpolation_order[0], interpolation_order), ]
 
     def format_param_pairs(self, params_pairs):
         """
@@ -131,14 +152,31 @@ class RegistrationParams(object):
         """
         return self.format_param_pairs(self.get_freeform_reg_params())
 
-    def format_segmentation_params(self):
+    def format_segmentation_params(self, interpolation_order=None):
         """
         Generate the string of formatted segmentation options
 
+        :param int interpolation_order: Overrides the default (nearest neighbour) interpolation order
         :return: The formatted string
         :rtype: str
         """
-        return self.format_param_pairs(self.get_segmentation_params())
+        return self.format_param_pairs(self.get_segmentation_params(interpolation_order))
+
+    def get_environment(self, program_type):
+        """
+        Get the environment to run the program with, limiting the number of OpenMP threads
+        and pinning them to cores if specified in the config
+
+        :param str program_type: One of 'affine', 'freeform' or 'segmentation'
+        :return: The environment
+        :rtype: dict
+        """
+        env = os.environ.copy()
+        if self.n_threads[program_type]:
+            env['OMP_NUM_THREADS'] = str(self.n_threads[program_type])
+        if self.cpu_affinity[program_type]:
+            env['GOMP_CPU_AFFINITY'] = self.cpu_affinity[program_type]
+        return env
 
     def __get_binary(self, program_type):
         """
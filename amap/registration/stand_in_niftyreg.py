@@ -0,0 +1,304 @@
+"""
+stand_in_niftyreg
+=================
+
+Stand-ins for the NiftyReg programs (reg_aladin, reg_f3d and reg_resample) to profile and load test
+the pipeline and the batch scheduler (I/O, scheduling, concurrency of the propagations...) on any machine,
+without the real binaries and hours of registration.
+
+They accept the options amap passes to NiftyReg and write outputs of the right shape and type:
+an identity affine matrix (reg_aladin), a control point grid of the identity transformation composed with the
+affine matrix (reg_f3d) and the floating image resampled into the reference space (all three,
+with amap.registration.deformation). They print their progress in the format of NiftyReg
+(see amap.registration.progress) and simulate a configurable CPU time and memory use.
+
+To use them, set the program_path of the affine, freeform and segmentation sections of amap.conf, e.g.::
+
+    [freeform]
+        program_path = 'amap_stand_in reg_f3d --cpu-seconds 60 --memory-mb 2000'
+
+(or 'python -m amap.registration.stand_in_niftyreg reg_f3d ...' if amap is not installed).
+The simulation options default to the environment variables AMAP_STAND_IN_<OPTION> (e.g. AMAP_STAND_IN_CPU_SECONDS)
+which can be overridden for one program with AMAP_STAND_IN_<PROGRAM>_<OPTION> (e.g. AMAP_STAND_IN_REG_F3D_CPU_SECONDS).
+The CPU time is spread over OMP_NUM_THREADS threads (all the cores by default) like the OpenMP threads of NiftyReg.
+"""
+import os
+import sys
+import time
+import hashlib
+import threading
+from argparse import ArgumentParser
+
+import numpy as np
+import nibabel as nib
+from nibabel.affines import apply_affine
+
+from amap.registration.deformation import Deformation, load_affine_matrix
+
+PROGRAMS = ('reg_aladin', 'reg_f3d', 'reg_resample')
+DEFAULT_GRID_SPACING = -5  # NiftyReg default, negative values are in voxels
+MB = 1024**2
+_BURN_BUFFER = b'\0' * MB  # hashlib releases the GIL for large buffers so the threads run in parallel
+
+
+class StandInError(Exception):
+    pass
+
+
+def get_setting(program, name, default):
+    """
+    Get the default of a simulation option from the environment
+
+    :param str program: e.g. 'reg_f3d'
+    :param str name: The name of the option (e.g. 'cpu_seconds')
+    :param default: The value if the environment does not define it
+    :return: AMAP_STAND_IN_<PROGRAM>_<NAME> or AMAP_STAND_IN_<NAME> or default
+    :rtype: str
+    """
+    for variable in ('AMAP_STAND_IN_{}_{}'.format(program, name), 'AMAP_STAND_IN_{}'.format(name)):
+        value = os.environ.get(variable.upper())
+        if value:
+            return value
+    return default
+
+
+def get_n_threads():
+    """
+    :return: The number of threads NiftyReg would use (OMP_NUM_THREADS or the number of cores)
+    :rtype: int
+    """
+    try:
+        return max(1, int(os.environ.get('OMP_NUM_THREADS', '')))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+def burn_cpu(cpu_seconds, n_threads=1):
+    """
+    Keep n_threads busy until they have used cpu_seconds of CPU time in total
+
+    :param float cpu_seconds:
+    :param int n_threads:
+    """
+    if cpu_seconds <= 0:
+        return
+    share = cpu_seconds / n_threads
+
+    def burn():
+        start = time.thread_time()
+        while time.thread_time() - start < share:
+            hashlib.sha256(_BURN_BUFFER).digest()
+
+    threads = [threading.Thread(target=burn) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def allocate_memory(memory_mb):
+    """
+    Allocate memory_mb of memory and write to every page so that it is resident
+
+    :param float memory_mb:
+    :return: The buffer to keep for as long as the memory should be used
+    :rtype: np.ndarray
+    """
+    return np.ones(int(memory_mb * MB), dtype=np.uint8)
+
+
+def parse_spacing(spacing, voxel_sizes):
+    """
+    Convert the grid spacing options of reg_f3d to a number of reference voxels along each axis
+
+    :param list spacing: The values of -sx, -sy and -sz (None if not given, in which case the value of -sx is used)
+    :param tuple voxel_sizes: The voxel sizes of the reference image in mm
+    :return: The spacing in voxels
+    :rtype: np.ndarray
+    """
+    spacing_x = spacing[0] if spacing[0] is not None else DEFAULT_GRID_SPACING
+    spacing = [s if s is not None else spacing_x for s in spacing]
+    return np.array([-s if s < 0 else s / size for s, size in zip(spacing, voxel_sizes)], dtype=np.float64)
+
+
+def make_control_points(reference_img, spacing, affine_matrix=None):
+    """
+    Create the control point grid that reg_f3d would be initialised with: control points every spacing voxels
+    of the reference image (with one extra control point before and two after the image along each axis)
+    placed at the position of the affine transformation (identity by default)
+
+    :param nib.Nifti1Image reference_img:
+    :param list spacing: The values of -sx, -sy and -sz (see parse_spacing)
+    :param np.ndarray affine_matrix: The reference to floating world matrix (see load_affine_matrix)
+    :return: The (nx, ny, nz, 1, 3) positions of the control points in the floating space and the voxel to world
+        matrix of the grid
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    reference_shape = np.array(reference_img.shape[:3])
+    spacing_voxels = parse_spacing(spacing, reference_img.header.get_zooms()[:3])
+    grid_shape = tuple(int(n) for n in np.ceil(reference_shape / spacing_voxels).astype(int) + 3)
+    grid_to_reference = np.diag(np.append(spacing_voxels, 1.))
+    grid_to_reference[:3, 3] = -spacing_voxels
+    grid_affine = reference_img.affine.dot(grid_to_reference)
+    indices = np.stack(np.meshgrid(*[np.arange(n) for n in grid_shape], indexing='ij'), axis=-1)
+    positions = apply_affine(grid_affine, indices)
+    if affine_matrix is not None:
+        positions = apply_affine(affine_matrix, positions)
+    return positions.reshape(grid_shape + (1, 3)).astype(np.float32), grid_affine
+
+
+def save_control_points(control_points, grid_affine, control_point_file_path):
+    """
+    Save the control point grid as a vector image like reg_f3d
+
+    :param np.ndarray control_points: The (nx, ny, nz, 1, 3) positions
+    :param np.ndarray grid_affine:
+    :param str control_point_file_path:
+    """
+    img = nib.Nifti1Image(control_points, grid_affine)
+    img.header.set_intent('vector')
+    nib.save(img, control_point_file_path)
+
+
+def resample(deformation, floating_img_path, dest_path, interpolation_order=1):
+    """
+    Resample the floating image into the reference space and save it (the result of -res)
+
+    :param Deformation deformation:
+    :param str floating_img_path:
+    :param str dest_path:
+    :param int interpolation_order: 0 for nearest neighbour, 1 for linear
+    """
+    floating_img = nib.load(floating_img_path)
+    warped = deformation.warp(np.asanyarray(floating_img.dataobj), floating_img.affine, interpolation_order,
+                              n_workers=get_n_threads())
+    nib.save(nib.Nifti1Image(warped, deformation.reference_affine), dest_path)
+
+
+def get_parser(program):
+    """
+    The parser of the options of program used by amap and of the simulation options
+
+    :param str program: One of PROGRAMS
+    :rtype: ArgumentParser
+    """
+    parser = ArgumentParser(prog=program, allow_abbrev=False,
+                            description='A stand-in for the NiftyReg program {} (see amap.registration.'
+                                        'stand_in_niftyreg). Unknown NiftyReg options are ignored.'.format(program))
+    parser.add_argument('-ref', dest='reference_img_path', required=True)
+    parser.add_argument('-flo', dest='floating_img_path', required=True)
+    parser.add_argument('-res', dest='result_img_path')
+    if program == 'reg_aladin':
+        parser.add_argument('-aff', dest='affine_matrix_path')
+    elif program == 'reg_f3d':
+        parser.add_argument('-aff', dest='affine_matrix_path')
+        parser.add_argument('-cpp', dest='control_point_file_path')
+        for axis in 'xyz':
+            parser.add_argument('-s{}'.format(axis), dest='spacing_{}'.format(axis), type=float)
+    else:
+        parser.add_argument('-cpp', '-trans', dest='control_point_file_path')
+        parser.add_argument('-aff', dest='affine_matrix_path')
+        parser.add_argument('-inter', dest='interpolation_order', type=int, default=1)
+    if program != 'reg_resample':
+        parser.add_argument('-ln', dest='n_levels', type=int, default=3)
+        parser.add_argument('-lp', dest='n_levels_to_perform', type=int)
+
+    parser.add_argument('--cpu-seconds', dest='cpu_seconds', type=float,
+                        default=float(get_setting(program, 'cpu_seconds', 0)),
+                        help='The CPU time to use in total (spread over the levels and the threads)')
+    parser.add_argument('--memory-mb', dest='memory_mb', type=float,
+                        default=float(get_setting(program, 'memory_mb', 0)),
+                        help='The memory to allocate for the duration of the run')
+    parser.add_argument('--exit-code', dest='exit_code', type=int,
+                        default=int(get_setting(program, 'exit_code', 0)),
+                        help='Fail with this exit code (after the simulated work) to test the error handling')
+    return parser
+
+
+def _print(line):
+    print(line, flush=True)
+
+
+def _run_levels(args, prefix, level_format, objective_lines):
+    """
+    Simulate the pyramid levels of a registration: print the progress and use the CPU time
+    """
+    n_levels = args.n_levels_to_perform or args.n_levels
+    for level in range(1, n_levels + 1):
+        _print(level_format.format(prefix, level, n_levels))
+        burn_cpu(args.cpu_seconds / n_levels, get_n_threads())
+        if objective_lines:
+            _print('{} Initial objective function: 0.5'.format(prefix))
+            _print('{} [1] Current objective function: {}'.format(prefix, 0.5 + 0.1 * level))
+            _print('{} Current registration level done'.format(prefix))
+
+
+def run_reg_aladin(args):
+    _run_levels(args, '[reg_aladin_sym]', '{} Current level {} / {}', False)
+    affine_matrix = np.eye(4)
+    if args.affine_matrix_path:
+        np.savetxt(args.affine_matrix_path, affine_matrix, fmt='%g', delimiter='\t')
+    if args.result_img_path:
+        reference_img = nib.load(args.reference_img_path)
+        deformation = Deformation(reference_img.shape, reference_img.affine, affine_matrix=affine_matrix)
+        resample(deformation, args.floating_img_path, args.result_img_path)
+
+
+def run_reg_f3d(args):
+    _run_levels(args, '[NiftyReg F3D]', '{} Current level: {} / {}', True)
+    reference_img = nib.load(args.reference_img_path)
+    affine_matrix = load_affine_matrix(args.affine_matrix_path) if args.affine_matrix_path else None
+    control_points, grid_affine = make_control_points(reference_img,
+                                                      [args.spacing_x, args.spacing_y, args.spacing_z],
+                                                      affine_matrix)
+    if args.control_point_file_path:
+        save_control_points(control_points, grid_affine, args.control_point_file_path)
+    if args.result_img_path:
+        deformation = Deformation(reference_img.shape, reference_img.affine, control_points.reshape(
+            control_points.shape[:3] + (3,)), grid_affine)
+        resample(deformation, args.floating_img_path, args.result_img_path)
+
+
+def run_reg_resample(args):
+    burn_cpu(args.cpu_seconds, get_n_threads())
+    if not args.result_img_path:
+        return
+    if args.control_point_file_path:
+        deformation = Deformation.from_files(args.reference_img_path, args.control_point_file_path)
+    else:
+        reference_img = nib.load(args.reference_img_path)
+        affine_matrix = load_affine_matrix(args.affine_matrix_path) if args.affine_matrix_path else np.eye(4)
+        deformation = Deformation(reference_img.shape, reference_img.affine, affine_matrix=affine_matrix)
+    resample(deformation, args.floating_img_path, args.result_img_path, args.interpolation_order)
+
+
+def run(program, argv):
+    """
+    Run the stand-in of program
+
+    :param str program: One of PROGRAMS
+    :param list argv: The arguments of the program
+    :return: The exit code
+    :rtype: int
+    """
+    if program not in PROGRAMS:
+        raise StandInError('Unknown program {}, expected one of {}'.format(program, PROGRAMS))
+    args, _ = get_parser(program).parse_known_args(argv)
+    _print('[{}] Stand-in for NiftyReg (amap.registration.stand_in_niftyreg)'.format(program))
+    memory = allocate_memory(args.memory_mb)
+    {'reg_aladin': run_reg_aladin, 'reg_f3d': run_reg_f3d, 'reg_resample': run_reg_resample}[program](args)
+    del memory
+    if args.exit_code:
+        print('[{}] Simulated failure'.format(program), file=sys.stderr, flush=True)
+    return args.exit_code
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in PROGRAMS:
+        sys.exit('Usage: amap_stand_in {{{}}} [NiftyReg options] [--cpu-seconds S] [--memory-mb MB] '
+                 '[--exit-code CODE]'.format(','.join(PROGRAMS)))
+    sys.exit(run(sys.argv[1], sys.argv[2:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+checkpoint
+==========
+
+A module to run a pipeline of steps (a DAG with declared inputs, outputs and parameters)
+and skip the steps whose outputs are up to date.
+After each step, a manifest records the parameters and the fingerprint (size, modification time and
+content hash) of its inputs and outputs. A step is up to date if its parameters are unchanged and all its
+files match the manifest. The cheap size and modification time check comes first and the content is only
+hashed again when the modification time changed, so that rewriting a file with the same content
+(e.g. a step rerun upstream) does not invalidate the following steps.
+Only the files written by the steps are hashed. The other inputs (e.g. a multi GB raw stack) are
+fingerprinted by their size and modification time only, so that they are never read in full.
+Folders (e.g. a sequence of raw planes) are fingerprinted by the name, size and modification time
+of their files, which are always compared.
+"""
+import os
+import json
+import hashlib
+
+from amap.utils.file_hash import hash_file
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def get_checkpoints_path(output_folder, sample_name):
+    """
+    Get the path of the checkpoints manifest of a sample in the output folder
+
+    :param str output_folder:
+    :param str sample_name:
+    :return: The path
+    :rtype: str
+    """
+    return os.path.join(output_folder, '{}_checkpoints.json'.format(sample_name))
+
+
+def hash_params(params):
+    """
+    A stable hash of the parameters of a step
+
+    :param dict params: Json serialisable parameters (other objects are converted to strings)
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _hash_folder_listing(folder_path):
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(folder_path)):
+        for file_name in sorted(files):
+            stat = os.stat(os.path.join(root, file_name))
+            digest.update('{}:{}:{};'.format(os.path.relpath(os.path.join(root, file_name), folder_path),
+                                             stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Step(object):
+    """
+    A step of a pipeline
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, depends_on=()):
+        """
+
+        :param str name: The name of the step
+        :param func: The function running the step (called without arguments)
+        :param inputs: The paths of the files (or folders) read by the step
+        :param outputs: The paths of the files (or folders) written by the step
+        :param dict params: The parameters that change the outputs of the step
+        :param depends_on: The names of the steps that must run before this one
+        """
+        self.name = name
+        self.func = func
+        self.inputs = [p for p in inputs if p]
+        self.outputs = [p for p in outputs if p]
+        self.params = params if params is not None else {}
+        self.depends_on = tuple(depends_on)
+
+
+class Pipeline(object):
+    """
+    Run steps in order, skipping those that are up to date when resuming
+    """
+    def __init__(self, steps, manifest_path):
+        """
+
+        :param list steps: The steps in a topological order (each step after the steps it depends on)
+        :param str manifest_path: The json file recording the checkpoints
+        """
+        self.steps = list(steps)
+        self.manifest_path = manifest_path
+        names = set()
+        for step in self.steps:
+            for dependency in step.depends_on:
+                if dependency not in names:
+                    raise CheckpointError('Step {} depends on {} which is not a previous step'
+                                          .format(step.name, dependency))
+            names.add(step.name)
+        self._produced_paths = {path for step in self.steps for path in step.outputs}
+        self.manifest = self.load_manifest()
+        self._hashes = {}  # (path, size, mtime) -> hash, avoids hashing a file twice in a run
+
+    @property
+    def step_names(self):
+        return [step.name for step in self.steps]
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                return json.load(manifest_file)
+        return {}
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _content_hash(self, path, stat):
+        if os.path.isdir(path):  # Cheap and the mtime of a folder does not change when its files are rewritten
+            return _hash_folder_listing(path)
+        if path not in self._produced_paths:
+            return None
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = hash_file(path)
+        return self._hashes[key]
+
+    def fingerprint(self, path):
+        """
+        The fingerprint of a file or folder
+
+        :param str path:
+        :return: The size, modification time (ns) and content hash of the path
+            (None for the files not written by a step)
+        :rtype: dict
+        """
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': self._content_hash(path, stat)}
+
+    def _matches(self, path, recorded):
+        if recorded is None or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if os.path.isdir(path):
+            return self._content_hash(path, stat) == recorded['hash']
+        if stat.st_size != recorded['size']:
+            return False
+        if stat.st_mtime_ns == recorded['mtime']:
+            return True
+        return recorded['hash'] is not None and self._content_hash(path, stat) == recorded['hash']
+
+    def is_up_to_date(self, step):
+        """
+        Whether the outputs of the step are up to date with its inputs and parameters
+
+        :param Step step:
+        :rtype: bool
+        """
+        record = self.manifest.get(step.name)
+        if record is None or record['params'] != hash_params(step.params):
+            return False
+        if sorted(record['inputs']) != sorted(step.inputs) or sorted(record['outputs']) != sorted(step.outputs):
+            return False
+        return all(self._matches(path, record['inputs'][path]) for path in step.inputs) and \
+            all(self._matches(path, record['outputs'][path]) for path in step.outputs)
+
+    def get_descendants(self, step_name):
+        """
+        Get the step and all the steps depending on it directly or indirectly
+
+        :param str step_name:
+        :rtype: set
+        """
+        if step_name not in self.step_names:
+            raise CheckpointError('Unknown step {}, expected one of {}'.format(step_name, self.step_names))
+        descendants = {step_name}
+        for step in self.steps:
+            if descendants.intersection(step.depends_on):
+                descendants.add(step.name)
+        return descendants
+
+    def run_step(self, step):
+        self.manifest.pop(step.name, None)  # A failed step must not look up to date
+        self.save_manifest()
+        step.func()
+        missing_outputs = [path for path in step.outputs if not os.path.exists(path)]
+        if missing_outputs:
+            raise CheckpointError('Step {} did not produce {}'.format(step.name, missing_outputs))
+        self.manifest[step.name] = {
+            'params': hash_params(step.params),
+            'inputs': {path: self.fingerprint(path) for path in step.inputs},
+            'outputs': {path: self.fingerprint(path) for path in step.outputs}
+        }
+        self.save_manifest()
+
+    def run(self, resume=False, force_from=None, only=None):
+        """
+        Run the steps
+
+        :param bool resume: Skip the steps that are up to date
+        :param str force_from: Always run this step and the steps depending on it
+            (the other steps are resumed)
+        :param only: The names of the steps to consider (all by default)
+        :return: The names of the steps that were run
+        :rtype: list
+        """
+        forced = self.get_descendants(force_from) if force_from else set()
+        resume = resume or bool(force_from)
+        ran = []
+        for step in self.steps:
+            if only is not None and step.name not in only:
+                continue
+            if resume and step.name not in forced and self.is_up_to_date(step):
+                print("\tSkipping {} (up to date)".format(step.name))
+                continue
+            self.run_step(step)
+            ran.append(step.name)
+        return ran
@@ -0,0 +1,17 @@
+import hashlib
+
+
+def hash_file(file_path, block_size=2**20):
+    """
+    Compute the sha1 hex digest of the content of a file, reading it by blocks
+
+    :param str file_path: The path of the file to hash
+    :param int block_size: The number of bytes to read at once
+    :return: The hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,176 @@
+"""
+hooks
+=====
+
+A registry of hooks receiving the start and end events of the stages of amap, to attach profilers or
+metrics exporters without patching amap.
+A hook is a function called with the event type ('start' or 'end'), the name of the stage and a dictionary
+of information about the stage (e.g. the plane index, the shape, the number of bytes). The end events also
+have the duration in seconds and, if the stage failed, the error.
+
+The events are emitted for each plane loaded (load_plane) and filtered (filter_plane), each volume saved
+(to_nii), each external command such as the NiftyReg binaries (command) and the instrumented stages
+(see amap.utils.instrumentation).
+When no hook is registered, the call sites skip the events (they test registered_hooks first),
+so the only cost is a truth test.
+
+Example::
+
+    def print_hook(event_type, stage, payload):
+        print(event_type, stage, payload)
+
+    with hooks.registered(print_hook):
+        process(args)
+"""
+import os
+import time
+import socket
+import cProfile
+import contextlib
+import threading
+
+registered_hooks = []
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def register(hook):
+    """
+    Register a hook
+
+    :param hook: A function called with event_type, stage and payload
+    :return: The hook (so that register can be used as a decorator)
+    """
+    registered_hooks.append(hook)
+    return hook
+
+
+def unregister(hook):
+    """
+    Unregister a hook (nothing is done if it was not registered)
+
+    :param hook:
+    """
+    if hook in registered_hooks:
+        registered_hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def registered(hook):
+    """
+    A context manager registering the hook for the duration of its body
+
+    :param hook:
+    """
+    register(hook)
+    try:
+        yield hook
+    finally:
+        unregister(hook)
+
+
+def emit(event_type, stage, **payload):
+    """
+    Call all the registered hooks with the event
+
+    :param str event_type: 'start' or 'end'
+    :param str stage: The name of the stage
+    :param payload: The information about the stage
+    """
+    for hook in list(registered_hooks):
+        hook(event_type, stage, payload)
+
+
+@contextlib.contextmanager
+def _span(stage, payload):
+    emit('start', stage, **payload)
+    start = time.time()
+    try:
+        yield payload
+    except BaseException as err:
+        payload['error'] = repr(err)
+        raise
+    finally:
+        payload['duration'] = time.time() - start
+        emit('end', stage, **payload)
+
+
+def span(stage, **payload):
+    """
+    A context manager emitting the start and end events of a stage if any hook is registered.
+    The dictionary of the payload is returned by the context manager so that information only known at the end
+    (e.g. the shape of a loaded plane) can be added to the end event.
+
+    :param str stage: The name of the stage
+    :param payload: The information about the stage
+    """
+    if not registered_hooks:
+        return _NULL_SPAN
+    return _span(stage, payload)
+
+
+class CProfileHook(object):
+    """
+    A hook profiling stages with cProfile and saving one file per call (stage_<name>_<count>.prof)
+    that can be read with pstats or snakeviz.
+    Only one stage per thread is profiled at a time, the stages nested in a profiled stage are part of its profile.
+    """
+    def __init__(self, output_folder, stage_names=None):
+        """
+
+        :param str output_folder: Where to save the profiles
+        :param stage_names: The names of the stages to profile (all by default)
+        """
+        self.output_folder = output_folder
+        self.stage_names = stage_names
+        self.counts = {}
+        self._profiles = threading.local()
+        self._lock = threading.Lock()
+
+    def __call__(self, event_type, stage, payload):
+        if self.stage_names is not None and stage not in self.stage_names:
+            return
+        current = getattr(self._profiles, 'current', None)
+        if event_type == 'start' and current is None:
+            profile = cProfile.Profile()
+            self._profiles.current = (stage, profile)
+            profile.enable()
+        elif event_type == 'end' and current is not None and current[0] == stage:
+            profile = current[1]
+            profile.disable()
+            self._profiles.current = None
+            with self._lock:
+                count = self.counts.get(stage, 0)
+                self.counts[stage] = count + 1
+            profile.dump_stats(os.path.join(self.output_folder, 'stage_{}_{}.prof'.format(stage, count)))
+
+
+class StatsdHook(object):
+    """
+    A hook sending the duration of the stages (in ms) and their number of bytes as StatsD metrics over UDP
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='amap'):
+        """
+
+        :param str host: The StatsD server
+        :param int port:
+        :param str prefix: The prefix of the metric names
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, event_type, stage, payload):
+        if event_type != 'end':
+            return
+        metrics = ['{}.{}.duration:{:.3f}|ms'.format(self.prefix, stage, payload['duration'] * 1000)]
+        if 'n_bytes' in payload:
+            metrics.append('{}.{}.bytes:{}|c'.format(self.prefix, stage, payload['n_bytes']))
+        if 'error' in payload:
+            metrics.append('{}.{}.errors:1|c'.format(self.prefix, stage))
+        try:
+            self.socket.sendto('\n'.join(metrics).encode('utf-8'), self.address)
+        except OSError:  # Metrics must never break a run
+            pass
+
+    def close(self):
+        self.socket.close()
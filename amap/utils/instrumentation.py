@@ -0,0 +1,261 @@
+"""
+instrumentation
+===============
+
+Record where a run spends its time and memory.
+The stages of the pipeline (loading, scale_z, filtering, atlas reorientation and saving,
+the NiftyReg registrations...) are wrapped with stage or the instrumented decorator.
+When a StageRecorder is enabled, each stage records its duration, CPU time, the bytes read and written
+and the peak resident memory of the process and its children (e.g. NiftyReg), and the recorder
+writes them as a json report.
+When no recorder is enabled, stage returns a shared no-op context manager so the overhead is a global lookup.
+The memory and the I/O of the children are sampled by a background thread so short peaks may be missed.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+from functools import wraps
+
+import psutil
+
+from amap.utils import hooks
+
+_recorder = None
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def get_report_path(output_folder, sample_name):
+    """
+    Get the path of the instrumentation report of a sample in the output folder
+
+    :param str output_folder:
+    :param str sample_name:
+    :return: The path
+    :rtype: str
+    """
+    return os.path.join(output_folder, '{}_report.json'.format(sample_name))
+
+
+def enable(poll_interval=0.05):
+    """
+    Start recording the stages
+
+    :param float poll_interval: The interval in seconds between two samples of the memory
+    :return: The recorder
+    :rtype: StageRecorder
+    """
+    global _recorder
+    disable()
+    _recorder = StageRecorder(poll_interval)
+    _recorder.start()
+    return _recorder
+
+
+def disable():
+    """
+    Stop recording the stages
+    """
+    global _recorder
+    if _recorder is not None:
+        _recorder.stop()
+        _recorder = None
+
+
+def get_recorder():
+    """
+    :return: The current recorder (None if disabled)
+    :rtype: StageRecorder
+    """
+    return _recorder
+
+
+def stage(name, **info):
+    """
+    A context manager recording a stage if a recorder is enabled
+
+    :param str name: The name of the stage
+    :param info: Any json serialisable information about the stage (e.g. the path of a file)
+    """
+    if _recorder is None:
+        return _NULL_STAGE
+    return _recorder.stage(name, **info)
+
+
+def instrumented(name):
+    """
+    A decorator recording each call of the function as a stage
+    (and emitting its start and end events to the hooks, see amap.utils.hooks)
+
+    :param str name: The name of the stage
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None and not hooks.registered_hooks:
+                return func(*args, **kwargs)
+            with hooks.span(name), stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Snapshot(object):
+    """
+    The cumulative counters of the process and its children at a point in time
+    """
+    def __init__(self, recorder):
+        cpu_times = recorder.process.cpu_times()
+        self.time = time.time()
+        self.cpu_time = cpu_times.user + cpu_times.system + cpu_times.children_user + cpu_times.children_system
+        try:
+            io_counters = recorder.process.io_counters()
+            read_bytes, written_bytes = io_counters.read_chars, io_counters.write_chars
+        except (AttributeError, psutil.Error):  # Not available on all platforms
+            read_bytes, written_bytes = 0, 0
+        self.read_bytes = read_bytes + recorder.children_read_bytes
+        self.written_bytes = written_bytes + recorder.children_written_bytes
+
+
+class StageRecorder(object):
+    """
+    Record the resources used by each stage. Stages can be nested and run in several threads.
+    The counters are process wide, so the stages running concurrently (e.g. the propagations)
+    each include the resources used by the others.
+    """
+    def __init__(self, poll_interval=0.05):
+        """
+
+        :param float poll_interval: The interval in seconds between two samples of the memory
+        """
+        self.poll_interval = poll_interval
+        self.process = psutil.Process()
+        self.records = []
+        self.start_time = time.time()
+        self.peak_rss = 0
+        self.children_read_bytes = 0
+        self.children_written_bytes = 0
+        self._children_io = {}  # pid -> (read, written), the last value seen for each child
+        self._open_records = []
+        self._stacks = threading.local()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample_loop, name='amap_stage_sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.poll_interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Measure the memory of the process and its children and the I/O of the children
+        """
+        try:
+            rss = self.process.memory_info().rss
+            children = self.process.children(recursive=True)
+        except psutil.Error:
+            return
+        for child in children:
+            try:
+                with child.oneshot():
+                    rss += child.memory_info().rss
+                    io_counters = child.io_counters()
+            except (psutil.Error, AttributeError):
+                continue
+            with self._lock:
+                last_read, last_written = self._children_io.get(child.pid, (0, 0))
+                self.children_read_bytes += io_counters.read_chars - last_read
+                self.children_written_bytes += io_counters.write_chars - last_written
+                self._children_io[child.pid] = (io_counters.read_chars, io_counters.write_chars)
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            for record in self._open_records:
+                record['peak_rss'] = max(record['peak_rss'], rss)
+
+    def _get_stack(self):
+        if not hasattr(self._stacks, 'names'):
+            self._stacks.names = []
+        return self._stacks.names
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """
+        Record the resources used in the body of the context manager
+
+        :param str name: The name of the stage
+        :param info: Any json serialisable information about the stage
+        """
+        stack = self._get_stack()
+        record = {'name': name, 'parent': stack[-1] if stack else None, 'thread': threading.current_thread().name,
+                  'info': info, 'peak_rss': 0}
+        with self._lock:
+            self._open_records.append(record)
+        self.sample()
+        start = _Snapshot(self)
+        stack.append(name)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            self.sample()
+            end = _Snapshot(self)
+            with self._lock:
+                self._open_records.remove(record)
+                record.update({
+                    'start': round(start.time - self.start_time, 6),
+                    'duration': end.time - start.time,
+                    'cpu_time': end.cpu_time - start.cpu_time,
+                    'read_bytes': end.read_bytes - start.read_bytes,
+                    'written_bytes': end.written_bytes - start.written_bytes
+                })
+                self.records.append(record)
+
+    def get_summary(self):
+        """
+        The total of each stage name over all its calls
+
+        :return: The count, duration, cpu_time, read_bytes, written_bytes and (maximum) peak_rss of each stage
+        :rtype: dict
+        """
+        summary = {}
+        for record in self.records:
+            stage_summary = summary.setdefault(record['name'], {'count': 0, 'duration': 0., 'cpu_time': 0.,
+                                                                 'read_bytes': 0, 'written_bytes': 0,
+                                                                 'peak_rss': 0})
+            stage_summary['count'] += 1
+            for key in ('duration', 'cpu_time', 'read_bytes', 'written_bytes'):
+                stage_summary[key] += record[key]
+            stage_summary['peak_rss'] = max(stage_summary['peak_rss'], record['peak_rss'])
+        return summary
+
+    def get_report(self):
+        """
+        :return: The records of all the stages (in order of completion), their summary and the totals of the run
+        :rtype: dict
+        """
+        return {
+            'duration': time.time() - self.start_time,
+            'peak_rss': self.peak_rss,
+            'summary': self.get_summary(),
+            'stages': sorted(self.records, key=lambda record: record['start'])
+        }
+
+    def write_report(self, report_path):
+        """
+        Write the report (see get_report) as json
+
+        :param str report_path:
+        """
+        with open(report_path, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=4, default=str)
@@ -0,0 +1,33 @@
+"""
+parallel
+========
+
+Helpers to process streams of chunks (of points, of planes...) on several processes
+without loading the whole stream in memory.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def bounded_map(func, iterable, n_processes):
+    """
+    Like ProcessPoolExecutor.map but only keeps a few chunks in flight so that streams are not
+    loaded in memory all at once. Results are yielded in order.
+
+    :param func: The function to apply to each item (must be picklable if n_processes > 1)
+    :param iterable: The items (typically chunks of data or the arguments to load them)
+    :param int n_processes: The number of processes. The items are processed in the calling process if <= 1.
+    :return: A generator of the results
+    """
+    if n_processes <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = deque()
+        for item in iterable:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= 2 * n_processes:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
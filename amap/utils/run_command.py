@@ -1,48 +1,295 @@
+"""
+run_command
+===========
+
+Run the external programs (e.g. the NiftyReg binaries) without a shell.
+The standard output and error of each program are copied line by line to the log files as they are produced
+(and optionally passed to a callback to parse them live) and the wall time, CPU time and peak resident memory
+of the program (including its children) are measured with psutil.
+The runner is based on asyncio so that several programs can run concurrently from a single thread
+(see run_commands), with timeouts and cancellation. safe_execute_command is the blocking interface.
+"""
 import os
-import subprocess
+import time
+import shlex
+import shutil
+import asyncio
 from tempfile import gettempdir
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from amap.utils import hooks
+
+STREAM_LIMIT = 2**20  # The longest line read from the programs
+
 
+class SafeExecuteCommandError(Exception):
+    pass
+
+
+class CommandTimeoutError(SafeExecuteCommandError):
+    pass
 
-def safe_execute_command(cmd, log_file_path=None, error_file_path=None):
+
+class CommandResult(object):
     """
-    Executes a command in the terminal, making sure that the output can
-    be logged even if execution fails during the call.
+    The resources used by a command that completed
+    """
+    def __init__(self, cmd, return_code, wall_time, cpu_time, peak_rss):
+        """
 
-    :param cmd:
-    :param log_file_path:
-    :param error_file_path:
-    :return:
+        :param cmd: The command
+        :param int return_code: The exit status of the program
+        :param float wall_time: The elapsed time in seconds
+        :param float cpu_time: The user and system CPU time in seconds of the program and its children
+            (sampled, so the last poll interval may be missed)
+        :param int peak_rss: The peak resident memory in bytes of the program and its children (sampled)
+        """
+        self.cmd = cmd
+        self.return_code = return_code
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss
+
+    def to_dict(self):
+        return {'cmd': self.cmd, 'return_code': self.return_code, 'wall_time': self.wall_time,
+                'cpu_time': self.cpu_time, 'peak_rss': self.peak_rss}
+
+
+def split_command(cmd):
     """
+    Split a command line into the program and its arguments (following the shell quoting rules)
+
+    :param cmd: A command line or a sequence of arguments
+    :rtype: list
+    """
+    if isinstance(cmd, str):
+        return shlex.split(cmd)
+    return [str(arg) for arg in cmd]
+
+
+def line_buffered(args):
+    """
+    Run the program with line buffered standard output and error (with stdbuf if available).
+    Programs using the C standard library (like NiftyReg) buffer their output by blocks when it is not
+    a terminal, so it would otherwise only be received when the buffer is full or the program exits.
+
+    :param list args: The program and its arguments
+    :rtype: list
+    """
+    stdbuf_path = shutil.which('stdbuf')
+    if stdbuf_path is None:
+        return args
+    return [stdbuf_path, '-oL', '-eL'] + list(args)
+
+
+def _get_default_log_paths(log_file_path, error_file_path):
     if log_file_path is None:
         log_file_path = os.path.abspath(os.path.join(gettempdir(), 'safe_execute_command.log'))
     if error_file_path is None:
         error_file_path = os.path.abspath(os.path.join(gettempdir(), 'safe_execute_command.err'))
+    return log_file_path, error_file_path
 
-    with open(log_file_path, 'w') as log_file, open(error_file_path, 'w') as error_file:
+
+def _format_failure(cmd, log_file_path, error_file_path, reason='Process failed'):
+    hline = '-'*25
+    try:
+        with open(error_file_path, 'r') as err_file:
+            errors = ''.join(err_file.readlines())
+        with open(log_file_path, 'r') as _log_file:
+            logs = ''.join(_log_file.readlines())
+    except IOError as err:
+        return "{}: please read the logs at {} and {}; command: {}; err: {}".\
+            format(reason, log_file_path, error_file_path, cmd, err)
+    return ("\n{0}\n{6}:\n {1}"
+            "{0}\n"
+            "{2}\n"
+            "{0}\n"
+            "please read the logs at {3} and {4}\n"
+            "{0}\n"
+            "command: {5}\n"
+            "{0}".format(hline, errors, logs, log_file_path, error_file_path, cmd, reason))
+
+
+async def _tee(stream, out_file, stream_name, line_callback):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        line = line.decode('utf-8', errors='replace')
+        out_file.write(line)
+        out_file.flush()  # So that the logs can be followed while the program runs
+        if line_callback is not None:
+            line_callback(stream_name, line)
+
+
+class _ResourceMonitor(object):
+    """
+    Sample the CPU time and resident memory of a process tree
+    """
+    def __init__(self, pid):
+        try:
+            self.process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            self.process = None
+        self.cpu_times = {}  # per pid, so that the time of the children that exited is kept
+        self.peak_rss = 0
+
+    @property
+    def cpu_time(self):
+        return sum(self.cpu_times.values())
+
+    def sample(self):
+        if self.process is None:
+            return
         try:
-            subprocess.check_call(cmd, stdout=log_file, stderr=error_file, shell=True)
-        except subprocess.CalledProcessError:
-            hline = '-'*25
+            processes = [self.process] + self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        rss = 0
+        for process in processes:
             try:
-                with open(error_file_path, 'r') as err_file:
-                    errors = err_file.readlines()
-                    errors = ''.join(errors)
-                with open(log_file_path, 'r') as _log_file:
-                    logs = _log_file.readlines()
-                    logs = ''.join(logs)
-                raise SafeExecuteCommandError("\n{0}\nProcess failed:\n {1}"
-                                              "{0}\n"
-                                              "{2}\n"
-                                              "{0}\n"
-                                              "please read the logs at {3} and {4}\n"
-                                              "{0}\n"
-                                              "command: {5}\n"
-                                              "{0}".
-                                              format(hline, errors, logs, log_file_path, error_file_path, cmd))
-            except IOError as err:
-                raise SafeExecuteCommandError("Process failed: please read the logs at {} and {}; command: {}; err: {}".
-                                              format(log_file_path, error_file_path, cmd, err))
+                with process.oneshot():
+                    cpu_times = process.cpu_times()
+                    rss += process.memory_info().rss
+                self.cpu_times[process.pid] = cpu_times.user + cpu_times.system
+            except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
 
+    async def run(self, poll_interval):
+        while True:
+            self.sample()
+            await asyncio.sleep(poll_interval)
 
-class SafeExecuteCommandError(Exception):
-    pass
+
+async def _wait_for_exit(process, output_tasks):
+    await asyncio.shield(output_tasks)  # Still read if the wait is cancelled, until the program is killed
+    return await process.wait()
+
+
+def _kill(process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def run_command_async(cmd, log_file_path=None, error_file_path=None, env=None, timeout=None,
+                            line_callback=None, poll_interval=0.1):
+    """
+    Run a command without a shell, copying its output to the log files as it is produced.
+    The start and end of the command are emitted to the hooks (stage 'command', see amap.utils.hooks)
+    with the resources used.
+
+    :param cmd: The command line (split with shlex) or a sequence of arguments
+    :param str log_file_path: The file receiving the standard output
+    :param str error_file_path: The file receiving the standard error
+    :param dict env: The environment of the command (defaults to the environment of the current process)
+    :param float timeout: The maximum duration in seconds (None for no limit)
+    :param line_callback: A function called with the stream name ('stdout' or 'stderr') and each line of output.
+        The output of the program is then line buffered (see line_buffered) so that the lines are received live
+    :param float poll_interval: The interval in seconds between two measurements of the resources
+    :return: The resources used by the command
+    :rtype: CommandResult
+    :raises SafeExecuteCommandError: If the program could not be started or returned a non zero status
+    :raises CommandTimeoutError: If the program did not complete within timeout (it is killed)
+    """
+    log_file_path, error_file_path = _get_default_log_paths(log_file_path, error_file_path)
+    with hooks.span('command', cmd=cmd, log_file_path=log_file_path) as hook_payload:
+        result = await _run_command(cmd, log_file_path, error_file_path, env, timeout, line_callback, poll_interval)
+        if hook_payload is not None:
+            hook_payload.update(result.to_dict())
+    return result
+
+
+async def _run_command(cmd, log_file_path, error_file_path, env, timeout, line_callback, poll_interval):
+    args = split_command(cmd)
+    if line_callback is not None:
+        args = line_buffered(args)
+    with open(log_file_path, 'w') as log_file, open(error_file_path, 'w') as error_file:
+        start = time.time()
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE, env=env,
+                                                           limit=STREAM_LIMIT)
+        except OSError as err:
+            raise SafeExecuteCommandError('Could not start {}: {}'.format(cmd, err))
+        monitor = _ResourceMonitor(process.pid)
+        monitor_task = asyncio.ensure_future(monitor.run(poll_interval))
+        output_tasks = asyncio.gather(_tee(process.stdout, log_file, 'stdout', line_callback),
+                                      _tee(process.stderr, error_file, 'stderr', line_callback))
+        try:
+            # A single timeout for the output and the exit, the program may close its output and keep running
+            return_code = await asyncio.wait_for(_wait_for_exit(process, output_tasks), timeout)
+        except asyncio.TimeoutError:
+            _kill(process)
+            await process.wait()
+            timed_out = True
+        except BaseException:  # Cancelled (or interrupted), do not leave the program running
+            _kill(process)
+            await process.wait()
+            raise
+        else:
+            timed_out = False
+        finally:
+            monitor_task.cancel()
+            await asyncio.gather(output_tasks, return_exceptions=True)  # The pipes are closed once the program exited
+        wall_time = time.time() - start
+    if timed_out:
+        raise CommandTimeoutError(_format_failure(cmd, log_file_path, error_file_path,
+                                                  'Process timed out after {}s'.format(timeout)))
+    if return_code != 0:
+        raise SafeExecuteCommandError(_format_failure(cmd, log_file_path, error_file_path))
+    return CommandResult(cmd, return_code, wall_time, monitor.cpu_time, monitor.peak_rss)
+
+
+async def run_commands(commands, max_concurrent=None):
+    """
+    Run several commands concurrently
+
+    :param list commands: The keyword arguments of run_command_async for each command
+    :param int max_concurrent: The maximum number of commands running at the same time (None for no limit)
+    :return: The CommandResult of each command, or the exception it raised
+    :rtype: list
+    """
+    semaphore = asyncio.Semaphore(max_concurrent if max_concurrent else max(1, len(commands)))
+
+    async def run(kwargs):
+        async with semaphore:
+            return await run_command_async(**kwargs)
+    return await asyncio.gather(*(run(kwargs) for kwargs in commands), return_exceptions=True)
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine to completion from synchronous code, including from a thread
+    that already runs an event loop (e.g. a notebook)
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def safe_execute_command(cmd, log_file_path=None, error_file_path=None, env=None, timeout=None,
+                         line_callback=None):
+    """
+    Executes a command (without a shell), making sure that the output can
+    be logged even if execution fails during the call.
+
+    :param cmd:
+    :param log_file_path:
+    :param error_file_path:
+    :param dict env: The environment of the command (defaults to the environment of the current process)
+    :param float timeout: The maximum duration in seconds (None for no limit)
+    :param line_callback: A function called with the stream name and each line of output (see run_command_async)
+    :return: The resources used by the command
+    :rtype: CommandResult
+    """
+    return run_sync(run_command_async(cmd, log_file_path, error_file_path, env=env, timeout=timeout,
+                                      line_callback=line_callback))
@@ -0,0 +1,250 @@
+"""
+run_benchmarks
+==============
+
+Benchmark the main stages of amap on a synthetic brain (see benchmarks.synthetic_brain):
+loading (load_from_paths_sequence and load_any for the chosen layout), scale_z, filter_for_registration,
+to_nii and generate_outlines.
+Each stage is timed over several repeats and its peak memory measured with tracemalloc in a separate run
+(numpy allocations are traced) so that tracing does not affect the timings.
+The results can be saved as json and compared to a saved baseline to catch regressions locally::
+
+    python -m benchmarks.run_benchmarks --shape 512 512 100 --output baseline.json
+    # change the code
+    python -m benchmarks.run_benchmarks --shape 512 512 100 --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import numpy as np
+
+from amap.brain import brain_io as bio
+from amap.brain.brain_processor import BrainProcessor
+from amap.registration.brain_registration import generate_outlines
+from benchmarks.synthetic_brain import SyntheticBrain, make_synthetic_atlas, LAYOUTS
+
+MB = 1024**2
+
+
+class Benchmark(object):
+    """
+    A stage to benchmark
+    """
+    def __init__(self, name, run, setup=None, n_bytes=0, n_planes=0):
+        """
+
+        :param str name: The name of the benchmark
+        :param run: The function to time, called with the result of setup
+        :param setup: A function called before each run and not timed (e.g. to copy the input)
+        :param int n_bytes: The number of bytes processed by a run (to compute the throughput)
+        :param int n_planes: The number of planes processed by a run
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup if setup is not None else (lambda: None)
+        self.n_bytes = n_bytes
+        self.n_planes = n_planes
+
+    def time_once(self):
+        args = self.setup()
+        start = time.perf_counter()
+        self.run(args)
+        return time.perf_counter() - start
+
+    def measure_peak_memory(self):
+        """
+        :return: The peak memory allocated during a run in bytes (relative to the start of the run)
+        :rtype: int
+        """
+        args = self.setup()
+        tracemalloc.start()
+        try:
+            self.run(args)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def measure(self, n_repeats=3):
+        """
+        Run the benchmark
+
+        :param int n_repeats: The number of timed runs
+        :return: The times, the best and median time, the throughput and the peak memory
+        :rtype: dict
+        """
+        self.time_once()  # Warm up (imports, file system cache)
+        times = [self.time_once() for _ in range(n_repeats)]
+        best = min(times)
+        return {
+            'times': times,
+            'best': best,
+            'median': float(np.median(times)),
+            'throughput_mb_s': self.n_bytes / MB / best if best > 0 else None,
+            'planes_per_s': self.n_planes / best if best > 0 else None,
+            'peak_memory_mb': self.measure_peak_memory() / MB
+        }
+
+
+def get_benchmarks(brain, work_dir, layout='planes'):
+    """
+    Create the benchmarks of the stages for a synthetic brain. The inputs are written to work_dir.
+
+    :param SyntheticBrain brain:
+    :param str work_dir: A temporary folder
+    :param str layout: The layout of the brain for load_any (see SyntheticBrain.write)
+    :return: The benchmarks
+    :rtype: list
+    """
+    n_bytes, n_planes = brain.nbytes, brain.shape[2]
+    planes_file_path = brain.write(os.path.join(work_dir, 'planes'), 'planes')
+    plane_paths = bio.get_plane_paths(planes_file_path)
+    layout_path = planes_file_path if layout == 'planes' else brain.write(os.path.join(work_dir, layout), layout)
+    volume = brain.get_volume()
+
+    atlas_path = os.path.join(work_dir, 'registered_atlas.nii')
+    atlas = make_synthetic_atlas(brain.shape, seed=brain.seed)
+    bio.to_nii(atlas, atlas_path)
+
+    return [
+        Benchmark('load_from_paths_sequence', lambda _: bio.load_from_paths_sequence(plane_paths),
+                  n_bytes=n_bytes, n_planes=n_planes),
+        Benchmark('load_any_{}'.format(layout), lambda _: bio.load_any(layout_path),
+                  n_bytes=n_bytes, n_planes=n_planes),
+        Benchmark('scale_z', lambda _: bio.scale_z(volume, 0.5), n_bytes=n_bytes, n_planes=n_planes),
+        Benchmark('filter_for_registration', BrainProcessor.filter_for_registration, setup=volume.copy,
+                  n_bytes=n_bytes, n_planes=n_planes),
+        Benchmark('to_nii', lambda _: bio.to_nii(volume, os.path.join(work_dir, 'to_nii.nii')),
+                  n_bytes=n_bytes, n_planes=n_planes),
+        Benchmark('generate_outlines',
+                  lambda _: generate_outlines(atlas_path, os.path.join(work_dir, 'outlines.nii')),
+                  n_bytes=atlas.nbytes, n_planes=n_planes)
+    ]
+
+
+def run_benchmarks(benchmarks, n_repeats=3, only=None):
+    """
+    Run the benchmarks. The failure of a benchmark is recorded and does not stop the others.
+
+    :param list benchmarks:
+    :param int n_repeats: The number of timed runs of each benchmark
+    :param only: The names of the benchmarks to run (all by default)
+    :return: The results of each benchmark
+    :rtype: dict
+    """
+    results = {}
+    for benchmark in benchmarks:
+        if only and benchmark.name not in only:
+            continue
+        try:
+            results[benchmark.name] = benchmark.measure(n_repeats)
+        except Exception as err:
+            results[benchmark.name] = {'error': '{}: {}'.format(type(err).__name__, err)}
+    return results
+
+
+def compare(results, baseline, time_tolerance=0.1, memory_tolerance=0.1):
+    """
+    Compare results to a baseline
+
+    :param dict results: The results of run_benchmarks
+    :param dict baseline: The results of a previous run
+    :param float time_tolerance: The relative increase of the best time considered a regression
+    :param float memory_tolerance: The relative increase of the peak memory considered a regression
+    :return: The time and memory ratios (current / baseline) of each benchmark in both and whether it regressed
+    :rtype: dict
+    """
+    comparison = {}
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None or 'error' in result or 'error' in reference:
+            continue
+        time_ratio = result['best'] / reference['best'] if reference['best'] else float('inf')
+        memory_ratio = (result['peak_memory_mb'] / reference['peak_memory_mb']
+                        if reference['peak_memory_mb'] else 1.)
+        comparison[name] = {
+            'time_ratio': time_ratio,
+            'memory_ratio': memory_ratio,
+            'regression': time_ratio > 1 + time_tolerance or memory_ratio > 1 + memory_tolerance
+        }
+    return comparison
+
+
+def format_results(results, comparison=None):
+    lines = ['{:<28}{:>10}{:>10}{:>12}{:>12}{:>12}'.format('benchmark', 'best (s)', 'MB/s', 'planes/s',
+                                                          'peak (MB)', 'vs base')]
+    for name, result in results.items():
+        if 'error' in result:
+            lines.append('{:<28}{}'.format(name, result['error']))
+            continue
+        versus = ''
+        if comparison and name in comparison:
+            versus = '{:.2f}x{}'.format(comparison[name]['time_ratio'],
+                                        ' !' if comparison[name]['regression'] else '')
+        lines.append('{:<28}{:>10.3f}{:>10.1f}{:>12.1f}{:>12.1f}{:>12}'.format(
+            name, result['best'], result['throughput_mb_s'], result['planes_per_s'], result['peak_memory_mb'], versus))
+    return '\n'.join(lines)
+
+
+def get_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='Benchmark the stages of amap on a synthetic brain')
+    parser.add_argument('--shape', type=int, nargs=3, default=(512, 512, 64), metavar=('X', 'Y', 'N_PLANES'),
+                        help='The shape of the synthetic brain')
+    parser.add_argument('--dtype', type=str, default='uint16', help='The data type of the synthetic brain')
+    parser.add_argument('--layout', type=str, choices=LAYOUTS, default='stack',
+                        help='The layout of the brain on disk for the load_any benchmark')
+    parser.add_argument('--n-blobs', dest='n_blobs', type=int, default=200, help='The number of blobs in the brain')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the synthetic brain')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of timed runs of each benchmark')
+    parser.add_argument('--only', type=str, nargs='+', help='The names of the benchmarks to run')
+    parser.add_argument('--work-dir', dest='work_dir', type=str,
+                        help='Where to write the inputs (a temporary folder removed at the end by default)')
+    parser.add_argument('--output', type=str, help='Save the results as json (e.g. to use as a baseline)')
+    parser.add_argument('--baseline', type=str, help='Compare to the results saved in this json file')
+    parser.add_argument('--time-tolerance', dest='time_tolerance', type=float, default=0.1,
+                        help='The relative slow down considered a regression')
+    parser.add_argument('--memory-tolerance', dest='memory_tolerance', type=float, default=0.1,
+                        help='The relative increase of the peak memory considered a regression')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    config = {'shape': list(args.shape), 'dtype': args.dtype, 'layout': args.layout, 'n_blobs': args.n_blobs,
+              'seed': args.seed, 'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'n_cpus': os.cpu_count()}
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix='amap_benchmarks_')
+    try:
+        brain = SyntheticBrain(args.shape, args.dtype, n_blobs=args.n_blobs, seed=args.seed)
+        results = run_benchmarks(get_benchmarks(brain, work_dir, args.layout), args.repeat, args.only)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['config']['shape'] != config['shape'] or baseline['config']['dtype'] != config['dtype']:
+            print('Warning: the baseline was run on a different brain ({})'.format(baseline['config']),
+                  file=sys.stderr)
+        comparison = compare(results, baseline['results'], args.time_tolerance, args.memory_tolerance)
+    print(format_results(results, comparison))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'config': config, 'results': results, 'comparison': comparison}, output_file, indent=4)
+    if comparison and any(c['regression'] for c in comparison.values()):
+        print('Regressions: {}'.format(', '.join(name for name, c in comparison.items() if c['regression'])),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
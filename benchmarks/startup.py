@@ -0,0 +1,87 @@
+"""
+startup
+=======
+
+Time the start of the command line programs of amap (e.g. amap --help), which should not import the
+heavy dependencies (numpy, scipy, skimage, nibabel...) nor read the config until they are needed.
+The time of the bare interpreter is reported too, the difference being the overhead of amap::
+
+    python -m benchmarks.startup --max-time 0.2
+
+The script exits with an error if the best time of amap --help is above --max-time.
+With -X importtime, python lists the time spent importing each module to find the culprit of a regression::
+
+    python -X importtime -m amap.main --help 2> import_times.txt
+"""
+import sys
+import time
+import subprocess
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from statistics import median
+
+COMMANDS = {
+    'python': ['-c', 'pass'],
+    'amap --help': ['-m', 'amap.main', '--help'],
+    'amap_batch --help': ['-m', 'amap.batch', '--help']
+}
+HEAVY_MODULES = ('numpy', 'scipy', 'skimage', 'nibabel', 'tifffile', 'psutil', 'configobj', 'pkg_resources')
+
+
+def time_command(args, n_repeats=10):
+    """
+    Time a python command in a new interpreter
+
+    :param list args: The arguments of the interpreter (e.g. ['-m', 'amap.main', '--help'])
+    :param int n_repeats: The number of runs
+    :return: The wall time of each run in seconds
+    :rtype: list
+    """
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def get_imported_heavy_modules(module_name):
+    """
+    Get the heavy dependencies imported by a module (in a new interpreter)
+
+    :param str module_name: e.g. 'amap.main'
+    :return: The modules of HEAVY_MODULES that were imported
+    :rtype: list
+    """
+    code = 'import sys, {0}; print(" ".join(m for m in {1} if m in sys.modules))'.format(module_name, HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True).stdout
+    return output.decode().split()
+
+
+def get_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description='Time the start of the command line programs of amap')
+    parser.add_argument('--repeat', type=int, default=10, help='The number of runs of each command')
+    parser.add_argument('--max-time', dest='max_time', type=float, default=0.2,
+                        help='The maximum best time of amap --help in seconds')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {name: time_command(command, args.repeat) for name, command in COMMANDS.items()}
+    print('{:<20}{:>10}{:>12}{:>14}'.format('command', 'best (ms)', 'median (ms)', 'overhead (ms)'))
+    for name, times in results.items():
+        print('{:<20}{:>10.1f}{:>12.1f}{:>14.1f}'.format(name, min(times) * 1000, median(times) * 1000,
+                                                        (min(times) - min(results['python'])) * 1000))
+    heavy_modules = get_imported_heavy_modules('amap.main')
+    if heavy_modules:
+        print('amap.main imports {}'.format(', '.join(heavy_modules)), file=sys.stderr)
+    if min(results['amap --help']) > args.max_time:
+        print('amap --help took {:.3f}s (maximum {}s)'.format(min(results['amap --help']), args.max_time),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+synthetic_brain
+===============
+
+A deterministic generator of synthetic brains and atlases for the benchmarks.
+The brain is an ellipsoid of tissue with gaussian blobs (cells, structures) and noise,
+and the atlas a partition of the same ellipsoid into regions (nearest random seed).
+They are generated plane by plane so that large volumes can be written without holding them in memory.
+"""
+import os
+
+import numpy as np
+import tifffile
+from scipy.spatial import cKDTree
+
+from amap.brain import brain_io as bio
+
+LAYOUTS = ('planes', 'stack', 'nii')
+
+
+def _ellipsoid_distance(shape, z):
+    """
+    The normalised distance to the centre of the ellipsoid inscribed in the volume for the plane z
+    """
+    x, y = np.ogrid[:shape[0], :shape[1]]
+    centre = [(s - 1) / 2. for s in shape]
+    return np.sqrt(((x - centre[0]) / (shape[0] / 2.)) ** 2 +
+                   ((y - centre[1]) / (shape[1] / 2.)) ** 2 +
+                   ((z - centre[2]) / (shape[2] / 2.)) ** 2)
+
+
+class SyntheticBrain(object):
+    """
+    A synthetic brain defined by its shape and a random seed
+    """
+    def __init__(self, shape=(512, 512, 64), dtype='uint16', n_blobs=200, blob_radius=6., noise_std=0.05, seed=0):
+        """
+
+        :param tuple shape: The shape of the volume (x, y, number of planes)
+        :param str dtype: The data type of the volume (integer types use their full range)
+        :param int n_blobs: The number of gaussian blobs
+        :param float blob_radius: The mean standard deviation of the blobs in voxels
+        :param float noise_std: The standard deviation of the noise relative to the maximum intensity
+        :param int seed: The seed of the random generator
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.noise_std = noise_std
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self.blob_centres = rng.uniform(0.2, 0.8, size=(n_blobs, 3)) * self.shape
+        self.blob_sigmas = rng.uniform(0.5, 1.5, size=n_blobs) * blob_radius
+        self.blob_intensities = rng.uniform(0.3, 1., size=n_blobs)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def get_plane(self, z):
+        """
+        Generate a plane of the brain
+
+        :param int z: The index of the plane
+        :rtype: np.ndarray
+        """
+        distance = _ellipsoid_distance(self.shape, z)
+        plane = np.where(distance < 1, 0.3 * (1 - distance ** 2), 0.)
+        x, y = np.ogrid[:self.shape[0], :self.shape[1]]
+        for centre, sigma, intensity in zip(self.blob_centres, self.blob_sigmas, self.blob_intensities):
+            dz = z - centre[2]
+            if abs(dz) > 3 * sigma:
+                continue
+            x_start, x_stop = (max(int(centre[0] - 3 * sigma), 0), min(int(centre[0] + 3 * sigma) + 1, self.shape[0]))
+            y_start, y_stop = (max(int(centre[1] - 3 * sigma), 0), min(int(centre[1] + 3 * sigma) + 1, self.shape[1]))
+            plane[x_start:x_stop, y_start:y_stop] += intensity * np.exp(
+                -((x[x_start:x_stop] - centre[0]) ** 2 + (y[:, y_start:y_stop] - centre[1]) ** 2 + dz ** 2) /
+                (2 * sigma ** 2))
+        rng = np.random.RandomState(self.seed * 100003 + z + 1)  # Each plane can be generated independently
+        plane += rng.normal(0, self.noise_std, size=plane.shape)
+        plane = np.clip(plane, 0, 1)
+        if np.issubdtype(self.dtype, np.integer):
+            plane = plane * np.iinfo(self.dtype).max
+        return plane.astype(self.dtype)
+
+    def get_volume(self):
+        """
+        :return: The whole brain
+        :rtype: np.ndarray
+        """
+        volume = np.empty(self.shape, dtype=self.dtype)
+        for z in range(self.shape[2]):
+            volume[:, :, z] = self.get_plane(z)
+        return volume
+
+    def write(self, dest_folder, layout='planes'):
+        """
+        Write the brain in one of the layouts read by amap
+
+        :param str dest_folder: The folder to write to (created if needed)
+        :param str layout: 'planes' (one tiff per plane and a text file listing them),
+            'stack' (a multi page tiff) or 'nii'
+        :return: The path to give to amap (the text file of the planes, the tiff stack or the nifty image)
+        :rtype: str
+        """
+        if layout not in LAYOUTS:
+            raise ValueError('Unknown layout {}, expected one of {}'.format(layout, LAYOUTS))
+        if not os.path.exists(dest_folder):
+            os.makedirs(dest_folder)
+        if layout == 'planes':
+            plane_paths = []
+            for z in range(self.shape[2]):
+                plane_paths.append(os.path.join(dest_folder, 'plane_{:05d}.tif'.format(z)))
+                tifffile.imsave(plane_paths[-1], self.get_plane(z))
+            paths_file_path = os.path.join(dest_folder, 'planes.txt')
+            with open(paths_file_path, 'w') as paths_file:
+                paths_file.write('\n'.join(plane_paths))
+            return paths_file_path
+        elif layout == 'stack':
+            stack_path = os.path.join(dest_folder, 'brain.tif')
+            with tifffile.TiffWriter(stack_path, bigtiff=self.nbytes > 2**31) as stack:
+                for z in range(self.shape[2]):  # Read back as (planes, x, y) by load_img_stack
+                    stack.save(self.get_plane(z))
+            return stack_path
+        else:
+            nii_path = os.path.join(dest_folder, 'brain.nii')
+            bio.to_nii(self.get_volume(), nii_path)
+            return nii_path
+
+
+def make_synthetic_atlas(shape=(256, 256, 64), n_regions=50, seed=0, dtype='uint32'):
+    """
+    A synthetic annotation volume: the ellipsoid of the brain split into regions around random seeds,
+    with large region IDs like those of the Allen atlas and 0 outside the brain
+
+    :param tuple shape: The shape of the volume
+    :param int n_regions: The number of regions
+    :param int seed: The seed of the random generator
+    :param str dtype: The data type of the labels
+    :rtype: np.ndarray
+    """
+    rng = np.random.RandomState(seed)
+    seeds = rng.uniform(0.15, 0.85, size=(n_regions, 3)) * shape
+    region_ids = np.cumsum(rng.randint(1, np.iinfo(np.int32).max // n_regions, size=n_regions)).astype(dtype)
+    tree = cKDTree(seeds)
+    atlas = np.zeros(shape, dtype=dtype)
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    for z in range(shape[2]):
+        inside = _ellipsoid_distance(shape, z) < 1
+        coordinates = np.column_stack((x[inside], y[inside], np.full(inside.sum(), z)))
+        if len(coordinates):
+            atlas[:, :, z][inside] = region_ids[tree.query(coordinates)[1]]
+    return atlas
@@ -126,7 +126,7 @@ if args.install_atlas:
 setup(
     name='amap',
     version='1.2.0',
-    packages=find_packages(exclude=('doc', 'tests*')),
+    packages=find_packages(exclude=('doc', 'tests*', 'benchmarks*')),
     install_requires=requirements,
     url='',
     license='',
@@ -146,7 +146,11 @@ setup(
     zip_safe=False,
     entry_points={
         'console_scripts': [
-            'amap = amap.main:main'
+            'amap = amap.main:main',
+            'amap_batch = amap.batch:main',
+            'amap_autotune = amap.registration.autotune:main',
+            'amap_label_server = amap.analysis.label_lookup:main',
+            'amap_stand_in = amap.registration.stand_in_niftyreg:main'
         ]
     }
 )
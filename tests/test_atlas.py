@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from amap.config import atlas as atlas_module
+from amap.config.config import config_obj
+
+
+@pytest.fixture()
+def sparse_labels():
+    ids = np.array([0, 997, 614454277, 1009, 8], dtype=np.uint32)
+    rng = np.random.RandomState(0)
+    return ids[rng.randint(0, ids.size, size=(6, 5, 7))]
+
+
+def test_compact_labels(sparse_labels):
+    index_volume, lut = atlas_module.compact_labels(sparse_labels, slab_size=3)
+    assert index_volume.dtype == np.uint16
+    assert index_volume.shape == sparse_labels.shape
+    assert (lut == np.unique(sparse_labels)).all()
+    assert (atlas_module.expand_labels(index_volume, lut) == sparse_labels).all()
+
+
+def test_compact_labels_too_many_labels():
+    labels = np.arange(2**16 + 1, dtype=np.uint32).reshape(1, 1, -1)
+    with pytest.raises(atlas_module.AtlasError):
+        atlas_module.compact_labels(labels)
+
+
+def test_block_average():
+    volume = np.arange(5 * 4 * 6, dtype=np.uint16).reshape(5, 4, 6)
+    downsampled = atlas_module.block_average(volume, 2, slab_size=2)
+    assert downsampled.shape == (2, 2, 3)
+    assert downsampled.dtype == np.float32
+    assert downsampled[0, 0, 0] == pytest.approx(volume[:2, :2, :2].mean())
+    assert downsampled[1, 1, 2] == pytest.approx(volume[2:4, 2:4, 4:6].mean())
+
+
+def test_downsample_labels(sparse_labels):
+    downsampled = atlas_module.downsample_labels(sparse_labels, 2)
+    assert downsampled.shape == atlas_module.block_average(sparse_labels, 2).shape
+    assert downsampled.dtype == sparse_labels.dtype
+    assert set(np.unique(downsampled)) <= set(np.unique(sparse_labels))
+    block = sparse_labels[2:4, 0:2, 4:6]
+    values, counts = np.unique(block, return_counts=True)
+    assert downsampled[1, 0, 2] == values[counts.argmax()]  # The most frequent label of the block
+    assert (atlas_module.downsample_labels(sparse_labels, 3) == sparse_labels[1::3, 1:3:3, 1::3]).all()
+
+
+@pytest.mark.parametrize('factor', [2, 3])
+def test_pyramid_labels_aligned_with_brain(tmpdir, monkeypatch, factor):
+    affine = np.diag([0.01, 0.01, 0.01, 1])
+    affine[:3, 3] = [1, 2, 3]
+    # An oblique boundary so that the blocks it crosses are not split in equal halves
+    world_sum = nib.affines.apply_affine(affine, np.indices((8, 6, 12)).transpose(1, 2, 3, 0)).sum(axis=-1)
+    threshold = 6.088  # Between the block centres for both factors
+    labels = np.where(world_sum >= threshold, 997, 8).astype(np.uint32)
+    hemispheres = np.where(world_sum >= threshold, 2, 1).astype(np.uint8)
+    atlas_conf = config_obj['atlas']
+    for element_name, data in (('atlas', labels), ('brain', world_sum.astype(np.float32)),
+                               ('hemispheres', hemispheres)):
+        nib.save(nib.Nifti1Image(data, affine), str(tmpdir.join(atlas_conf['default_{}_name'.format(element_name)])))
+    monkeypatch.setitem(atlas_conf, 'base_folder', str(tmpdir))
+
+    atlas = atlas_module.Atlas(downsampling_factor=factor)
+    atlas.load_all()
+    atlas_img, brain_img = atlas.get_data(), atlas.get_brain_data()
+    np.testing.assert_allclose(atlas_img.affine, brain_img.affine)
+    level_world_sum = nib.affines.apply_affine(atlas_img.affine,
+                                               np.indices(atlas_img.shape).transpose(1, 2, 3, 0)).sum(axis=-1)
+    # The brain voxels (block averages) are at the world coordinates given by the affine ...
+    np.testing.assert_allclose(brain_img.get_data(), level_world_sum, rtol=1e-6)
+    # ... and so are the label voxels
+    assert (atlas_img.get_data() == np.where(level_world_sum >= threshold, 997, 8)).all()
+    assert (atlas.get_hemispheres_data().get_data() == np.where(level_world_sum >= threshold, 2, 1)).all()
+
+
+def test_pack_labels(sparse_labels):
+    hemispheres = (np.arange(sparse_labels.size).reshape(sparse_labels.shape) % 3).astype(np.uint8)
+    packed, lut = atlas_module.pack_labels(sparse_labels, hemispheres, slab_size=2)
+    assert packed.dtype == np.uint32
+    assert packed.max() < 2**24
+    annotations, unpacked_hemispheres = atlas_module.unpack_labels(packed, lut)
+    assert (annotations == sparse_labels).all()
+    assert (unpacked_hemispheres == hemispheres).all()
+
+
+def test_pack_labels_invalid_hemispheres(sparse_labels):
+    hemispheres = np.full(sparse_labels.shape, 2**8, dtype=np.uint16)
+    with pytest.raises(atlas_module.AtlasError):
+        atlas_module.pack_labels(sparse_labels, hemispheres)
+
+
+def test_pyramid_level(tmpdir, monkeypatch, sparse_labels):
+    affine = np.diag([0.01, 0.01, 0.02, 1])
+    affine[:3, 3] = [1, 2, 3]
+    brain = np.random.RandomState(1).rand(*sparse_labels.shape).astype(np.float32)
+    hemispheres = (sparse_labels % 2 + 1).astype(np.uint8)
+    atlas_conf = config_obj['atlas']
+    for element_name, data in (('atlas', sparse_labels), ('brain', brain), ('hemispheres', hemispheres)):
+        nib.save(nib.Nifti1Image(data, affine), str(tmpdir.join(atlas_conf['default_{}_name'.format(element_name)])))
+    monkeypatch.setitem(atlas_conf, 'base_folder', str(tmpdir))
+
+    atlas = atlas_module.Atlas(downsampling_factor=2)
+    atlas.load_all()
+    atlas_img = atlas.get_data()
+    assert atlas_img.shape == (3, 2, 3)
+    assert (atlas_img.get_data() == atlas_module.downsample_labels(sparse_labels, 2)).all()
+    np.testing.assert_allclose(atlas_img.header.get_zooms(), (0.02, 0.02, 0.04))
+    # The new voxels are centred on their block of full resolution voxels
+    np.testing.assert_allclose(atlas_img.affine, affine.dot([[2, 0, 0, 0.5], [0, 2, 0, 0.5], [0, 0, 2, 0.5],
+                                                            [0, 0, 0, 1]]))
+    np.testing.assert_allclose([atlas.pix_sizes[axis] for axis in ('x', 'y', 'z')], (0.02, 0.02, 0.04))
+    np.testing.assert_allclose(atlas.get_brain_data().get_data(), atlas_module.block_average(brain, 2), rtol=1e-6)
+    assert atlas.get_hemispheres_data().shape == (3, 2, 3)
+
+    pyramid_folder = os.path.dirname(atlas.get_pyramid_path(atlas.get_path()))
+    assert sorted(os.listdir(pyramid_folder)) == sorted(atlas_conf['default_{}_name'.format(element_name)]
+                                                        for element_name in ('atlas', 'brain', 'hemispheres'))
@@ -0,0 +1,34 @@
+import json
+
+from amap.registration import autotune
+
+
+def test_pick_best():
+    assert autotune.pick_best({1: 10.0, 2: 5.5, 4: 3.0, 8: 2.9}) == 4
+    assert autotune.pick_best({1: 10.0, 2: 12.0}) == 1
+
+
+def test_get_candidate_thread_counts():
+    assert autotune.get_candidate_thread_counts(12) == [1, 2, 4, 8, 12]
+    assert autotune.get_candidate_thread_counts(1) == [1]
+
+
+def test_autotune(tmpdir, monkeypatch):
+    def fake_time_command(cmd, n_threads, log_file_path, error_file_path):
+        if cmd == 'affine':
+            return {1: 4.0, 2: 2.0, 4: 1.95}[n_threads]
+        else:
+            return 8.0 / n_threads
+
+    monkeypatch.setattr(autotune, 'get_short_registration_cmds',
+                        lambda *args: {'affine': 'affine', 'freeform': 'freeform'})
+    monkeypatch.setattr(autotune, 'time_command', fake_time_command)
+    tuned_threads_path = str(tmpdir.join('autotune.json'))
+    assert autotune.load_tuned_threads(tuned_threads_path) == {}
+
+    result = autotune.autotune('ref.nii', 'flo.nii', thread_counts=[1, 2, 4], tuned_threads_path=tuned_threads_path)
+    expected = {'affine': 2, 'freeform': 4, 'segmentation': 4}
+    assert result['n_threads'] == expected
+    assert autotune.load_tuned_threads(tuned_threads_path) == expected
+    with open(tuned_threads_path) as tuned_file:
+        assert json.load(tuned_file)['timings']['affine']['4'] == 1.95
@@ -0,0 +1,109 @@
+import time
+import threading
+
+import pytest
+
+from amap import batch
+
+
+def test_read_manifest(tmpdir):
+    manifest_path = str(tmpdir.join('manifest.csv'))
+    with open(manifest_path, 'w') as manifest_file:
+        manifest_file.write('target_brain_path,sample_name,output_folder,x_pixel_mm,flip_x,atlas_mask_planes\n'
+                            '/data/brain_1,brain_1,/out/brain_1,0.002,yes,10 -5\n'
+                            '/data/brain_2,brain_2,/out/brain_2,,,\n')
+    samples = batch.read_manifest(manifest_path, ['-p', '-x', '0.004'])
+    assert [s.sample_name for s in samples] == ['brain_1', 'brain_2']
+    assert all(s.preprocess for s in samples)
+    assert samples[0].x_pixel_mm == 0.002
+    assert samples[1].x_pixel_mm == 0.004
+    assert samples[0].flip_x and not samples[1].flip_x
+    assert samples[0].atlas_mask_planes == [10, -5]
+    assert samples[1].target_brain_path == '/data/brain_2'
+
+
+def test_read_manifest_unknown_column(tmpdir):
+    manifest_path = str(tmpdir.join('manifest.csv'))
+    with open(manifest_path, 'w') as manifest_file:
+        manifest_file.write('target_brain_path,sample_name,output_folder,colour\n/data/b,b,/out/b,red\n')
+    with pytest.raises(batch.BatchError):
+        batch.read_manifest(manifest_path)
+
+
+class StageRecorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = {}
+        self.max_running = {}
+
+    def stage_func(self, name, duration, fail_sample=None):
+        def func(sample):
+            with self.lock:
+                self.events.append(('start', name, sample))
+                self.running[name] = self.running.get(name, 0) + 1
+                self.max_running[name] = max(self.max_running.get(name, 0), self.running[name])
+            time.sleep(duration)
+            with self.lock:
+                self.running[name] -= 1
+                self.events.append(('end', name, sample))
+            if sample == fail_sample:
+                raise RuntimeError('failed')
+        return func
+
+
+def test_scheduler_overlaps_preprocessing_with_freeform():
+    recorder = StageRecorder()
+    stages = [batch.Stage('preprocess', recorder.stage_func('preprocess', 0.02), n_cores=1),
+              batch.Stage('freeform', recorder.stage_func('freeform', 0.1), n_cores=2, max_concurrent=1)]
+    errors = batch.BatchScheduler(stages, max_cores=4, max_memory_gb=100, poll_interval=0.01).run([0, 1, 2])
+    assert errors == [None] * 3
+    assert recorder.max_running['freeform'] == 1
+    events = recorder.events
+    # The preprocessing of the next samples happens while the first freeform registration runs
+    assert events.index(('end', 'preprocess', 1)) < events.index(('end', 'freeform', 0))
+    for sample in range(3):
+        assert events.index(('end', 'preprocess', sample)) < events.index(('start', 'freeform', sample))
+
+
+def test_scheduler_budget_and_failures():
+    recorder = StageRecorder()
+    stages = [batch.Stage('preprocess', recorder.stage_func('preprocess', 0.02), n_cores=1, memory_gb=6),
+              batch.Stage('segment', recorder.stage_func('segment', 0.02, fail_sample=1), n_cores=1, memory_gb=1),
+              batch.Stage('last', recorder.stage_func('last', 0.01), n_cores=1, memory_gb=1)]
+    errors = batch.BatchScheduler(stages, max_cores=8, max_memory_gb=10, poll_interval=0.01).run([0, 1, 2, 3])
+    assert recorder.max_running['preprocess'] == 1  # Only one fits in the memory budget
+    assert isinstance(errors[1], batch.BatchError)
+    assert [e is None for e in errors] == [True, False, True, True]
+    assert ('start', 'last', 1) not in recorder.events
+    assert ('end', 'last', 3) in recorder.events
+
+
+def test_registration_cores_override_autotune(tmpdir, monkeypatch):
+    import json
+    from amap.registration.registration_params import RegistrationParams
+
+    monkeypatch.setenv('HOME', str(tmpdir))  # ~/.amap/autotune.json
+    tmpdir.mkdir('.amap').join('autotune.json').write(json.dumps(
+        {'n_threads': {'affine': 16, 'freeform': 16, 'segmentation': 16}}))
+    monkeypatch.delenv('OMP_NUM_THREADS', raising=False)
+    assert RegistrationParams().get_environment('freeform')['OMP_NUM_THREADS'] == '16'
+
+    environments = []
+
+    class SchedulerMock(object):
+        def __init__(self, stages, max_cores, max_memory_gb):
+            pass
+
+        def run(self, samples):  # The NiftyReg jobs run with the environment of the registration params
+            params = RegistrationParams()
+            environments.extend(params.get_environment(program_type) for program_type in
+                                ('affine', 'freeform', 'segmentation'))
+            return []
+
+    monkeypatch.setattr(batch, 'BatchScheduler', SchedulerMock)
+    monkeypatch.setattr(batch, 'read_manifest', lambda manifest_path, common_args: [])
+    monkeypatch.setattr('sys.argv', ['amap_batch', 'manifest.csv', '--registration-cores', '3'])
+    monkeypatch.setenv('OMP_NUM_THREADS', '1')  # Restored after the test as main sets it
+    batch.main()
+    assert [env['OMP_NUM_THREADS'] for env in environments] == ['3', '3', '3']
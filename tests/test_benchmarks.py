@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from amap.brain import brain_io as bio
+from benchmarks.synthetic_brain import SyntheticBrain, make_synthetic_atlas
+from benchmarks.run_benchmarks import Benchmark, run_benchmarks, compare
+from benchmarks.startup import time_command, get_imported_heavy_modules
+
+
+def test_synthetic_brain_is_deterministic():
+    brain = SyntheticBrain((32, 40, 6), n_blobs=10, seed=3)
+    volume = brain.get_volume()
+    assert volume.shape == (32, 40, 6) and volume.dtype == np.uint16
+    assert (volume == SyntheticBrain((32, 40, 6), n_blobs=10, seed=3).get_volume()).all()
+    assert (volume[:, :, 2] == brain.get_plane(2)).all()
+    assert not (volume == SyntheticBrain((32, 40, 6), n_blobs=10, seed=4).get_volume()).all()
+
+
+@pytest.mark.parametrize('layout', ['planes', 'nii'])
+def test_synthetic_brain_layouts(tmpdir, layout):
+    brain = SyntheticBrain((16, 20, 4), n_blobs=5)
+    path = brain.write(str(tmpdir.join(layout)), layout)
+    assert (bio.load_any(path) == brain.get_volume()).all()
+
+
+def test_synthetic_atlas():
+    atlas = make_synthetic_atlas((20, 24, 10), n_regions=5)
+    assert atlas[0, 0, 0] == 0
+    assert len(np.unique(atlas)) == 6
+
+
+def test_run_and_compare():
+    def fail(_):
+        raise ValueError('broken')
+    results = run_benchmarks([Benchmark('sum', lambda _: np.ones(10**5).sum(), n_bytes=8 * 10**5, n_planes=1),
+                              Benchmark('fail', fail)], n_repeats=2)
+    assert len(results['sum']['times']) == 2 and results['sum']['peak_memory_mb'] > 0
+    assert 'broken' in results['fail']['error']
+
+    baseline = {'sum': dict(results['sum'], best=results['sum']['best'] / 2)}
+    comparison = compare(results, baseline, time_tolerance=0.5)
+    assert comparison['sum']['regression'] and 'fail' not in comparison
+    assert not compare(results, baseline, time_tolerance=1.5)['sum']['regression']
+
+
+def test_startup_does_not_import_heavy_dependencies():
+    assert get_imported_heavy_modules('amap.main') == []
+    assert get_imported_heavy_modules('amap.config.config') == []
+
+
+def test_time_command():
+    times = time_command(['-m', 'amap.main', '--help'], n_repeats=2)
+    assert len(times) == 2 and all(t > 0 for t in times)
@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import pytest
+
+from amap.analysis import brain_analyser as ba
+from amap.brain import brain_io as bio
+from amap.brain.sample_space import SampleSpace
+from amap.config.atlas import compact_labels
+
+
+@pytest.fixture()
+def atlas():
+    ids = np.array([0, 997, 614454277, 1009], dtype=np.uint32)
+    return ids[np.random.RandomState(0).randint(0, 4, size=(10, 12, 8))]
+
+
+@pytest.fixture()
+def hemispheres(atlas):
+    hemispheres = np.ones(atlas.shape, dtype=np.uint8)
+    hemispheres[5:] = 2
+    return hemispheres
+
+
+@pytest.fixture()
+def atlas_paths(tmpdir, atlas, hemispheres):
+    paths = {name: str(tmpdir.join(name)) for name in ('atlas.nii', 'hemispheres.nii',
+                                                       'compact_atlas.nii', 'lut.npy')}
+    bio.to_nii(atlas, paths['atlas.nii'])
+    bio.to_nii(hemispheres, paths['hemispheres.nii'])
+    compact_atlas, lut = compact_labels(atlas)
+    bio.to_nii(compact_atlas, paths['compact_atlas.nii'])
+    np.save(paths['lut.npy'], lut)
+    return paths
+
+
+@pytest.fixture()
+def points(atlas):
+    return np.random.RandomState(1).uniform(-1, 12, size=(5000, 3))
+
+
+def expected_counts(points, atlas, hemispheres):
+    counts = {}
+    for point in np.floor(points + 0.5).astype(int):
+        if (point >= 0).all() and (point < atlas.shape).all():
+            key = (atlas[tuple(point)], hemispheres[tuple(point)])
+        else:
+            key = (0, 0)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def table_to_dict(table):
+    return {(row['region_id'], row['hemisphere']): row['count'] for row in table}
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_classify_counts(atlas_paths, atlas, hemispheres, points, compact):
+    if compact:
+        analyser = ba.BrainAnalyser(atlas_paths['compact_atlas.nii'], atlas_paths['hemispheres.nii'],
+                                    labels_lut_path=atlas_paths['lut.npy'])
+    else:
+        analyser = ba.BrainAnalyser(atlas_paths['atlas.nii'], atlas_paths['hemispheres.nii'])
+    table = analyser.classify_counts(points, chunk_size=700)
+    assert table['count'].sum() == len(points)
+    assert table_to_dict(table) == expected_counts(points, atlas, hemispheres)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_classify_counts_without_background(tmpdir, hemispheres, points, compact):
+    ids = np.array([997, 614454277, 1009], dtype=np.uint32)  # e.g. a cropped atlas, fully labelled
+    atlas = ids[np.random.RandomState(0).randint(0, 3, size=(10, 12, 8))]
+    atlas_path, lut_path = str(tmpdir.join('atlas.nii')), str(tmpdir.join('lut.npy'))
+    if compact:
+        compact_atlas, lut = compact_labels(atlas)
+        bio.to_nii(compact_atlas, atlas_path)
+        np.save(lut_path, lut)
+        analyser = ba.BrainAnalyser(atlas_path, labels_lut_path=lut_path)
+    else:
+        bio.to_nii(atlas, atlas_path)
+        analyser = ba.BrainAnalyser(atlas_path)
+    assert analyser.outside_label_index == len(ids)
+    table = analyser.classify_counts(points, chunk_size=700)
+    assert table_to_dict(table) == expected_counts(points, atlas, np.zeros(atlas.shape, dtype=np.uint8))
+    outside = ~np.all((np.floor(points + 0.5) >= 0) & (np.floor(points + 0.5) < atlas.shape), axis=1)
+    assert outside.any()
+    assert (analyser.lookup_regions(points)[outside] == 0).all()
+
+
+def test_classify_counts_raw_coordinates(atlas_paths, atlas, points):
+    sample_space = SampleSpace(0.5, 0.5, 0.25)
+    raw_points = sample_space.downsampled_to_raw(points)
+    analyser = ba.BrainAnalyser(atlas_paths['atlas.nii'], sample_space=sample_space)
+    table = analyser.classify_counts(raw_points)
+    assert table_to_dict(table) == expected_counts(points, atlas, np.zeros(atlas.shape, dtype=np.uint8))
+
+
+def test_save_table(tmpdir, atlas_paths, points):
+    table = ba.BrainAnalyser(atlas_paths['atlas.nii']).classify_counts(points)
+    dest_path = str(tmpdir.join('counts.csv'))
+    ba.save_table(table, dest_path)
+    reloaded = np.genfromtxt(dest_path, delimiter=',', names=True, dtype=None)
+    assert reloaded.dtype.names == ('region_id', 'hemisphere', 'count')
+    assert (reloaded['count'] == table['count']).all()
+    assert (reloaded['region_id'] == table['region_id']).all()
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+@pytest.mark.parametrize('raw_format', ['folder', 'stack', 'nii'])
+def test_measure_intensities(tmpdir, atlas_paths, atlas, n_processes, raw_format):
+    scaling = (0.4, 0.5, 0.45)
+    raw = np.random.RandomState(2).randint(0, 4000, size=(25, 24, 20)).astype(np.uint16)
+    if raw_format == 'folder':
+        raw_src_path = str(tmpdir.mkdir('raw'))
+        for i in range(raw.shape[2]):
+            bio.to_tiff(raw[:, :, i], os.path.join(raw_src_path, 'plane_{:04d}.tif'.format(i)))
+    elif raw_format == 'stack':
+        raw_src_path = str(tmpdir.join('raw.tif'))
+        bio.to_tiff(raw, raw_src_path)
+    else:
+        raw_src_path = str(tmpdir.join('raw.nii'))
+        bio.to_nii(raw, raw_src_path)
+    raw_cells = [np.clip(np.floor((np.arange(n) + 0.5) * s).astype(int), 0, m - 1)
+                 for n, s, m in zip(raw.shape, scaling, atlas.shape)]
+    raw_labels = atlas[np.ix_(*raw_cells)]
+    sample_space = SampleSpace(*scaling)
+
+    for atlas_path, lut_path in ((atlas_paths['atlas.nii'], None),
+                                 (atlas_paths['compact_atlas.nii'], atlas_paths['lut.npy'])):
+        analyser = ba.BrainAnalyser(atlas_path, labels_lut_path=lut_path, sample_space=sample_space)
+        table = analyser.measure_intensities(raw_src_path, chunk_size=3, n_processes=n_processes)
+        assert np.all(table['region_id'] == np.unique(raw_labels))
+        for row in table:
+            region_signal = raw[raw_labels == row['region_id']]
+            assert row['count'] == region_signal.size
+            assert row['sum'] == region_signal.sum()
+            assert np.isclose(row['mean'], region_signal.mean())
+
+
+def test_measure_intensities_chunk_bytes(tmpdir, atlas_paths, monkeypatch):
+    raw = np.random.RandomState(2).randint(0, 4000, size=(25, 24, 20)).astype(np.uint16)
+    raw_src_path = str(tmpdir.join('raw.nii'))
+    bio.to_nii(raw, raw_src_path)
+    analyser = ba.BrainAnalyser(atlas_paths['atlas.nii'], sample_space=SampleSpace(0.4, 0.5, 0.45))
+    expected_table = analyser.measure_intensities(raw_src_path, chunk_size=20, n_processes=1)
+
+    chunk_n_planes = []
+    load_planes = bio.load_planes
+    monkeypatch.setattr(bio, 'load_planes', lambda src_path, start, stop, **kwargs:
+                        chunk_n_planes.append(stop - start) or load_planes(src_path, start, stop, **kwargs))
+    table = analyser.measure_intensities(raw_src_path, max_chunk_bytes=3.5 * raw[:, :, 0].nbytes, n_processes=1)
+    assert chunk_n_planes[1:] == [3] * 6 + [2]  # The first plane is loaded to measure the size of a plane
+    assert (table == expected_table).all()
@@ -75,3 +75,30 @@ def test_tiff_to_nii(tmpdir, start_array):
 def test_scale_z(start_array):
     assert bio.scale_z(start_array, 0.5).shape[-1] == start_array.shape[-1] / 2
     assert bio.scale_z(start_array, 2).shape[-1] == start_array.shape[-1] * 2
+
+
+def test_scale_volume_returns_new_array(start_array):
+    volume = start_array.astype(np.float64)
+    scaled_volume = bio.scale_volume(volume)
+    assert scaled_volume is not volume
+    assert not np.shares_memory(scaled_volume, volume)
+    assert (scaled_volume == volume).all()
+
+
+def test_create_nii_memmap(tmpdir):
+    volume = np.random.randint(0, 1000, size=(4, 5, 6)).astype(np.uint16)
+    dest_path = str(tmpdir.join('volume.nii'))
+    data = bio.create_nii_memmap(dest_path, volume.shape, volume.dtype, scale=(0.5, 0.5, 2))
+    for i in range(volume.shape[2]):
+        data[:, :, i] = volume[:, :, i]
+    data.flush()
+    del data
+
+    ref_path = str(tmpdir.join('reference.nii'))
+    bio.to_nii(volume, ref_path, scale=(0.5, 0.5, 2))
+    img = bio.load_nii(dest_path)
+    ref_img = bio.load_nii(ref_path)
+    assert (img.get_data() == volume).all()
+    assert img.get_data_dtype() == np.uint16
+    assert img.header.get_zooms() == ref_img.header.get_zooms()
+    assert (img.affine == ref_img.affine).all()
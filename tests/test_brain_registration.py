@@ -1,5 +1,9 @@
+import os
+
+import numpy as np
 import pytest
 
+from amap.brain import brain_io as bio
 from amap.registration import brain_registration
 from test_registration_params import RegistrationParamsMock
 
@@ -55,3 +59,122 @@ def spike_generate_outlines():
     assert (a*b == np.array([0, 0, 0, 0, 4, 5, 0, 0, 0, 9])).all()
 # assert error log is empty
 
+
+
+@pytest.fixture
+def atlas_img_path(tmpdir):
+    atlas_path = str(tmpdir.join('atlas.nii'))
+    bio.to_nii(np.arange(4 * 5 * 6, dtype=np.uint32).reshape(4, 5, 6), atlas_path, scale=(0.01, 0.01, 0.01))
+    return atlas_path
+
+
+def test_make_atlas_mask(tmpdir, atlas_img_path):
+    mask_path = str(tmpdir.join('mask.nii'))
+    brain_registration.make_atlas_mask(atlas_img_path, mask_path, 1, -1)
+    mask = bio.load_nii(mask_path, as_array=True)
+    assert mask.dtype == np.uint8
+    assert mask.shape == (4, 5, 6)
+    assert (mask[:, 1:4, :] == 1).all()
+    assert mask[:, 0, :].sum() == 0
+    assert mask[:, 4, :].sum() == 0
+
+
+def test_get_cached_atlas_mask(tmpdir, atlas_img_path):
+    cache_folder = str(tmpdir.join('cache'))
+    bounding_box = ((1, 3), (None, None), (2, -1))
+    mask_path = brain_registration.get_cached_atlas_mask(atlas_img_path, bounding_box, cache_folder)
+    mask = bio.load_nii(mask_path, as_array=True)
+    assert mask.sum() == 2 * 5 * 3
+    assert (mask[1:3, :, 2:5] == 1).all()
+    equivalent_bounding_box = ((1, 3), (0, 5), (2, 5))
+    assert brain_registration.get_cached_atlas_mask(atlas_img_path, equivalent_bounding_box,
+                                                    cache_folder) == mask_path
+    assert len(os.listdir(cache_folder)) == 1
+
+
+def test_segment_linear_interpolation(brain_reg_fixture):
+    cmd = brain_reg_fixture._prepare_segmentation_cmd('/home/bob/channel.nii', '/home/bob/registered_channel.nii',
+                                                      interpolation_order=1)
+    assert cmd.startswith('/usr/local/nifty_reg/reg_resample -inter 1 -cpp')
+
+
+def test_propagate_all(monkeypatch, brain_reg_fixture):
+    calls = []
+
+    def fake_execute_command(cmd, log_file_path, error_file_path, env=None):
+        calls.append((cmd.split(' -res ')[-1], log_file_path, error_file_path))
+
+    monkeypatch.setattr(brain_registration, 'safe_execute_command', fake_execute_command)
+    brain_reg_fixture.propagate_all(hemispheres=True,
+                                    extra_volumes=[('/home/bob/channel.nii', '/home/bob/registered_channel.nii', 1)])
+    assert sorted(c[0] for c in calls) == sorted([brain_reg_fixture.registered_atlas_img_path,
+                                                  brain_reg_fixture.registered_hemispheres_img_path,
+                                                  '/home/bob/registered_channel.nii'])
+    assert len(set(c[1] for c in calls)) == 3
+    assert len(set(c[2] for c in calls)) == 3
+
+
+def test_propagate_all_failure(monkeypatch, brain_reg_fixture):
+    def failing_execute_command(cmd, log_file_path, error_file_path, env=None):
+        if 'hemispheres' in cmd:
+            raise brain_registration.SafeExecuteCommandError('reg_resample crashed')
+
+    monkeypatch.setattr(brain_registration, 'safe_execute_command', failing_execute_command)
+    with pytest.raises(brain_registration.SegmentationError):
+        brain_reg_fixture.propagate_all(hemispheres=True)
+
+
+def test_segment_packed(monkeypatch, tmpdir):
+    import shutil
+
+    annotations = np.array([0, 997, 614454277], dtype=np.uint32)[np.arange(60).reshape(3, 4, 5) % 3]
+    hemispheres = (np.arange(60).reshape(3, 4, 5) % 2 + 1).astype(np.uint8)
+    output_folder = str(tmpdir)
+    reg = BrainRegMock('test_brain', os.path.join(output_folder, 'brain.nii'), output_folder)
+    reg.atlas_img_path = os.path.join(output_folder, 'atlas.nii')
+    reg.hemispheres_img_path = os.path.join(output_folder, 'hemispheres.nii')
+    bio.to_nii(annotations, reg.atlas_img_path)
+    bio.to_nii(hemispheres, reg.hemispheres_img_path)
+
+    def identity_propagation(cmd, log_file_path, error_file_path, env=None):  # reg_resample with an identity transform
+        args = cmd.split()
+        shutil.copy(args[args.index('-flo') + 1], args[args.index('-res') + 1])
+
+    monkeypatch.setattr(brain_registration, 'safe_execute_command', identity_propagation)
+    reg.propagate_all(hemispheres=True, packed=True)
+    assert (bio.load_nii(reg.registered_atlas_img_path, as_array=True) == annotations).all()
+    registered_hemispheres = bio.load_nii(reg.registered_hemispheres_img_path, as_array=True)
+    assert registered_hemispheres.dtype == np.uint8
+    assert (registered_hemispheres == hemispheres).all()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('mask_only', [False, True])
+def test_generate_outlines(tmpdir, compact, mask_only):
+    from skimage.segmentation import find_boundaries
+    from amap.config.atlas import compact_labels
+
+    ids = np.array([0, 997, 614454277], dtype=np.uint32)
+    blocks = np.random.RandomState(0).randint(0, 3, size=(3, 4, 4))
+    atlas = ids[blocks.repeat(3, axis=0).repeat(3, axis=1).repeat(3, axis=2)]
+    output_folder = str(tmpdir)
+    reg = BrainRegMock('test_brain', os.path.join(output_folder, 'brain.nii'), output_folder)
+    if compact:
+        reg.atlas_labels_lut_path = os.path.join(output_folder, 'lut.npy')
+        compact_atlas, lut = compact_labels(atlas)
+        np.save(reg.atlas_labels_lut_path, lut)
+        bio.to_nii(compact_atlas, reg.registered_compact_atlas_img_path, scale=(0.5, 0.5, 0.5))
+    else:
+        bio.to_nii(atlas, reg.registered_atlas_img_path, scale=(0.5, 0.5, 0.5))
+    reg.generate_outlines(mask_only=mask_only, slab_size=3, n_workers=2)
+
+    outlines_img = bio.load_nii(reg.outlines_file_path)
+    assert outlines_img.header.get_zooms() == (0.5, 0.5, 0.5)
+    outlines = outlines_img.get_data()
+    expected_mask = find_boundaries(atlas, mode='inner')
+    if mask_only:
+        assert outlines.dtype == np.uint8
+        assert (outlines == expected_mask).all()
+    else:
+        assert outlines.dtype == np.uint32
+        assert (outlines == atlas * expected_mask).all()
@@ -0,0 +1,159 @@
+import os
+import time
+
+import pytest
+
+from amap.utils.checkpoint import Step, Pipeline, CheckpointError
+
+
+def make_steps(tmpdir, calls, params=None):
+    src_path = str(tmpdir.join('src.txt'))
+    mid_path = str(tmpdir.join('mid.txt'))
+    dest_path = str(tmpdir.join('dest.txt'))
+
+    def first():
+        calls.append('first')
+        with open(src_path, 'r') as src, open(mid_path, 'w') as mid:
+            mid.write(src.read().upper())
+
+    def second():
+        calls.append('second')
+        with open(mid_path, 'r') as mid, open(dest_path, 'w') as dest:
+            dest.write(mid.read()[::-1])
+
+    return [Step('first', first, inputs=[src_path], outputs=[mid_path], params=params or {'a': 1}),
+            Step('second', second, inputs=[mid_path], outputs=[dest_path], depends_on=('first',))]
+
+
+@pytest.fixture
+def src_file(tmpdir):
+    src_path = str(tmpdir.join('src.txt'))
+    with open(src_path, 'w') as src:
+        src.write('abc')
+    return src_path
+
+
+def test_resume(tmpdir, src_file):
+    manifest_path = str(tmpdir.join('checkpoints.json'))
+    calls = []
+    assert Pipeline(make_steps(tmpdir, calls), manifest_path).run() == ['first', 'second']
+    assert Pipeline(make_steps(tmpdir, calls), manifest_path).run(resume=True) == []
+    assert Pipeline(make_steps(tmpdir, calls), manifest_path).run() == ['first', 'second']  # No resume
+    assert calls == ['first', 'second'] * 2
+
+
+def test_resume_after_changes(tmpdir, src_file):
+    manifest_path = str(tmpdir.join('checkpoints.json'))
+    calls = []
+    Pipeline(make_steps(tmpdir, calls), manifest_path).run()
+
+    assert Pipeline(make_steps(tmpdir, calls, params={'a': 2}), manifest_path).run(resume=True) == ['first']
+
+    os.remove(str(tmpdir.join('dest.txt')))
+    assert Pipeline(make_steps(tmpdir, calls, params={'a': 2}), manifest_path).run(resume=True) == ['second']
+
+    with open(src_file, 'w') as src:
+        src.write('abd')
+    assert Pipeline(make_steps(tmpdir, calls, params={'a': 2}), manifest_path).run(resume=True) == \
+        ['first', 'second']
+
+
+def test_touched_file_with_same_content_is_up_to_date(tmpdir, src_file, monkeypatch):
+    from amap.utils import checkpoint
+
+    manifest_path = str(tmpdir.join('checkpoints.json'))
+    Pipeline(make_steps(tmpdir, []), manifest_path).run()
+    new_time = time.time() + 10
+    os.utime(str(tmpdir.join('mid.txt')), (new_time, new_time))  # Written by the first step
+    assert Pipeline(make_steps(tmpdir, []), manifest_path).run(resume=True) == []
+
+    hashed_paths = []
+    hash_file = checkpoint.hash_file
+    monkeypatch.setattr(checkpoint, 'hash_file', lambda path: hashed_paths.append(path) or hash_file(path))
+    os.utime(src_file, (new_time, new_time))  # Not written by a step, only fingerprinted by size and mtime
+    assert Pipeline(make_steps(tmpdir, []), manifest_path).run(resume=True) == ['first']  # Same mid.txt
+    assert src_file not in hashed_paths
+
+
+def test_force_from(tmpdir, src_file):
+    manifest_path = str(tmpdir.join('checkpoints.json'))
+    Pipeline(make_steps(tmpdir, []), manifest_path).run()
+    assert Pipeline(make_steps(tmpdir, []), manifest_path).run(force_from='second') == ['second']
+    assert Pipeline(make_steps(tmpdir, []), manifest_path).run(force_from='first') == ['first', 'second']
+    with pytest.raises(CheckpointError):
+        Pipeline(make_steps(tmpdir, []), manifest_path).run(force_from='third')
+
+
+def test_failed_step_is_not_up_to_date(tmpdir, src_file):
+    manifest_path = str(tmpdir.join('checkpoints.json'))
+    Pipeline(make_steps(tmpdir, []), manifest_path).run()
+
+    def fail():
+        raise RuntimeError('crash')
+    steps = make_steps(tmpdir, [])
+    steps[1].func = fail
+    with pytest.raises(RuntimeError):
+        Pipeline(steps, manifest_path).run(force_from='second')
+    assert Pipeline(make_steps(tmpdir, []), manifest_path).run(resume=True) == ['second']
+
+
+def test_missing_output(tmpdir, src_file):
+    steps = [Step('noop', lambda: None, inputs=[src_file], outputs=[str(tmpdir.join('missing.txt'))])]
+    with pytest.raises(CheckpointError):
+        Pipeline(steps, str(tmpdir.join('checkpoints.json'))).run()
+
+
+def test_unknown_dependency(tmpdir):
+    with pytest.raises(CheckpointError):
+        Pipeline([Step('second', lambda: None, depends_on=('first',))], str(tmpdir.join('checkpoints.json')))
+
+
+def test_folder_input(tmpdir):
+    folder = tmpdir.mkdir('planes')
+    folder.join('plane_0.tif').write('a')
+    dest_path = str(tmpdir.join('dest.txt'))
+    manifest_path = str(tmpdir.join('checkpoints.json'))
+
+    def get_steps():
+        return [Step('load', lambda: open(dest_path, 'w').close(), inputs=[str(folder)], outputs=[dest_path])]
+    Pipeline(get_steps(), manifest_path).run()
+    assert Pipeline(get_steps(), manifest_path).run(resume=True) == []
+    folder.join('plane_1.tif').write('b')
+    assert Pipeline(get_steps(), manifest_path).run(resume=True) == ['load']
+
+    folder_mtime = os.stat(str(folder)).st_mtime_ns
+    folder.join('plane_0.tif').write('cc')  # Rewritten in place, the folder mtime does not change
+    assert os.stat(str(folder)).st_mtime_ns == folder_mtime
+    assert Pipeline(get_steps(), manifest_path).run(resume=True) == ['load']
+
+
+def test_preprocess_step_depends_on_atlas(tmpdir, monkeypatch):
+    from amap import main
+    from amap.config.config import config_obj
+
+    atlas_conf = config_obj['atlas']
+    atlas_folder = tmpdir.mkdir('atlas')
+    for element_name in ('atlas', 'brain', 'hemispheres'):
+        atlas_folder.join(atlas_conf['default_{}_name'.format(element_name)]).write(element_name)
+    monkeypatch.setitem(atlas_conf, 'base_folder', str(atlas_folder))
+    tmpdir.join('brain.tif').write('brain')
+    args = main.get_parser().parse_args([str(tmpdir.join('brain.tif')), 'sample', str(tmpdir), '-p'])
+    manifest_path = main.get_checkpoints_path(args.output_folder, args.sample_name)
+
+    def get_preprocess_step():
+        step = main.get_pipeline(args).steps[0]
+        step.func = lambda: [open(path, 'w').close() for path in step.outputs]  # Stand-in preprocessing
+        return step
+
+    Pipeline([get_preprocess_step()], manifest_path).run()
+    step = get_preprocess_step()
+    assert Pipeline([step], manifest_path).is_up_to_date(step)
+
+    atlas_folder.join(atlas_conf['default_brain_name']).write('new brain')
+    step = get_preprocess_step()
+    assert not Pipeline([step], manifest_path).is_up_to_date(step)
+    Pipeline([step], manifest_path).run()
+
+    monkeypatch.setitem(atlas_conf, 'default_brain_name', atlas_conf['default_hemispheres_name'])
+    step = get_preprocess_step()
+    assert not Pipeline([step], manifest_path).is_up_to_date(step)
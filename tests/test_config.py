@@ -1,6 +1,9 @@
+import os
+
 import pytest
 
-from amap.config.config import config_obj
+import amap
+from amap.config.config import config_obj, LazyConfig, get_binary, os_folder_name
 
 
 @pytest.fixture()
@@ -9,13 +12,17 @@ def expected_conf():
         'affine': {
             'program_path': '',
             'n_steps': 6,
-            'use_n_steps': 5
+            'use_n_steps': 5,
+            'n_threads': 0,
+            'cpu_affinity': ''
         },
         'freeform': {
             'program_path': '',
             'n_steps': 6,
             'use_n_steps': 4,
             'bending_energy_weight': 0.95,
+            'n_threads': 0,
+            'cpu_affinity': '',
             'grid_spacing': {'x': -10},
             'smoothing_sigma': {
                 'reference': -1.0,
@@ -26,18 +33,25 @@ def expected_conf():
                 'floating': 128
             }
         },
-        'segmentation': {'program_path': ''},
+        'segmentation': {
+            'program_path': '',
+            'n_threads': 0,
+            'cpu_affinity': ''
+        },
         'atlas': {
             'base_folder': '~/.amap/atlas/',
             'default_atlas_name': 'allen_cff_october_2017_atlas_annotations_10_um.nii',
             'default_brain_name': 'allen_cff_october_2016_average_brain_filtered_10_um.nii',
             'default_hemispheres_name': 'allen_cff_october_2017_atlas_hemispheres_annotations_10_um.nii',
             'default_outlines_name': 'allen_cff_october_2017_atlas_outlines_10_um.nii',
+            'default_labels_lut_name': 'allen_cff_october_2017_atlas_labels_lut.npy',
             'atlas_path': '',
             'brain_path': '',
             'hemispheres_path': '',
             'outlines_path': '',
             'orientation': 'horizontal',
+            'labels_lut_path': '',
+            'mask_cache_folder': '~/.amap/mask_cache/',
             'pixel_size': {
                 'x': 0.010,
                 'y': 0.010,
@@ -50,3 +64,24 @@ def expected_conf():
 def test_config_obj(expected_conf):
     assert config_obj == expected_conf
 
+
+def test_lazy_config(tmpdir):
+    config_path = tmpdir.join('amap.conf')
+    config_path.write("[atlas]\n    orientation = 'horizontal'\n")
+    config = LazyConfig(str(config_path))
+    assert config._config is None
+    assert config['atlas']['orientation'] == 'horizontal'
+    config['atlas']['orientation'] = 'coronal'
+    assert dict(config) == {'atlas': {'orientation': 'coronal'}}
+
+
+def test_get_binary():
+    expected_path = os.path.join(os.path.dirname(amap.__file__), 'bin', 'nifty_reg', os_folder_name, 'reg_aladin')
+    assert get_binary('amap/bin/nifty_reg', 'reg_aladin') == expected_path
+
+
+def test_get_binary_without_importlib_files(monkeypatch):
+    import importlib.resources
+    monkeypatch.delattr(importlib.resources, 'files')  # Python < 3.9
+    expected_path = os.path.join(os.path.dirname(amap.__file__), 'bin', 'nifty_reg', os_folder_name, 'reg_aladin')
+    assert os.path.normpath(get_binary('amap/bin/nifty_reg', 'reg_aladin')) == expected_path
@@ -0,0 +1,116 @@
+import os
+import platform
+import subprocess
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+import amap
+from amap.brain import brain_io as bio
+from amap.registration import deformation
+
+NIFTY_REG_FOLDER = os.path.join(os.path.dirname(amap.__file__), 'bin', 'nifty_reg', 'linux_x64')
+
+
+def nifty_reg_available():
+    if platform.system() != 'Linux':
+        return False
+    try:
+        subprocess.call([os.path.join(NIFTY_REG_FOLDER, 'reg_resample')],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return False
+    return True
+
+
+def make_affine(spacing, origin):
+    affine = np.diag([spacing] * 3 + [1.])
+    affine[:3, 3] = origin
+    return affine
+
+
+@pytest.fixture()
+def identity_grid():
+    reference_affine = make_affine(0.05, (1., -2., 0.5))
+    grid_affine = make_affine(0.25, (1. - 0.25, -2. - 0.25, 0.5 - 0.25))
+    grid_voxels = np.stack(np.meshgrid(*[np.arange(n) for n in (6, 8, 7)], indexing='ij'), axis=-1)
+    control_points = deformation._apply_affine(grid_affine, grid_voxels.reshape(-1, 3)).reshape(grid_voxels.shape)
+    return deformation.Deformation((20, 24, 16), reference_affine, control_points, grid_affine)
+
+
+def test_cubic_bspline_weights():
+    weights = deformation.cubic_bspline_weights(np.linspace(0, 0.99, 11))
+    assert np.allclose(weights.sum(axis=-1), 1)
+    assert weights[0] == pytest.approx([1 / 6., 4 / 6., 1 / 6., 0])
+
+
+def test_identity_grid(identity_grid):
+    labels = np.random.RandomState(0).randint(0, 5, size=(20, 24, 16)).astype(np.uint16)
+    warped = identity_grid.warp(labels, identity_grid.reference_affine, interpolation_order=0, slab_size=5)
+    assert warped.dtype == labels.dtype
+    assert (warped == labels).all()
+
+
+def test_separable_field_matches_points(identity_grid):
+    rng = np.random.RandomState(0)
+    identity_grid.control_points += rng.normal(scale=0.02, size=identity_grid.control_points.shape)
+    field = identity_grid.deformation_field(slice(3, 6))
+    grid = np.stack(np.meshgrid(np.arange(20), np.arange(24), np.arange(3, 6), indexing='ij'), axis=-1)
+    assert np.allclose(field, identity_grid.transform_points(grid.reshape(-1, 3)).reshape(field.shape))
+
+
+@pytest.mark.skipif(not nifty_reg_available(), reason='NiftyReg binaries cannot be run on this platform')
+def test_warp_matches_reg_resample(tmpdir):
+    rng = np.random.RandomState(1)
+    x, y, z = np.mgrid[:30, :32, :28]
+    floating = gaussian_filter(rng.rand(30, 32, 28), 3) * 1000 + 500 * np.exp(-((x - 15)**2 + (y - 16)**2 +
+                                                                                   (z - 14)**2) / 100.)
+    reference = gaussian_filter(np.roll(floating, (2, -1, 1), axis=(0, 1, 2)), 0.5)
+    labels = (floating > floating.mean()) * 7 + (x > 15) * 3
+    paths = {name: str(tmpdir.join('{}.nii'.format(name))) for name in ('flo', 'ref', 'labels', 'cpp',
+                                                                         'res', 'labels_res', 'flo_res')}
+    bio.to_nii(floating.astype(np.float32), paths['flo'], affine_transform=make_affine(0.05, (1., -2., 0.5)))
+    bio.to_nii(reference.astype(np.float32), paths['ref'], affine_transform=make_affine(0.05, (1.2, -2.1, 0.4)))
+    bio.to_nii(labels.astype(np.uint16), paths['labels'], affine_transform=make_affine(0.05, (1., -2., 0.5)))
+
+    def run(program, args):
+        subprocess.check_call([os.path.join(NIFTY_REG_FOLDER, program)] + args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    run('reg_f3d', ['-ln', '2', '-lp', '2', '-sx', '-5', '-flo', paths['flo'], '-ref', paths['ref'],
+                    '-cpp', paths['cpp'], '-res', paths['res']])
+    run('reg_resample', ['-inter', '0', '-cpp', paths['cpp'], '-flo', paths['labels'], '-ref', paths['ref'],
+                         '-res', paths['labels_res']])
+    run('reg_resample', ['-inter', '1', '-cpp', paths['cpp'], '-flo', paths['flo'], '-ref', paths['ref'],
+                         '-res', paths['flo_res']])
+
+    warped_labels = deformation.warp_image(paths['labels'], paths['ref'], paths['cpp'], interpolation_order=0)
+    assert (warped_labels == bio.load_nii(paths['labels_res'], as_array=True)).all()
+    warped = deformation.warp_image(paths['flo'], paths['ref'], paths['cpp'], interpolation_order=1)
+    assert np.allclose(warped, bio.load_nii(paths['flo_res'], as_array=True), atol=0.05)
+
+
+def test_cached_deformation(tmpdir, identity_grid):
+    rng = np.random.RandomState(0)
+    identity_grid.control_points += rng.normal(scale=0.02, size=identity_grid.control_points.shape)
+    paths = {name: str(tmpdir.join(name)) for name in ('ref.nii', 'cpp.nii', 'field.npy')}
+    bio.to_nii(np.zeros(identity_grid.reference_shape, dtype=np.uint8), paths['ref.nii'],
+               affine_transform=identity_grid.reference_affine)
+    grid_affine = np.linalg.inv(identity_grid.reference_to_grid.dot(np.linalg.inv(identity_grid.reference_affine)))
+    control_points = identity_grid.control_points.astype(np.float32)
+    bio.to_nii(control_points.reshape(control_points.shape[:3] + (1, 3)), paths['cpp.nii'],
+               affine_transform=grid_affine)
+
+    assert deformation.load_cached_deformation(paths['ref.nii'], paths['cpp.nii'], paths['field.npy']) is None
+    deformation.materialise_deformation_field(paths['ref.nii'], paths['cpp.nii'], paths['field.npy'], slab_size=5)
+    cached = deformation.load_cached_deformation(paths['ref.nii'], paths['cpp.nii'], paths['field.npy'])
+    assert isinstance(cached.field, np.memmap)
+    assert cached.field.dtype == np.float32
+    assert np.allclose(cached.deformation_field(), identity_grid.deformation_field(), atol=1e-5)
+    points = rng.uniform(0, 15, size=(50, 3))
+    assert np.allclose(cached.transform_points(points), identity_grid.transform_points(points), atol=1e-3)
+
+    bio.to_nii((control_points + 0.01).reshape(control_points.shape[:3] + (1, 3)), paths['cpp.nii'],
+               affine_transform=grid_affine)
+    assert deformation.load_cached_deformation(paths['ref.nii'], paths['cpp.nii'], paths['field.npy']) is None
@@ -0,0 +1,106 @@
+import os
+import sys
+import socket
+
+import numpy as np
+import tifffile
+
+from amap.brain import brain_io as bio
+from amap.brain import brain_processor
+from amap.utils import hooks
+from amap.utils.instrumentation import instrumented
+from amap.utils.run_command import safe_execute_command
+
+
+class EventRecorder(object):
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event_type, stage, payload):
+        self.events.append((event_type, stage, dict(payload)))
+
+    def of_stage(self, stage):
+        return [(event_type, payload) for event_type, s, payload in self.events if s == stage]
+
+
+def test_no_hooks():
+    assert not hooks.registered_hooks
+    assert hooks.span('a', index=1) is hooks.span('b')
+    with hooks.span('a') as payload:
+        assert payload is None
+
+
+def test_registry():
+    recorder = EventRecorder()
+    with hooks.registered(recorder):
+        with hooks.span('stage', index=3) as payload:
+            payload['shape'] = (2, 2)
+        try:
+            with hooks.span('failing'):
+                raise ValueError('bad')
+        except ValueError:
+            pass
+    assert not hooks.registered_hooks
+    (start_type, start), (end_type, end) = recorder.of_stage('stage')
+    assert (start_type, start) == ('start', {'index': 3})
+    assert end_type == 'end' and end['shape'] == (2, 2) and end['duration'] >= 0
+    assert 'bad' in recorder.of_stage('failing')[1][1]['error']
+
+
+def test_io_events(tmpdir):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmpdir.join('plane_{}.tif'.format(i))))
+        tifffile.imsave(paths[-1], np.full((4, 5), i, dtype=np.uint16))
+    recorder = EventRecorder()
+    with hooks.registered(recorder):
+        volume = bio.load_from_paths_sequence(paths)
+        bio.to_nii(volume, str(tmpdir.join('volume.nii')))
+    load_ends = [payload for event_type, payload in recorder.of_stage('load_plane') if event_type == 'end']
+    assert [payload['index'] for payload in load_ends] == [0, 1, 2]
+    assert load_ends[0]['n_bytes'] == 40 and load_ends[0]['shape'] == (4, 5)
+    assert recorder.of_stage('to_nii')[1][1]['shape'] == (4, 5, 3)
+
+
+def test_filter_events(monkeypatch):
+    monkeypatch.setattr(brain_processor, 'filter_plane_for_registration', lambda plane: plane)
+    recorder = EventRecorder()
+    with hooks.registered(recorder):
+        brain_processor.BrainProcessor.filter_for_registration(np.ones((4, 5, 6)))
+    assert len(recorder.of_stage('filter_plane')) == 12
+
+
+def test_command_and_stage_events(tmpdir):
+    @instrumented('my_stage')
+    def run():
+        safe_execute_command([sys.executable, '-c', 'print(1)'], str(tmpdir.join('a.log')), str(tmpdir.join('a.err')))
+    recorder = EventRecorder()
+    with hooks.registered(recorder):
+        run()
+    assert [(event_type, stage) for event_type, stage, _ in recorder.events] == \
+        [('start', 'my_stage'), ('start', 'command'), ('end', 'command'), ('end', 'my_stage')]
+    assert recorder.of_stage('command')[1][1]['return_code'] == 0
+
+
+def test_cprofile_hook(tmpdir):
+    with hooks.registered(hooks.CProfileHook(str(tmpdir), stage_names=('profiled',))):
+        with hooks.span('profiled'):
+            sum(range(1000))
+        with hooks.span('ignored'):
+            pass
+    assert os.listdir(str(tmpdir)) == ['stage_profiled_0.prof']
+
+
+def test_statsd_hook():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    statsd_hook = hooks.StatsdHook(*server.getsockname(), prefix='test')
+    with hooks.registered(statsd_hook):
+        with hooks.span('save', n_bytes=10):
+            pass
+    metrics = server.recv(1024).decode('utf-8').splitlines()
+    statsd_hook.close()
+    server.close()
+    assert metrics[0].startswith('test.save.duration:') and metrics[0].endswith('|ms')
+    assert metrics[1] == 'test.save.bytes:10|c'
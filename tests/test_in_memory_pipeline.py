@@ -0,0 +1,139 @@
+import os
+import sys
+
+import numpy as np
+import nibabel as nib
+import pytest
+from skimage.segmentation import find_boundaries
+
+import amap
+from amap.brain import brain_io as bio
+from amap.config.config import config_obj
+from amap.in_memory_pipeline import InMemoryPipeline, InMemoryPipelineError
+
+PIX_SIZE = float(np.float32(0.05))  # As read from the atlas header so that the brain is not rescaled
+ATLAS_AFFINE = np.diag([PIX_SIZE, PIX_SIZE, PIX_SIZE, 1])
+CORONAL_TRANSPOSITION = (2, 0, 1)  # see Atlas.reorientate_to_sample
+
+
+@pytest.fixture
+def atlas(tmpdir, monkeypatch):
+    """
+    A small horizontal atlas in the config and the stand-ins of the NiftyReg programs
+    (identity registration) as registration programs
+    """
+    ids = np.array([0, 997, 614454277], dtype=np.uint32)
+    blocks = np.random.RandomState(0).randint(0, 3, size=(4, 3, 3))
+    annotations = ids[blocks.repeat(3, axis=0).repeat(3, axis=1).repeat(3, axis=2)]
+    brain = np.random.RandomState(1).rand(*annotations.shape).astype(np.float32)
+    hemispheres = np.ones(annotations.shape, dtype=np.uint8)
+    hemispheres[annotations.shape[0] // 2:] = 2
+
+    atlas_folder = tmpdir.mkdir('atlas')
+    atlas_conf = config_obj['atlas']
+    for element_name, data in (('atlas', annotations), ('brain', brain), ('hemispheres', hemispheres)):
+        nib.save(nib.Nifti1Image(data, ATLAS_AFFINE),
+                 str(atlas_folder.join(atlas_conf['default_{}_name'.format(element_name)])))
+    monkeypatch.setitem(atlas_conf, 'base_folder', str(atlas_folder))
+    for program_type, program_name in (('affine', 'reg_aladin'), ('freeform', 'reg_f3d')):
+        monkeypatch.setitem(config_obj[program_type], 'program_path',
+                            '{} -m amap.registration.stand_in_niftyreg {}'.format(sys.executable, program_name))
+    monkeypatch.setenv('PYTHONPATH', os.path.dirname(os.path.dirname(amap.__file__)))
+    return annotations, brain, hemispheres
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_run(tmpdir, atlas, compact):
+    annotations, brain, hemispheres = atlas
+    sample_brain = np.transpose(brain, CORONAL_TRANSPOSITION)  # The atlas brain as a coronal sample
+    work_folder = str(tmpdir.join('work'))
+    with InMemoryPipeline(PIX_SIZE, PIX_SIZE, PIX_SIZE, orientation='coronal', work_folder=work_folder,
+                          compact_labels=compact, n_workers=2) as pipeline:
+        registered_atlas = pipeline.run(sample_brain, hemispheres=True, filter_brain=False)
+
+        expected_atlas = np.transpose(annotations, CORONAL_TRANSPOSITION)
+        assert registered_atlas.dtype == np.uint32
+        assert (registered_atlas == expected_atlas).all()
+        assert (pipeline.registered_hemispheres == np.transpose(hemispheres, CORONAL_TRANSPOSITION)).all()
+        assert (pipeline.registered_atlas == expected_atlas).all() != compact
+
+        outlines = pipeline.generate_outlines()
+        assert (outlines == expected_atlas * find_boundaries(expected_atlas, mode='inner')).all()
+
+        table = pipeline.compute_region_volumes()
+        region_ids, counts = np.unique(expected_atlas, return_counts=True)
+        assert (table['region_id'] == region_ids).all()
+        assert (table['voxel_count'] == counts).all()
+        np.testing.assert_allclose(table['volume'], counts * PIX_SIZE ** 3)
+
+        plane_paths = pipeline.export_atlas_to_raw_resolution(str(tmpdir.join('raw')))
+        assert len(plane_paths) == expected_atlas.shape[2]
+
+    # Only the inputs of NiftyReg are written, the label volumes stay in memory
+    written_files = os.listdir(work_folder)
+    assert 'sample_downsampled_filtered.nii' in written_files
+    assert config_obj['atlas']['default_brain_name'] in written_files
+    assert config_obj['atlas']['default_atlas_name'] not in written_files
+    assert config_obj['atlas']['default_hemispheres_name'] not in written_files
+    assert not [name for name in written_files if 'registered_atlas.nii' in name or 'hemispheres' in name]
+
+
+def test_bounding_box(tmpdir, atlas):
+    _, brain, _ = atlas
+    pipeline = InMemoryPipeline(PIX_SIZE, PIX_SIZE, PIX_SIZE, orientation='coronal', work_folder=str(tmpdir),
+                                atlas_bounding_box=((None, None), (0, 6), (None, None)))
+    pipeline.preprocess(np.transpose(brain, CORONAL_TRANSPOSITION), filter_brain=False)
+    pipeline.register()
+    mask = bio.load_nii(pipeline.brain_registration.atlas_mask_path, as_array=True)
+    assert mask.shape == pipeline.atlas.get_brain_data().shape  # The mask of the reoriented atlas
+    assert mask[:, :6].all() and not mask[:, 6:].any()
+    assert '-fmask {}'.format(pipeline.brain_registration.atlas_mask_path) in \
+        pipeline.brain_registration._prepare_freeform_reg_cmd()
+
+
+def test_stages_order(atlas):
+    _, brain, _ = atlas
+    pipeline = InMemoryPipeline(PIX_SIZE, PIX_SIZE, PIX_SIZE)
+    work_folder = pipeline.work_folder
+    with pytest.raises(InMemoryPipelineError):
+        pipeline.register()
+    pipeline.preprocess(brain, filter_brain=False)
+    with pytest.raises(InMemoryPipelineError):
+        pipeline.propagate()
+    pipeline.close()
+    assert not os.path.exists(work_folder)  # Temporary work folder
+
+
+@pytest.mark.parametrize('read_only', [False, True])  # e.g. a memory map opened in read mode
+def test_preprocess_keeps_caller_brain(atlas, monkeypatch, read_only):
+    from amap.brain import brain_processor
+
+    _, brain, _ = atlas
+    sample_brain = np.transpose(brain, CORONAL_TRANSPOSITION).astype(np.float64)  # Not converted by the filter
+    sample_brain.setflags(write=not read_only)
+    expected_brain = sample_brain.copy()
+    monkeypatch.setattr(brain_processor, 'filter_plane_for_registration', lambda plane: plane + 1)
+    with InMemoryPipeline(PIX_SIZE, PIX_SIZE, PIX_SIZE, orientation='coronal') as pipeline:
+        filtered_brain = pipeline.preprocess(sample_brain, filter_brain=True)
+    assert filtered_brain.dtype == np.uint16
+    assert (sample_brain == expected_brain).all()
+
+
+@pytest.mark.parametrize('raw_format', ['folder', 'stack'])
+def test_sample_space_scaling(tmpdir, atlas, raw_format):
+    _, brain, _ = atlas
+    raw_brain = np.transpose(brain, CORONAL_TRANSPOSITION).repeat(2, axis=0).repeat(2, axis=1)
+    if raw_format == 'folder':
+        src_path = str(tmpdir.mkdir('raw'))
+        bio.to_tiffs(raw_brain, os.path.join(src_path, 'plane'))
+    else:
+        src_path = str(tmpdir.join('raw.tif'))
+        bio.to_tiff(raw_brain, src_path)
+    with InMemoryPipeline(PIX_SIZE / 2, PIX_SIZE / 2, PIX_SIZE, orientation='coronal') as pipeline:
+        pipeline.preprocess(src_path, filter_brain=False)
+        sample_space = pipeline.sample_space
+    assert sample_space.raw_shape == raw_brain.shape
+    # Image stacks are not scaled along x and y on loading
+    expected_scaling = (0.5, 0.5, 1) if raw_format == 'folder' else (1, 1, 1)
+    np.testing.assert_allclose(sample_space.scaling, expected_scaling)
+    np.testing.assert_allclose(np.array(sample_space.downsampled_shape) / sample_space.raw_shape, expected_scaling)
@@ -0,0 +1,53 @@
+import sys
+import json
+import subprocess
+
+import pytest
+
+from amap.utils import instrumentation
+
+
+@pytest.fixture
+def recorder():
+    recorder = instrumentation.enable(poll_interval=0.01)
+    yield recorder
+    instrumentation.disable()
+
+
+@instrumentation.instrumented('write')
+def write_file(path, n_bytes):
+    with open(path, 'wb') as out_file:
+        out_file.write(b'0' * n_bytes)
+
+
+def test_disabled():
+    assert instrumentation.get_recorder() is None
+    assert instrumentation.stage('a') is instrumentation.stage('b')  # Shared no-op context manager
+    with instrumentation.stage('a'):
+        pass
+
+
+def test_stages(recorder, tmpdir):
+    with instrumentation.stage('outer', path='x'):
+        write_file(str(tmpdir.join('a.bin')), 2**20)
+    inner, outer = recorder.records
+    assert (inner['name'], inner['parent']) == ('write', 'outer')
+    assert (outer['name'], outer['parent'], outer['info']) == ('outer', None, {'path': 'x'})
+    assert inner['written_bytes'] >= 2**20
+    assert outer['duration'] >= inner['duration']
+    assert recorder.get_summary()['write']['count'] == 1
+
+
+def test_children_memory(recorder, tmpdir):
+    with instrumentation.stage('child'):
+        subprocess.check_call([sys.executable, '-c', 'import time; x = bytearray(200 * 2**20); time.sleep(0.5)'])
+    record = recorder.records[0]
+    assert record['peak_rss'] > 200 * 2**20
+    assert record['cpu_time'] > 0
+
+    report_path = str(tmpdir.join('report.json'))
+    recorder.write_report(report_path)
+    with open(report_path, 'r') as report_file:
+        report = json.load(report_file)
+    assert report['stages'][0]['name'] == 'child'
+    assert report['peak_rss'] >= record['peak_rss']
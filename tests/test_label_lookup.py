@@ -0,0 +1,63 @@
+import threading
+
+import numpy as np
+import pytest
+
+from amap.analysis import label_lookup as ll
+from amap.analysis.brain_analyser import BrainAnalyser
+from amap.brain import brain_io as bio
+from amap.brain.sample_space import SampleSpace
+
+
+@pytest.fixture()
+def lookup(tmpdir):
+    ids = np.array([0, 997, 614454277, 1009], dtype=np.uint32)
+    atlas = ids[np.random.RandomState(0).randint(0, 4, size=(10, 12, 8))]
+    hemispheres = np.ones(atlas.shape, dtype=np.uint8)
+    hemispheres[5:] = 2
+    atlas_path = str(tmpdir.join('atlas.nii'))
+    hemispheres_path = str(tmpdir.join('hemispheres.nii'))
+    bio.to_nii(atlas, atlas_path)
+    bio.to_nii(hemispheres, hemispheres_path)
+    analyser = BrainAnalyser(atlas_path, hemispheres_path, sample_space=SampleSpace(0.5, 0.5, 0.25))
+    return ll.LabelLookup(analyser), atlas, hemispheres
+
+
+@pytest.fixture()
+def raw_points():
+    return np.array([[0, 0, 0], [5, 7, 9], [19, 23, 31], [40, 0, 0]])
+
+
+def expected_labels(raw_points, atlas, hemispheres):
+    voxels = np.floor((raw_points + 0.5) * np.array([0.5, 0.5, 0.25])).astype(int)
+    inside = np.all(voxels < atlas.shape, axis=1)
+    voxels = np.minimum(voxels, np.array(atlas.shape) - 1)
+    region_ids = np.where(inside, atlas[tuple(voxels.T)], 0)
+    return region_ids, np.where(inside, hemispheres[tuple(voxels.T)], 0)
+
+
+def test_query(lookup, raw_points):
+    lookup, atlas, hemispheres = lookup
+    region_ids, lookup_hemispheres = lookup.query(raw_points)
+    expected_region_ids, expected_hemispheres = expected_labels(raw_points, atlas, hemispheres)
+    assert (region_ids == expected_region_ids).all()
+    assert (lookup_hemispheres == expected_hemispheres).all()
+
+
+def test_server(lookup, raw_points):
+    lookup, atlas, hemispheres = lookup
+    server = ll.LabelLookupServer(lookup)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with ll.LabelLookupClient(*server.server_address) as client:
+            region_ids, lookup_hemispheres = client.query(raw_points)
+            assert (region_ids == expected_labels(raw_points, atlas, hemispheres)[0]).all()
+            assert (lookup_hemispheres == expected_labels(raw_points, atlas, hemispheres)[1]).all()
+            with pytest.raises(ll.LabelLookupError):
+                client.query([[1, 2]])
+            assert (client.query(raw_points[:1])[0] == region_ids[:1]).all()  # The connection is still usable
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from amap.analysis import point_transform as pt
+from amap.brain.sample_space import SampleSpace
+from amap.registration.deformation import Deformation
+
+
+@pytest.fixture()
+def sample_space():
+    return SampleSpace(0.1, 0.1, 0.5, orientation='coronal', atlas_flips=(True, False, False))
+
+
+@pytest.fixture()
+def transform(sample_space):
+    affine = np.diag([0.01, 0.01, 0.01, 1.])
+    deformation = Deformation((20, 20, 20), affine, affine_matrix=np.eye(4))
+    registered_atlas_shape = (20, 30, 40)
+    return pt.SampleToAtlasTransform(sample_space, deformation, affine, registered_atlas_shape)
+
+
+@pytest.fixture()
+def points():
+    return np.random.RandomState(0).uniform(0, 150, size=(1000, 3))
+
+
+def expected_atlas_points(points, sample_space):
+    downsampled = (points + 0.5) * sample_space.scaling - 0.5
+    downsampled[:, 0] = 20 - 1 - downsampled[:, 0]  # flip x of the reoriented atlas
+    atlas_points = np.empty_like(downsampled)
+    atlas_points[:, (2, 0, 1)] = downsampled  # undo the coronal transposition
+    return atlas_points
+
+
+def test_sample_space_io(tmpdir, sample_space):
+    path = str(tmpdir.join('sample_space.json'))
+    sample_space.save(path)
+    reloaded = SampleSpace.load(path)
+    assert reloaded.to_dict() == sample_space.to_dict()
+    points = np.array([[10., 20., 30.]])
+    assert np.allclose(reloaded.downsampled_to_raw(reloaded.raw_to_downsampled(points)), points)
+
+
+def test_transform(transform, sample_space, points):
+    assert np.allclose(transform.transform(points), expected_atlas_points(points, sample_space))
+
+
+def test_transform_invalid_shape(transform):
+    with pytest.raises(pt.PointTransformError):
+        transform.transform(np.zeros((5, 2)))
+
+
+def test_transform_array_multiprocess(transform, points):
+    single_process = transform.transform_array(points, chunk_size=128)
+    multi_process = transform.transform_array(points, chunk_size=128, n_processes=2)
+    assert np.array_equal(single_process, multi_process)
+    assert np.allclose(single_process, transform.transform(points))
+
+
+@pytest.mark.parametrize('src_ext,dest_ext', [('.npy', '.npy'), ('.csv', '.npy'), ('.npy', '.csv')])
+def test_transform_file(tmpdir, transform, points, src_ext, dest_ext):
+    src_path = str(tmpdir.join('cells' + src_ext))
+    dest_path = str(tmpdir.join('cells_atlas' + dest_ext))
+    if src_ext == '.npy':
+        np.save(src_path, points)
+    else:
+        np.savetxt(src_path, points, delimiter=',', header='x,y,z', comments='')
+    assert pt.count_points(src_path) == len(points)
+    transform.transform_file(src_path, dest_path, chunk_size=300)
+    if dest_ext == '.npy':
+        transformed = np.load(dest_path)
+    else:
+        transformed = np.loadtxt(dest_path, delimiter=',', skiprows=1)
+    assert transformed.shape == points.shape
+    assert np.allclose(transformed, transform.transform(points), atol=1e-3)
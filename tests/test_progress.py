@@ -0,0 +1,62 @@
+import itertools
+
+from amap.registration.progress import ProgressRecorder, get_progress_path, load_progress, summarise_progress, \
+    format_summary
+
+F3D_OUTPUT = """[NiftyReg F3D] Level number: 2
+[NiftyReg F3D] **************************************************
+[NiftyReg F3D] Current level: 1 / 2
+[NiftyReg F3D] Initial objective function: 0.0515636 = (wSIM)0.0515636 - (wBE)1.86089e-13 - (wLE)0
+[NiftyReg F3D] [12] Current objective function: 0.0516039 = (wSIM)0.0516281 - (wBE)2.42e-05 [+ 0.115938 mm]
+[NiftyReg F3D] [23] Current objective function: 0.0516041 = (wSIM)0.0516286 - (wBE)2.45e-05 [+ 0 mm]
+[NiftyReg F3D] Current registration level done
+[NiftyReg F3D] --------------------------------------------------
+[NiftyReg F3D] Current level: 2 / 2
+[NiftyReg F3D] Initial objective function: 0.05 = (wSIM)0.05 - (wBE)1e-13 - (wLE)0
+[NiftyReg F3D] [17] Current objective function: 0.0515123 = (wSIM)0.0516168 - (wBE)1.04e-04 [+ 0 mm]
+[NiftyReg F3D] Current registration level done
+[NiftyReg F3D] Registration Performed in 0 min 1 sec
+"""
+
+ALADIN_OUTPUT = """[reg_aladin_sym] Maximum iteration number: 5 (10 during the first level)
+[reg_aladin_sym] Current level 1 / 2
+[reg_aladin_sym] Block size = [4 4 4]
+[reg_aladin_sym] Current level 2 / 2
+[reg_aladin_sym] Block size = [4 4 4]
+"""
+
+
+def feed(recorder, output):
+    for line in output.splitlines(True):
+        recorder('stdout', line)
+    recorder.close()
+
+
+def test_get_progress_path():
+    assert get_progress_path('/data/sample_freeform.log') == '/data/sample_freeform_progress.jsonl'
+
+
+def test_f3d_progress(tmpdir):
+    progress_path = str(tmpdir.join('sample_freeform_progress.jsonl'))
+    clock = itertools.count()
+    with ProgressRecorder(progress_path, 'freeform', clock=lambda: float(next(clock))) as recorder:
+        for line in F3D_OUTPUT.splitlines(True):
+            recorder('stdout', line)
+    events = load_progress(progress_path)
+    assert events == recorder.events
+    assert [e['event'] for e in events] == ['level_start', 'iteration', 'iteration', 'iteration', 'level_end',
+                                            'level_start', 'iteration', 'iteration', 'level_end', 'end']
+    assert [e['iteration'] for e in events if e['event'] == 'iteration'] == [0, 12, 23, 0, 17]
+    levels = summarise_progress(events)
+    assert [(level['level'], level['n_iterations'], level['objective']) for level in levels] == \
+        [(1, 23, 0.0516041), (2, 17, 0.0515123)]
+    assert all(level['duration'] > 0 for level in levels)
+    assert format_summary(events).startswith('Level 1 / 2: 23 iterations in')
+
+
+def test_aladin_progress():
+    recorder = ProgressRecorder('', 'affine')
+    feed(recorder, ALADIN_OUTPUT)
+    levels = summarise_progress(recorder.events)
+    assert [(level['level'], level['n_levels']) for level in levels] == [(1, 2), (2, 2)]
+    assert recorder.events[-1]['event'] == 'end'
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from amap.analysis import region_volumes as rv
+from amap.brain import brain_io as bio
+from amap.config.atlas import compact_labels
+
+
+@pytest.fixture()
+def atlas():
+    ids = np.array([0, 997, 614454277, 1009], dtype=np.uint32)
+    return ids[np.random.RandomState(0).randint(0, 4, size=(10, 12, 9))]
+
+
+@pytest.fixture()
+def hierarchy():
+    # 997 (root) -> 8 -> 614454277, 997 -> 1009, 8 has no voxel of its own
+    return np.array([997, 8, 614454277, 1009]), np.array([-1, 997, 8, 997])
+
+
+def count(atlas, region_id):
+    return np.count_nonzero(atlas == region_id)
+
+
+def test_count_region_voxels(tmpdir, atlas):
+    atlas_path = str(tmpdir.join('atlas.nii'))
+    bio.to_nii(atlas, atlas_path)
+    labels, counts = rv.count_region_voxels(atlas_path, slab_size=4)
+    assert np.all(labels == np.unique(atlas))
+    assert np.all(counts == [count(atlas, label) for label in labels])
+
+    compact_atlas, lut = compact_labels(atlas)
+    bio.to_nii(compact_atlas, atlas_path)
+    compact_indices, compact_counts = rv.count_region_voxels(atlas_path, slab_size=4)
+    assert np.all(lut[compact_indices] == labels)
+    assert np.all(compact_counts == counts)
+
+
+def test_rollup(hierarchy):
+    parent_idx, depth = rv.build_parent_index(*hierarchy)
+    assert np.all(parent_idx == [-1, 0, 1, 0])
+    assert np.all(depth == [0, 1, 2, 1])
+    assert np.all(rv.rollup(np.array([1, 0, 10, 100]), parent_idx, depth) == [111, 10, 10, 100])
+    empty = np.array([], dtype=np.int64)
+    assert rv.rollup(empty, empty, empty).size == 0
+
+
+def test_cyclic_hierarchy():
+    with pytest.raises(rv.RegionHierarchyError):
+        rv.build_parent_index([1, 2, 3], [-1, 3, 2])
+
+
+def test_load_hierarchy(tmpdir, hierarchy):
+    hierarchy_path = str(tmpdir.join('structures.csv'))
+    with open(hierarchy_path, 'w') as hierarchy_file:
+        hierarchy_file.write('id,name,parent_structure_id\n997,root,\n8,grey,997\n614454277,x,8\n1009,fibres,997\n')
+    region_ids, parent_ids = rv.load_hierarchy(hierarchy_path)
+    assert np.all(region_ids == hierarchy[0])
+    assert np.all(parent_ids == hierarchy[1])
+
+
+def test_region_volumes(tmpdir, atlas, hierarchy):
+    atlas_path = str(tmpdir.join('atlas.nii'))
+    bio.to_nii(atlas, atlas_path, scale=(0.5, 0.5, 2))
+    table = rv.region_volumes(atlas_path, hierarchy=hierarchy, slab_size=4)
+    assert np.all(table['region_id'] == [997, 8, 614454277, 1009, 0])
+    expected_voxels = [count(atlas, 997), 0, count(atlas, 614454277), count(atlas, 1009), count(atlas, 0)]
+    assert np.all(table['voxel_count'] == expected_voxels)
+    assert np.allclose(table['volume'], np.array(expected_voxels) * 0.5)
+    assert table['total_voxel_count'][0] == np.count_nonzero(atlas)
+    assert table['total_voxel_count'][1] == count(atlas, 614454277)
+
+    compact_atlas, lut = compact_labels(atlas)
+    bio.to_nii(compact_atlas, atlas_path, scale=(0.5, 0.5, 2))
+    compact_table = rv.region_volumes(atlas_path, hierarchy=hierarchy, labels_lut=lut)
+    assert np.all(compact_table == table)
+
+
+def test_region_volumes_of_array(tmpdir, atlas, hierarchy):
+    atlas_path = str(tmpdir.join('atlas.nii'))
+    bio.to_nii(atlas, atlas_path, scale=(0.5, 0.5, 2))
+    table = rv.region_volumes(atlas_path, hierarchy=hierarchy, slab_size=4)
+    assert np.all(rv.region_volumes(atlas, hierarchy=hierarchy, slab_size=4, voxel_volume=0.5) == table)
+
+    compact_atlas, lut = compact_labels(atlas)
+    assert np.all(rv.region_volumes(compact_atlas, hierarchy=hierarchy, labels_lut=lut, voxel_volume=0.5) == table)
+    with pytest.raises(ValueError):
+        rv.region_volumes(atlas)
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from amap.registration import registration_params
@@ -33,10 +35,15 @@ class RegistrationParamsMock(registration_params.RegistrationParams):
 
         self.segmentation_interpolation_order = ('-inter', 0)
 
+        self.n_threads = {'affine': 0, 'freeform': 0, 'segmentation': 0}
+        self.cpu_affinity = {'affine': '', 'freeform': '', 'segmentation': ''}
+
         self.default_atlas_path = '/home/lambda/amap/default_atlas.nii'
         self.atlas_path = '/home/lambda/amap/atlas.nii'
         self.atlas_brain_path = '/home/lambda/amap/atlas_brain.nii'
         self.hemispheres_path = '/home/lambda/amap/hemispheres_path.ini'
+        self.atlas_labels_lut_path = '/home/lambda/amap/atlas_labels_lut.npy'
+        self.atlas_mask_cache_folder = '/home/lambda/.amap/mask_cache'
         self.atlas_x_pix_size = 0.01  # WARNING: mm
         self.atlas_y_pix_size = 0.01  # WARNING: mm
         self.atlas_z_pix_size = 0.01  # WARNING: mm
@@ -62,3 +69,12 @@ def test_format_segmentation_params(params):
 
 def test_get_binary(params):
     pass
+
+
+def test_get_environment(params):
+    assert params.get_environment('affine').get('OMP_NUM_THREADS') == os.environ.get('OMP_NUM_THREADS')
+    params.n_threads['freeform'] = 6
+    params.cpu_affinity['freeform'] = '0-5'
+    env = params.get_environment('freeform')
+    assert env['OMP_NUM_THREADS'] == '6'
+    assert env['GOMP_CPU_AFFINITY'] == '0-5'
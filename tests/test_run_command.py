@@ -0,0 +1,78 @@
+import sys
+import asyncio
+
+import pytest
+
+from amap.utils.run_command import safe_execute_command, run_command_async, run_commands, \
+    SafeExecuteCommandError, CommandTimeoutError
+
+
+def python_cmd(code):
+    return [sys.executable, '-c', code]
+
+
+def test_safe_execute_command_logs(tmpdir):
+    log_path = str(tmpdir.join('cmd.log'))
+    err_path = str(tmpdir.join('cmd.err'))
+    lines = []
+    result = safe_execute_command(python_cmd('import sys, time; print("out 1"); print("out 2"); '
+                                             'print("err", file=sys.stderr); x = bytearray(50 * 2**20); '
+                                             'time.sleep(0.5)'),
+                                  log_path, err_path, line_callback=lambda stream, line: lines.append((stream, line)))
+    assert open(log_path).read() == 'out 1\nout 2\n'
+    assert open(err_path).read() == 'err\n'
+    assert ('stdout', 'out 2\n') in lines and ('stderr', 'err\n') in lines
+    assert result.return_code == 0
+    assert result.wall_time >= 0.5
+    assert result.peak_rss > 50 * 2**20
+
+
+def test_safe_execute_command_no_shell(tmpdir):
+    log_path = str(tmpdir.join('cmd.log'))
+    safe_execute_command('{} -c "import sys; print(sys.argv[1:])" "a b" \'$HOME\''.format(sys.executable),
+                         log_path, str(tmpdir.join('cmd.err')))
+    assert open(log_path).read() == "['a b', '$HOME']\n"
+
+
+def test_safe_execute_command_failure(tmpdir):
+    with pytest.raises(SafeExecuteCommandError) as err:
+        safe_execute_command(python_cmd('import sys; print("bad input", file=sys.stderr); sys.exit(3)'),
+                             str(tmpdir.join('cmd.log')), str(tmpdir.join('cmd.err')))
+    assert 'bad input' in str(err.value)
+    with pytest.raises(SafeExecuteCommandError):
+        safe_execute_command(str(tmpdir.join('missing_program')), str(tmpdir.join('cmd.log')),
+                             str(tmpdir.join('cmd.err')))
+
+
+def test_timeout(tmpdir):
+    with pytest.raises(CommandTimeoutError):
+        safe_execute_command(python_cmd('import time; time.sleep(30)'), str(tmpdir.join('cmd.log')),
+                             str(tmpdir.join('cmd.err')), timeout=0.5)
+
+
+def test_timeout_after_closing_output(tmpdir):
+    with pytest.raises(CommandTimeoutError):
+        safe_execute_command(python_cmd('import os, time; os.close(1); os.close(2); time.sleep(30)'),
+                             str(tmpdir.join('cmd.log')), str(tmpdir.join('cmd.err')), timeout=0.5)
+
+
+def test_cancel(tmpdir):
+    async def cancel_after_start():
+        task = asyncio.ensure_future(run_command_async(python_cmd('import time; time.sleep(30)'),
+                                                       str(tmpdir.join('cmd.log')), str(tmpdir.join('cmd.err'))))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(asyncio.wait_for(cancel_after_start(), 10))
+
+
+def test_run_commands(tmpdir):
+    commands = [{'cmd': python_cmd('import time; time.sleep(0.5); print({})'.format(i)),
+                 'log_file_path': str(tmpdir.join('cmd_{}.log'.format(i))),
+                 'error_file_path': str(tmpdir.join('cmd_{}.err'.format(i)))} for i in range(4)]
+    commands[2]['cmd'] = python_cmd('import sys; sys.exit(1)')
+    results = asyncio.run(run_commands(commands, max_concurrent=2))
+    assert isinstance(results[2], SafeExecuteCommandError)
+    assert [open(commands[i]['log_file_path']).read() for i in (0, 1, 3)] == ['0\n', '1\n', '3\n']
+    assert all(results[i].wall_time >= 0.5 for i in (0, 1, 3))
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import amap
+from amap.registration import stand_in_niftyreg as stand_in
+from amap.registration.deformation import Deformation, load_affine_matrix
+from amap.registration.progress import ProgressRecorder, summarise_progress
+from amap.utils.run_command import safe_execute_command, SafeExecuteCommandError
+
+REFERENCE_AFFINE = np.array([[0.05, 0, 0, 1.],
+                             [0, 0.05, 0, 2.],
+                             [0, 0, 0.05, 3.],
+                             [0, 0, 0, 1.]])
+
+
+@pytest.fixture
+def images(tmpdir):
+    reference_path = str(tmpdir.join('reference.nii'))
+    floating_path = str(tmpdir.join('floating.nii'))
+    rng = np.random.RandomState(0)
+    nib.save(nib.Nifti1Image(rng.rand(20, 24, 16).astype(np.float32), REFERENCE_AFFINE), reference_path)
+    nib.save(nib.Nifti1Image(rng.randint(0, 1000, (20, 24, 16)).astype(np.uint32), REFERENCE_AFFINE),
+             floating_path)
+    return reference_path, floating_path
+
+
+def test_get_setting(monkeypatch):
+    monkeypatch.delenv('AMAP_STAND_IN_CPU_SECONDS', raising=False)
+    monkeypatch.delenv('AMAP_STAND_IN_REG_F3D_CPU_SECONDS', raising=False)
+    assert stand_in.get_setting('reg_f3d', 'cpu_seconds', 0) == 0
+    monkeypatch.setenv('AMAP_STAND_IN_CPU_SECONDS', '5')
+    assert stand_in.get_setting('reg_f3d', 'cpu_seconds', 0) == '5'
+    monkeypatch.setenv('AMAP_STAND_IN_REG_F3D_CPU_SECONDS', '7')
+    assert stand_in.get_setting('reg_f3d', 'cpu_seconds', 0) == '7'
+    assert stand_in.get_setting('reg_aladin', 'cpu_seconds', 0) == '5'
+
+
+def test_parse_spacing():
+    voxel_sizes = (0.05, 0.05, 0.1)
+    np.testing.assert_allclose(stand_in.parse_spacing([-10, None, None], voxel_sizes), [10, 10, 10])
+    np.testing.assert_allclose(stand_in.parse_spacing([0.5, None, -4], voxel_sizes), [10, 10, 4])
+    np.testing.assert_allclose(stand_in.parse_spacing([None, None, None], voxel_sizes), [5, 5, 5])
+
+
+def test_burn_cpu():
+    start = time.process_time()
+    stand_in.burn_cpu(0.2, n_threads=2)
+    assert time.process_time() - start >= 0.2
+
+
+def test_control_points_are_identity(images):
+    reference_img = nib.load(images[0])
+    control_points, grid_affine = stand_in.make_control_points(reference_img, [-4, None, None])
+    assert control_points.shape == (8, 9, 7, 1, 3)
+    deformation = Deformation(reference_img.shape, reference_img.affine,
+                              control_points.reshape(control_points.shape[:3] + (3,)), grid_affine)
+    points = np.array([[0, 0, 0], [19, 23, 15], [7.5, 3.2, 11]])
+    np.testing.assert_allclose(deformation.transform_points(points),
+                               nib.affines.apply_affine(REFERENCE_AFFINE, points), atol=1e-4)
+
+
+def test_control_points_compose_affine(images):
+    affine_matrix = np.eye(4)
+    affine_matrix[:3, 3] = [0.1, -0.2, 0.3]
+    reference_img = nib.load(images[0])
+    control_points, grid_affine = stand_in.make_control_points(reference_img, [-5, None, None], affine_matrix)
+    deformation = Deformation(reference_img.shape, reference_img.affine,
+                              control_points.reshape(control_points.shape[:3] + (3,)), grid_affine)
+    points = np.array([[3, 4, 5], [10, 20, 12]])
+    np.testing.assert_allclose(deformation.transform_points(points),
+                               nib.affines.apply_affine(REFERENCE_AFFINE, points) + [0.1, -0.2, 0.3], atol=1e-4)
+
+
+def test_registration_outputs(tmpdir, images, capsys):
+    reference_path, floating_path = images
+    affine_matrix_path = str(tmpdir.join('affine_matrix.txt'))
+    control_point_file_path = str(tmpdir.join('control_point_file.nii'))
+    registered_atlas_path = str(tmpdir.join('registered_atlas.nii'))
+
+    assert stand_in.run('reg_aladin', ['-ln', '3', '-lp', '2', '-flo', floating_path, '-ref', reference_path,
+                                       '-aff', affine_matrix_path, '-res', str(tmpdir.join('affine.nii'))]) == 0
+    np.testing.assert_array_equal(load_affine_matrix(affine_matrix_path), np.eye(4))
+
+    assert stand_in.run('reg_f3d', ['-ln', '2', '-sx', '-10', '-be', '0.95', '-smooR', '-1.0', '--rbn', '128',
+                                    '-aff', affine_matrix_path, '-flo', floating_path, '-ref', reference_path,
+                                    '-cpp', control_point_file_path, '-res', str(tmpdir.join('freeform.nii'))]) == 0
+    assert nib.load(control_point_file_path).shape == (5, 6, 5, 1, 3)
+    assert nib.load(str(tmpdir.join('freeform.nii'))).shape == (20, 24, 16)
+
+    assert stand_in.run('reg_resample', ['-inter', '0', '-cpp', control_point_file_path, '-flo', floating_path,
+                                         '-ref', reference_path, '-res', registered_atlas_path]) == 0
+    registered_atlas = nib.load(registered_atlas_path)
+    assert registered_atlas.get_data_dtype() == np.uint32
+    np.testing.assert_array_equal(np.asarray(registered_atlas.dataobj),
+                                  np.asarray(nib.load(floating_path).dataobj))
+
+    output = capsys.readouterr().out
+    recorder = ProgressRecorder('', 'freeform')
+    for line in output[output.index('[reg_f3d]'):].splitlines():
+        recorder('stdout', line)
+    recorder.close()
+    assert [level['level'] for level in summarise_progress(recorder.events)] == [1, 2]
+
+
+def test_unknown_program():
+    with pytest.raises(stand_in.StandInError):
+        stand_in.run('reg_jacobian', [])
+
+
+def test_as_program_path(tmpdir, images):
+    reference_path, floating_path = images
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(amap.__file__))
+    env['AMAP_STAND_IN_EXIT_CODE'] = '3'
+    cmd = '{} -m amap.registration.stand_in_niftyreg reg_resample --memory-mb 50 -flo {} -ref {} -res {}'.format(
+        sys.executable, floating_path, reference_path, str(tmpdir.join('resampled.nii')))
+    log_file_path, error_file_path = str(tmpdir.join('resample.log')), str(tmpdir.join('resample.err'))
+    with pytest.raises(SafeExecuteCommandError):
+        safe_execute_command(cmd, log_file_path, error_file_path, env=env)
+    assert 'Simulated failure' in open(error_file_path).read()
+    assert os.path.exists(str(tmpdir.join('resampled.nii')))
+
+    del env['AMAP_STAND_IN_EXIT_CODE']
+    result = safe_execute_command(cmd, log_file_path, error_file_path, env=env)
+    assert result.return_code == 0
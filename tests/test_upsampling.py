@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+from amap.brain import brain_io as bio
+from amap.brain.sample_space import SampleSpace
+from amap.brain.upsampling import export_to_raw_resolution
+from amap.config.atlas import compact_labels
+
+
+@pytest.fixture()
+def atlas():
+    ids = np.array([0, 997, 614454277, 1009], dtype=np.uint32)
+    return ids[np.random.RandomState(0).randint(0, 4, size=(5, 6, 4))]
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_export_to_raw_resolution(tmpdir, atlas, compact):
+    sample_space = SampleSpace(0.5, 0.4, 0.3, raw_shape=(10, 15, 13))
+    atlas_path = str(tmpdir.join('atlas.nii'))
+    if compact:
+        compact_atlas, lut = compact_labels(atlas)
+        bio.to_nii(compact_atlas, atlas_path)
+    else:
+        lut = None
+        bio.to_nii(atlas, atlas_path)
+    dest_folder = str(tmpdir.join('raw_atlas'))
+    paths = export_to_raw_resolution(atlas_path, dest_folder, sample_space, labels_lut=lut,
+                                     n_workers=2, max_planes_in_flight=3)
+    assert paths == [os.path.join(dest_folder, 'plane_{:04d}.tif'.format(i)) for i in range(13)]
+    assert bio.get_shape(dest_folder) == (10, 15, 13)
+
+    raw_points = np.indices((10, 15, 13)).reshape(3, -1).T
+    nearest = np.floor(sample_space.raw_to_downsampled(raw_points) + 0.5).astype(int)
+    nearest = np.minimum(nearest, np.array(atlas.shape) - 1)
+    expected = atlas[nearest[:, 0], nearest[:, 1], nearest[:, 2]].reshape(10, 15, 13)
+    for i, path in enumerate(paths):
+        plane = tifffile.imread(path)
+        assert plane.dtype == np.uint32
+        assert (plane == expected[:, :, i]).all()